@@ -0,0 +1,301 @@
+"""
+在生成的大文档上测量 execute_format_request 的耗时、UNO 写调用次数和峰值内存。
+
+必须使用 LibreOffice 自带的 Python 运行 (需要 uno / pyuno)，例如:
+
+    /opt/libreoffice26.2/program/python benchmarks/bench_format.py --pages 10,50,200
+
+脚本会启动一个使用独立用户目录的 headless soffice，通过复制 mao.odt (--source) 生成
+指定页数的文档 (或用 --paragraphs 生成指定段数的合成文档)，保存到临时目录；
+每个场景重新加载一份，执行固定的 JSON 计划后不保存关闭。
+
+每个场景输出:
+    wall      execute_format_request 的耗时 (多次运行取中位数)
+    calls     bridge_stats 中的写调用次数 / 写入的属性个数 / 合并省下的调用次数
+    office    soffice.bin 的峰值常驻内存 (VmHWM，每个场景前通过 clear_refs 重置)
+    python    Python 侧 tracemalloc 峰值
+
+对比修改前后:
+
+    git show HEAD~1:main.py > /tmp/main_before.py
+    /opt/libreoffice26.2/program/python benchmarks/bench_format.py --module /tmp/main_before.py
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import uno
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPE_NAME = "writerai_bench"
+
+
+# ------------------------------------------------
+# Scenarios: (名称, 根据页数生成计划的函数)
+# ------------------------------------------------
+
+def plan_page_wide(pages):
+    targets = sorted({1, (pages + 1) // 2, pages})
+    return {f"page_{page}": {"line_all": {"font_color": "1F4E79", "italic": True}} for page in targets}
+
+
+def plan_lines(pages):
+    return {f"page_{page}": {"line_1": {"bold": True}, "line_2": {"bold": True}, "line_3": {"highlight": "FFFF00"}}
+            for page in range(1, pages + 1)}
+
+
+def plan_document(pages):
+    return {"all_pages": {"font_name": "Liberation Serif", "font_size": 12, "align_justify": True}}
+
+
+def plan_insert_replace(pages):
+    plan = {}
+    for page in range(1, pages + 1, max(1, pages // 10)):
+        plan[f"page_{page}"] = {
+            "line_1": {"insert_text": "[start] ", "insert_before": True},
+            "line_2": {"replace_text": "Replaced paragraph."},
+        }
+    return plan
+
+
+def plan_headings(pages):
+    return {"headings": {"bold": True, "font_color": "C00000"}}
+
+
+def plan_find(pages):
+    return {"find": {"text": "the", "whole_words": True, "format": {"highlight": "FFFF00"}}}
+
+
+SCENARIOS = [
+    ("page_wide", plan_page_wide),
+    ("lines", plan_lines),
+    ("document", plan_document),
+    ("insert_replace", plan_insert_replace),
+    ("headings", plan_headings),
+    ("find", plan_find),
+]
+
+
+# ------------------------------------------------
+# Office process
+# ------------------------------------------------
+
+def start_office(soffice, profile_dir):
+    command = [
+        soffice, "--headless", "--invisible", "--norestore", "--nologo", "--nodefault",
+        f"-env:UserInstallation={uno.systemPathToFileUrl(profile_dir)}",
+        f"--accept=pipe,name={PIPE_NAME};urp;StarOffice.ComponentContext",
+    ]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def connect(timeout=60):
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return resolver.resolve(f"uno:pipe,name={PIPE_NAME};urp;StarOffice.ComponentContext")
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def office_pid(root_pid):
+    """soffice 启动脚本会再启动 soffice.bin；返回其 pid，找不到时返回 root_pid。"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{entry}/comm") as file:
+                name = file.read().strip()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append((int(entry), name))
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        for child, name in children.get(pid, []):
+            if name == "soffice.bin":
+                return child
+            pending.append(child)
+    return root_pid
+
+
+def reset_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+# ------------------------------------------------
+# Documents
+# ------------------------------------------------
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("writerai_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_document(module, desktop, path, pages=None, paragraphs=None, source=None):
+    """复制 source 直到达到 pages 页，或生成 paragraphs 段合成正文；返回 (页数, 段数)。"""
+    doc = desktop.loadComponentFromURL("private:factory/swriter", "_blank", 0,
+                                       (module.make_property("Hidden", True),))
+    try:
+        text = doc.Text
+        if paragraphs:
+            from com.sun.star.text.ControlCharacter import PARAGRAPH_BREAK
+            cursor = text.createTextCursor()
+            for number in range(paragraphs):
+                cursor.ParaStyleName = "Heading 1" if number % 20 == 0 else "Text body"
+                text.insertString(cursor, f"Paragraph {number}: " + "the quick brown fox jumps over the lazy dog " * 6,
+                                  False)
+                if number + 1 < paragraphs:
+                    text.insertControlCharacter(cursor, PARAGRAPH_BREAK, False)
+        else:
+            source_url = uno.systemPathToFileUrl(os.path.abspath(source))
+            resolver = module.PageResolver(doc)
+            while True:
+                cursor = text.createTextCursor()
+                cursor.gotoEnd(False)
+                cursor.insertDocumentFromURL(source_url, ())
+                resolver.invalidate()
+                if resolver.page_count() >= pages:
+                    break
+        resolver = module.PageResolver(doc)
+        page_count = resolver.page_count()
+        paragraph_count = len(module.ParagraphIndex(doc, None).paragraphs)
+        doc.storeToURL(uno.systemPathToFileUrl(path), ())
+        return page_count, paragraph_count
+    finally:
+        doc.close(True)
+
+
+def run_scenario(module, ctx, desktop, doc_path, plan, pid, suspend_layout):
+    doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(doc_path), "_blank", 0,
+                                       (module.make_property("Hidden", True),))
+    try:
+        for key in module.bridge_stats:
+            module.bridge_stats[key] = 0
+        fmt = module.Format(ctx, doc)
+        reset_peak_rss(pid)
+        tracemalloc.start()
+        started = time.perf_counter()
+        module.execute_format_request(json.loads(json.dumps(plan)), fmt, suspend_layout=suspend_layout)
+        wall = time.perf_counter() - started
+        python_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {
+            "wall": wall,
+            "stats": dict(module.bridge_stats),
+            "office_peak_kb": peak_rss_kb(pid),
+            "python_peak_kb": python_peak // 1024,
+        }
+    finally:
+        doc.close(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default=os.path.join(REPO_DIR, "main.py"), help="要测量的 main.py")
+    parser.add_argument("--soffice", default="soffice", help="soffice 可执行文件")
+    parser.add_argument("--source", default=os.path.join(REPO_DIR, "mao.odt"), help="复制生成文档的源文件")
+    parser.add_argument("--pages", default="10,50", help="逗号分隔的目标页数")
+    parser.add_argument("--paragraphs", default="", help="逗号分隔的合成文档段数 (代替 --pages)")
+    parser.add_argument("--scenarios", default=",".join(name for name, _ in SCENARIOS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no-suspend-layout", dest="suspend_layout", action="store_false")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    module = load_module(args.module)
+    if hasattr(module, "set_log_level"):
+        module.set_log_level("WARNING")
+    scenarios = [(name, build) for name, build in SCENARIOS if name in args.scenarios.split(",")]
+    if args.paragraphs:
+        sizes = [("paragraphs", int(value)) for value in args.paragraphs.split(",")]
+    else:
+        sizes = [("pages", int(value)) for value in args.pages.split(",")]
+
+    work_dir = tempfile.mkdtemp(prefix="writerai-bench-")
+    office = start_office(args.soffice, os.path.join(work_dir, "profile"))
+    desktop = None
+    results = []
+    try:
+        ctx = connect()
+        desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+        pid = office_pid(office.pid)
+
+        for kind, size in sizes:
+            doc_path = os.path.join(work_dir, f"{kind}_{size}.odt")
+            started = time.perf_counter()
+            if kind == "pages":
+                pages, paragraphs = generate_document(module, desktop, doc_path, pages=size, source=args.source)
+            else:
+                pages, paragraphs = generate_document(module, desktop, doc_path, paragraphs=size)
+            print(f"{os.path.basename(doc_path)}: {pages} pages, {paragraphs} paragraphs "
+                  f"(generated in {time.perf_counter() - started:.1f}s)")
+
+            for name, build in scenarios:
+                plan = build(pages)
+                runs = [run_scenario(module, ctx, desktop, doc_path, plan, pid, args.suspend_layout)
+                        for _ in range(args.runs)]
+                wall = statistics.median(run["wall"] for run in runs)
+                stats = runs[-1]["stats"]
+                office_peak = max(run["office_peak_kb"] for run in runs)
+                python_peak = max(run["python_peak_kb"] for run in runs)
+                print(f"    {name:<15} wall {wall * 1000:9.1f} ms  "
+                      f"calls {stats['bridge_calls']:6d} / writes {stats['property_writes']:6d} "
+                      f"(saved {stats['saved_calls']:6d})  "
+                      f"office {office_peak / 1024:7.1f} MB  python {python_peak / 1024:6.1f} MB")
+                results.append({
+                    "document": os.path.basename(doc_path), "pages": pages, "paragraphs": paragraphs,
+                    "scenario": name, "wall": wall, "runs": [run["wall"] for run in runs],
+                    "stats": stats, "office_peak_kb": office_peak, "python_peak_kb": python_peak,
+                })
+    finally:
+        try:
+            if desktop is not None:
+                desktop.terminate()
+        except Exception:
+            pass
+        try:
+            office.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            office.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""
+测量 main.py 被 LibreOffice 加载时的导入耗时。
+
+必须使用 LibreOffice 自带的 Python 运行 (需要 uno / pyuno)，例如:
+
+    /opt/libreoffice26.2/program/python benchmarks/bench_startup.py
+
+对比修改前后:
+
+    git show HEAD~1:main.py > /tmp/main_before.py
+    /opt/libreoffice26.2/program/python benchmarks/bench_startup.py /tmp/main_before.py main.py
+
+每个模块在独立的子进程中导入 --runs 次 (避免 sys.modules 缓存)，输出中位数与最小值，
+并用 -X importtime 列出自身耗时最高的导入。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import importlib.util, sys, time
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("writerai_main", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - started)
+"""
+
+
+def measure(python, path, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [python, "-c", IMPORT_SNIPPET, path],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return samples
+
+
+def top_imports(python, path, limit):
+    """返回 -X importtime 中自身耗时 (微秒) 最高的导入。"""
+    stderr = subprocess.run(
+        [python, "-X", "importtime", "-c", IMPORT_SNIPPET, path],
+        check=True, capture_output=True, text=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=[os.path.join(REPO_DIR, "main.py")],
+                        help="main.py 文件路径，可传多个用于对比")
+    parser.add_argument("--python", default=sys.executable, help="LibreOffice 自带的 python")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for path in args.modules:
+        samples = measure(args.python, path, args.runs)
+        print(f"{path}: median {statistics.median(samples) * 1000:.1f} ms, "
+              f"min {min(samples) * 1000:.1f} ms over {args.runs} runs")
+        for self_us, name in top_imports(args.python, path, args.top):
+            print(f"    {self_us / 1000:8.2f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
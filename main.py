@@ -1,36 +1,27 @@
 import uno
 import re
 import unohelper
-import dashscope # 需安装：pip install dashscope
-from http import HTTPStatus
 import json
+import logging
 import os
+import time
+import unicodedata
 import traceback
+import threading
+import queue
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
 import sys # To print to stderr
+# 模块导入时只加载注册组件和定义监听器类所需的接口；
+# UNO 常量、ssl/http.client/hashlib 等较重的依赖在首次使用时于函数内导入
 from com.sun.star.task import XJobExecutor
-from com.sun.star.awt import MessageBoxButtons as MSG_BUTTONS
-from com.sun.star.awt import XActionListener, XItemListener
-from com.sun.star.awt.PosSize import POS, SIZE, POSSIZE
-from com.sun.star.awt.PushButtonType import OK, CANCEL
-from com.sun.star.util.MeasureUnit import TWIP
+from com.sun.star.awt import XActionListener
+from com.sun.star.util import XModifyListener
 
-from com.sun.star.awt.FontWeight import BOLD
-from com.sun.star.awt.FontSlant import ITALIC
-from com.sun.star.awt import FontUnderline
-from com.sun.star.style.ParagraphAdjust import LEFT, RIGHT, CENTER, BLOCK
-
-from com.sun.star.ui.dialogs.TemplateDescription import FILEOPEN_SIMPLE
-
-from com.sun.star.awt.MessageBoxButtons import BUTTONS_YES_NO
-from com.sun.star.awt.MessageBoxResults import YES
-
-from com.sun.star.awt.FontWeight import NORMAL
-from com.sun.star.awt.FontSlant import NONE
-from com.sun.star.awt.FontUnderline import NONE as UNDERLINE_NONE
-
-
-# select file to format
-def pick_writer_file(ctx):
+# select files to format
+def pick_writer_files(ctx):
+    """返回用户选择的文档 URL 列表 (支持多选)，取消时返回空列表。"""
 
     smgr = ctx.getServiceManager()
 
@@ -39,9 +30,11 @@ def pick_writer_file(ctx):
         ctx
     )
 
+    from com.sun.star.ui.dialogs.TemplateDescription import FILEOPEN_SIMPLE
     file_picker.initialize((FILEOPEN_SIMPLE,))
 
-    file_picker.setTitle("Select Writer Document")
+    file_picker.setTitle("Select Writer Documents")
+    file_picker.setMultiSelectionMode(True)
 
     file_picker.appendFilter("Writer Documents", "*.odt;*.docx;*.doc")
     file_picker.setCurrentFilter("Writer Documents")
@@ -49,16 +42,52 @@ def pick_writer_file(ctx):
     result = file_picker.execute()
 
     if result == 1:
-        files = file_picker.getFiles()
-        return files[0]
+        try:
+            return list(file_picker.getSelectedFiles())
+        except AttributeError:
+            # 旧接口：多选时第一个元素是目录，其余是文件名
+            files = file_picker.getFiles()
+            if len(files) > 1:
+                folder = files[0].rstrip("/")
+                return [f"{folder}/{name}" for name in files[1:]]
+            return list(files)
+
+    return []
+
+
+def make_property(name, value):
+    prop = uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+    prop.Name = name
+    prop.Value = value
+    return prop
 
-    return None
     
+# 日志默认只输出 WARNING 及以上，设置中的 log_level 可调为 INFO / DEBUG
+logger = logging.getLogger("writerai")
+logger.propagate = False
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s writerai: %(message)s"))
+    logger.addHandler(_handler)
+logger.setLevel(logging.WARNING)
+
+
+def set_log_level(level):
+    """按级别名 ("DEBUG"、"INFO" ...) 或数值设置日志级别，无效值被忽略。"""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.strip().upper())
+    if isinstance(level, int):
+        logger.setLevel(level)
+
+
 # Helper for debugging
-def log_to_console(*args):
-    """Prints messages to the console for debugging."""
-    print(*args, file=sys.stderr)
-    sys.stderr.flush()
+def log_to_console(*args, level=logging.INFO):
+    """
+    按级别写日志；低于当前级别的消息不拼接也不输出。
+    DEBUG 消息把变量作为单独的参数传入，不要先写成 f-string，否则关闭 DEBUG 时仍会格式化。
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, " ".join(str(arg) for arg in args))
 
 
 def get_doc(ctx):
@@ -69,17 +98,417 @@ def get_doc(ctx):
     return desktop.getCurrentComponent()
     
        
+class PageResolver:
+    """
+    解析并缓存每页的 (起点, 终点) TextRange。
+
+    Writer 的 API 只有视图光标实现 XPageCursor，模型光标 (createTextCursor) 和段落对象都没有页码，
+    也不能另外创建一个隐藏的视图光标，所以页的范围只能借用视图光标解析：期间锁定控制器，
+    结束后恢复用户原来的选区和滚动位置 (ViewData)，界面上不会出现跳转或重绘。
+    隐藏加载和 headless 模式下的文档同样有控制器和版面；没有控制器时抛出 RuntimeError，
+    调用方按无版面处理。页数直接读取控制器的 PageCount，不移动视图光标。
+    结果缓存到版面变化 (文档被修改) 为止。
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._pages = {}
+        self._page_count = None
+
+    def invalidate(self):
+        self._pages.clear()
+        self._page_count = None
+
+    def page_range(self, page):
+        bounds = self._pages.get(page)
+        if bounds is None:
+            self.prefetch([page])
+            bounds = self._pages[page]
+        return bounds
+
+    def page_count(self):
+        if self._page_count is None:
+            controller = self._controller()
+            try:
+                self._page_count = controller.PageCount
+            except Exception:
+                # 没有 PageCount 属性的控制器：走到最后一页读取页码
+                with self._view_cursor() as view_cursor:
+                    view_cursor.jumpToLastPage()
+                    self._page_count = view_cursor.getPage()
+        return self._page_count
+
+    def prefetch(self, pages):
+        """一次性解析多页，只保存/恢复一次视图状态。"""
+        missing = sorted(set(pages) - set(self._pages))
+        if not missing:
+            return
+        with self._view_cursor() as view_cursor:
+            for page in missing:
+                view_cursor.jumpToPage(page)
+                view_cursor.jumpToStartOfPage()
+                start_range = view_cursor.getStart()
+                view_cursor.jumpToEndOfPage()
+                self._pages[page] = (start_range, view_cursor.getEnd())
+
+    def _controller(self):
+        controller = self.doc.getCurrentController()
+        if controller is None:
+            raise RuntimeError("Document has no layout view")
+        return controller
+
+    @contextmanager
+    def _view_cursor(self):
+        """借用视图光标：期间锁定控制器，结束后恢复选区和 ViewData。"""
+        controller = self._controller()
+        view_cursor = controller.getViewCursor()
+        selection = controller.getSelection()
+        view_data = controller.getViewData()
+        self.doc.lockControllers()
+        try:
+            yield view_cursor
+        finally:
+            try:
+                if selection is not None:
+                    controller.select(selection)
+                controller.restoreViewData(view_data)
+            except Exception as e:
+                log_to_console(f"Error restoring view state: {e}", level=logging.WARNING)
+            self.doc.unlockControllers()
+
+
+class ParagraphIndex(unohelper.Base, XModifyListener):
+    """
+    文档正文的段落索引，每个文档一个实例。
+
+    第一次使用时枚举一遍正文，记录所有段落对象 (段落对象在编辑过程中保持稳定)；
+    段落样式名 -> 段落序号的样式索引在首次按样式查询时一次遍历建立；
+    页码到 (起点, 终点) 范围 (由 PageResolver 解析) 以及页首段落序号在首次查询后缓存，
+    之后按页/行查找为 O(1)。
+    文档被修改时通过 XModifyListener 失效，同时 revision 加一。
+    """
+
+    _instances = {}
+
+    @classmethod
+    def for_document(cls, doc):
+        key = doc.RuntimeUID
+        index = cls._instances.get(key)
+        if index is None:
+            index = cls._instances[key] = cls(doc, key)
+            doc.addModifyListener(index)
+        return index
+
+    def __init__(self, doc, key):
+        self.doc = doc
+        self.key = key
+        self._paragraphs = None
+        self._styles = None
+        self._headings = None
+        self._paragraph_styles = None
+        self.pages = PageResolver(doc)
+        self._page_first_paragraph = {}
+        self._paused = 0
+        self._stale = False
+        self._context = None
+        self.revision = 0
+
+    # --- XModifyListener ---
+
+    def modified(self, event):
+        if self._paused:
+            self._stale = True
+        else:
+            self.invalidate()
+
+    def disposing(self, event):
+        ParagraphIndex._instances.pop(self.key, None)
+        self.invalidate()
+
+    # ------------------------------------------------
+
+    def invalidate(self):
+        self._paragraphs = None
+        self._styles = None
+        self._headings = None
+        self._paragraph_styles = None
+        self.pages.invalidate()
+        self._page_first_paragraph.clear()
+        self._stale = False
+        self.revision += 1
+
+    @contextmanager
+    def paused(self):
+        """期间的修改事件只做标记，退出时再统一失效。"""
+        self._paused += 1
+        try:
+            yield self
+        finally:
+            self._paused -= 1
+            if not self._paused and self._stale:
+                self.invalidate()
+
+    @property
+    def paragraphs(self):
+        if self._paragraphs is None:
+            paragraphs = []
+            enumeration = self.doc.Text.createEnumeration()
+            while enumeration.hasMoreElements():
+                element = enumeration.nextElement()
+                # 跳过表格等非段落对象，与 gotoNextParagraph 的行为一致
+                if element.supportsService("com.sun.star.text.Paragraph"):
+                    paragraphs.append(element)
+            self._paragraphs = paragraphs
+        return self._paragraphs
+
+    def _build_styles(self):
+        # 一次遍历读取每段的样式名和大纲级别 (每段一次 getPropertyValues)
+        styles, names, headings, paragraph_styles = {}, {}, [], []
+        for ordinal, paragraph in enumerate(self.paragraphs):
+            outline_level, style_name = paragraph.getPropertyValues(("OutlineLevel", "ParaStyleName"))
+            styles.setdefault(style_name.lower(), []).append(ordinal)
+            names.setdefault(style_name.lower(), style_name)
+            paragraph_styles.append(style_name)
+            if outline_level > 0 or style_name.startswith("Heading"):
+                headings.append(ordinal)
+        self._styles, self._style_names, self._headings = styles, names, headings
+        self._paragraph_styles = paragraph_styles
+
+    def style_names(self):
+        """文档正文中正在使用的段落样式名。"""
+        if self._styles is None:
+            self._build_styles()
+        return list(self._style_names.values())
+
+    def paragraph_styles(self):
+        """按段落序号排列的段落样式名。"""
+        if self._paragraph_styles is None:
+            self._build_styles()
+        return self._paragraph_styles
+
+    def paragraphs_with_style(self, style_name):
+        """返回样式为 style_name (不区分大小写) 的段落序号列表。"""
+        if self._styles is None:
+            self._build_styles()
+        return self._styles.get(str(style_name).lower(), [])
+
+    def heading_paragraphs(self):
+        """返回所有标题段落 (大纲级别 > 0 或 Heading 样式) 的序号列表。"""
+        if self._headings is None:
+            self._build_styles()
+        return self._headings
+
+    def page_range(self, page):
+        """返回第 page 页的 (起点, 终点) TextRange。"""
+        return self.pages.page_range(page)
+
+    def line(self, page, line):
+        """返回第 page 页第 line 段的段落对象 (超出末尾时返回最后一段)。"""
+        paragraphs = self.paragraphs
+        if not paragraphs:
+            raise RuntimeError("Document has no paragraphs")
+        return paragraphs[min(self.page_first_paragraph(page) + max(line, 1) - 1, len(paragraphs) - 1)]
+
+    def page_first_paragraph(self, page):
+        """第 page 页页首所在段落的序号 (即该页 line_1)。"""
+        first = self._page_first_paragraph.get(page)
+        if first is None:
+            first = self._page_first_paragraph[page] = self.paragraph_at(self.page_range(page)[0])
+        return first
+
+    def page_starts(self):
+        """所有页的页首段落序号，第 1 页在下标 0。"""
+        pages = range(1, self.pages.page_count() + 1)
+        self.pages.prefetch(pages)
+        return [self.page_first_paragraph(page) for page in pages]
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = DocumentContext(self)
+        return self._context
+
+    def paragraph_at(self, text_range):
+        """二分查找包含 text_range 起点的段落序号。"""
+        paragraphs = self.paragraphs
+        text = self.doc.Text
+        found, low, high = 0, 0, len(paragraphs) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            # compareRegionStarts: 1 表示段落起点在前，0 表示相同，-1 表示在后
+            if text.compareRegionStarts(paragraphs[middle], text_range) >= 0:
+                found, low = middle, middle + 1
+            else:
+                high = middle - 1
+        return found
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：CJK 等宽字符约 1 个/字，其余约 4 个字符 1 个。"""
+    wide = sum(1 for char in text if ord(char) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+class DocumentContext:
+    """
+    随指令发给模型的文档概要：每个非空段落一行 "页.行 [样式] 截断的正文"，
+    页.行与计划中的 page_n / line_n 一一对应，并按 token 预算裁剪。
+
+    概要按文档修订 (ParagraphIndex.revision) 缓存，文档未修改时直接复用。
+    修改事件不带范围，无法知道是哪一段变了；修改后先用一次 getString 读取整个正文，
+    正文摘要未变 (只改了格式，如刚执行的计划) 时复用各段的正文，只重新读取样式和页码，
+    否则逐段重新读取。
+    """
+
+    DEFAULT_BUDGET = 1500
+    TEXT_LIMIT = 80         # 每段最多保留的字符数
+    MIN_TEXT_LIMIT = 10
+
+    def __init__(self, index):
+        self.index = index
+        self._rows = None       # (revision, _lines() 的结果)
+        self._snapshot = None   # ((revision, budget), 概要)
+        self._texts = None      # (正文摘要, 各段规范化后的正文)
+
+    def outline(self, budget=DEFAULT_BUDGET):
+        key = (self.index.revision, budget)
+        if self._snapshot is not None and self._snapshot[0] == key:
+            return self._snapshot[1]
+        text = self._trim(self._cached_lines(), budget, "# Document outline (page.line [paragraph style] text)")
+        self._snapshot = (key, text)
+        return text
+
+    def chunks(self, budget=DEFAULT_BUDGET):
+        """
+        概要超出 budget 时按整页切块，每块不超过 budget，块内保留文档页码；
+        返回 [(首页, 页数, 块概要)]。整个文档放得下时只返回一块 (即 outline)。
+        """
+        lines = self._cached_lines()
+        if not lines:
+            return []
+        pages = []      # [(页码, 该页的行, token 数)]
+        for line in lines:
+            if not pages or pages[-1][0] != line[0]:
+                pages.append((line[0], [], 0))
+            page, page_lines, tokens = pages[-1]
+            page_lines.append(line)
+            pages[-1] = (page, page_lines, tokens + self._row_tokens(line, self.TEXT_LIMIT))
+        if sum(tokens for _, _, tokens in pages) <= budget:
+            return [(1, pages[-1][0], self.outline(budget))]
+
+        groups, current, used = [], [], 0
+        for page, page_lines, tokens in pages:
+            if current and used + tokens > budget:
+                groups.append(current)
+                current, used = [], 0
+            current.append((page, page_lines))
+            used += tokens
+        groups.append(current)
+
+        chunks = []
+        for number, group in enumerate(groups, 1):
+            first, last = group[0][0], group[-1][0]
+            rows = [line for _, page_lines in group for line in page_lines]
+            header = (f"# Document outline, part {number} of {len(groups)}: pages {first}-{last} only "
+                      f"(page.line [paragraph style] text)")
+            chunks.append((first, last - first + 1, self._trim(rows, budget, header)))
+        return chunks
+
+    def _cached_lines(self):
+        if self._rows is None or self._rows[0] != self.index.revision:
+            self._rows = (self.index.revision, self._lines())
+        return self._rows[1]
+
+    def _lines(self):
+        """返回 [(页, 行, 样式, 正文, 是否标题)]，跳过空段落。"""
+        index = self.index
+        paragraphs = index.paragraphs
+        styles = index.paragraph_styles()
+        headings = set(index.heading_paragraphs())
+        try:
+            starts = index.page_starts()
+        except Exception as e:
+            # 没有版面时全部按第 1 页编号，line_n 依然能定位到同一段
+            log_to_console(f"Error resolving pages for document context: {e}", level=logging.WARNING)
+            starts = [0]
+
+        texts = self._paragraph_texts(paragraphs)
+        lines, page = [], 0
+        for ordinal, text in enumerate(texts):
+            while page + 1 < len(starts) and starts[page + 1] <= ordinal:
+                page += 1
+            if text:
+                lines.append((page + 1, ordinal - starts[page] + 1, styles[ordinal], text, ordinal in headings))
+        return lines
+
+    def _paragraph_texts(self, paragraphs):
+        """各段规范化后的正文；正文摘要和段落数都未变时不逐段读取。"""
+        import hashlib
+        try:
+            body = self.index.doc.Text.getString()
+            digest = hashlib.blake2b(body.encode("utf-8"), digest_size=16).digest()
+        except Exception as e:
+            log_to_console("Could not read body text, reading paragraphs:", e, level=logging.DEBUG)
+            digest = None
+        if digest is not None and self._texts is not None and self._texts[0] == digest \
+                and len(self._texts[1]) == len(paragraphs):
+            return self._texts[1]
+        texts = [" ".join(paragraph.getString().split()) for paragraph in paragraphs]
+        self._texts = (digest, texts)
+        return texts
+
+    @staticmethod
+    def _render(line, limit):
+        page, number, style, text, _ = line
+        if len(text) > limit:
+            text = text[:limit] + "…"
+        return f"{page}.{number} [{style}] {text}"
+
+    def _row_tokens(self, line, limit):
+        return estimate_tokens(self._render(line, limit)) + 1
+
+    def _trim(self, lines, budget, header):
+        limit = self.TEXT_LIMIT
+        while True:
+            rendered = []
+            for line in lines:
+                text = self._render(line, limit)
+                rendered.append((text, estimate_tokens(text) + 1, line[4]))
+            if sum(tokens for _, tokens, _ in rendered) <= budget or limit <= self.MIN_TEXT_LIMIT:
+                break
+            limit //= 2
+
+        # 截断正文后仍超出预算：先保留标题，其余段落按文档顺序保留到预算用完
+        keep, used = set(), estimate_tokens(header)
+        for headings_first in (True, False):
+            for number, (_, tokens, heading) in enumerate(rendered):
+                if heading == headings_first and used + tokens <= budget:
+                    keep.add(number)
+                    used += tokens
+        output = [header] + [line for number, (line, _, _) in enumerate(rendered) if number in keep]
+        if len(keep) < len(rendered):
+            output.append(f"({len(rendered) - len(keep)} paragraphs omitted)")
+        return "\n".join(output)
+
+
 class Format:
 
-    def __init__(self, ctx, doc):
+    def __init__(self, ctx, doc, style_mode=False, skip_unchanged=False, traverse_all_text=False):
 
         self.ctx = ctx
         self.doc = doc
+        # 为 True 时全文范围的格式写到段落样式上 (见 apply_to_paragraph_styles)
+        self.style_mode = style_mode
+        # 为 True 时只写入与当前值不同的属性 (见 PropertyBatch)
+        self.skip_unchanged = skip_unchanged
+        # 为 True 时全文范围的格式同时写入表格、文本框和页眉页脚 (见 apply_document_operations)
+        self.traverse_all_text = traverse_all_text
 
         if self.doc is None:
             raise RuntimeError("No active document")
 
         self.controller = self.doc.getCurrentController()
+        self.index = ParagraphIndex.for_document(self.doc)
         
         
 
@@ -133,24 +562,12 @@ class Format:
     def get_all_lines_cursor(self, page_num):
 
         try:
-            # 1. go to page 
-            self.goto_page(page_num)
-            view_cursor = self.doc.CurrentController.getViewCursor()
-            
-            # 2. move to the start of the page
-            view_cursor.jumpToStartOfPage()
-            start_range = view_cursor.getStart()
-            
-            # 3. move to the end of the page
-            view_cursor.jumpToEndOfPage()
-            end_range = view_cursor.getEnd()
-            
-            # 4. create a TextCursor
+            start_range, end_range = self.index.page_range(page_num)
             cursor = self.doc.Text.createTextCursorByRange(start_range)
             cursor.gotoRange(end_range, True)
             return cursor
         except Exception as e:
-            log_to_console(f"Error creating page cursor: {e}")
+            log_to_console(f"Error creating page cursor: {e}", level=logging.WARNING)
             return self.doc.Text.createTextCursor()
 
     def get_selection(self):
@@ -163,55 +580,58 @@ class Format:
         return None
         
     def goto_page(self, page):
-        view_cursor = self.get_cursor()
-        view_cursor.jumpToPage(page)
-        view_cursor.jumpToStartOfPage() 
-
-    def goto_line(self, line):
-        view_cursor = self.get_cursor()
-        cursor = self.doc.Text.createTextCursorByRange(view_cursor.getStart())
-        for _ in range(line - 1):
-            if not cursor.gotoNextParagraph(False):
-                break
-                
-        cursor.gotoStartOfParagraph(False)
-        cursor.gotoEndOfParagraph(True)
-        return cursor
+        """返回位于第 page 页页首的 TextCursor，不移动视图光标。"""
+        start_range, _ = self.index.page_range(page)
+        return self.doc.Text.createTextCursorByRange(start_range)
+
+    def goto_line(self, line, page=None):
+        """返回第 page 页第 line 段的 TextCursor；未指定 page 时使用视图光标所在页。"""
+        if page is None:
+            page = self.get_cursor().getPage()
+        paragraph = self.index.line(page, line)
+        return self.doc.Text.createTextCursorByRange(paragraph)
         
         
-    def find_paragraphs_by_styles(doc, target_styles=None):
+    def get_lines_cursor(self, page, first, last):
+        """返回覆盖第 page 页第 first..last 段的 TextCursor。"""
+        cursor = self.doc.Text.createTextCursorByRange(self.index.line(page, first).getStart())
+        cursor.gotoRange(self.index.line(page, last).getEnd(), True)
+        return cursor
+
+    def find_paragraphs_by_styles(self, target_styles=None):
         """
         输入:
-            doc: LibreOffice 文档对象 (XComponent)
             target_styles: 想要匹配的样式名称列表 (list)
         输出:
-            matches: 包含匹配段落对象的列表
+            matches: 包含匹配段落对象的列表 (按文档顺序)
         """
         if target_styles is None:
             target_styles = ["Title", "Subtitle", "Text body"] 
             target_styles.extend([f"Heading {i}" for i in range(1, 11)])
 
+        ordinals = sorted(set().union(*(self.index.paragraphs_with_style(name) for name in target_styles)))
+        paragraphs = self.index.paragraphs
+
         matches = []
-        
-        # 遍历文档中的所有内容
-        paragraphs = doc.Text.createEnumeration()
-        
-        while paragraphs.hasMoreElements():
-            para = paragraphs.nextElement()
-
-            # 确保当前元素是一个段落（过滤掉表格等其他对象）
-            if para.supportsService("com.sun.star.text.Paragraph"):
-                # 检查段落样式是否在目标列表中
-                if para.ParaStyleName in target_styles:
-                    matches.append({
-                        "style": para.ParaStyleName,
-                        "text": para.String,
-                        "object": para  
-                    })
-                    
+        for ordinal in ordinals:
+            para = paragraphs[ordinal]
+            matches.append({
+                "style": para.ParaStyleName,
+                "text": para.String,
+                "object": para  
+            })
 
         return matches
 
+    def get_style_cursors(self, style_name=None):
+        """返回样式为 style_name 的所有段落的 TextCursor；style_name 为 None 时返回所有标题段落。"""
+        if style_name is None:
+            ordinals = self.index.heading_paragraphs()
+        else:
+            ordinals = self.index.paragraphs_with_style(style_name)
+        paragraphs = self.index.paragraphs
+        return [self.doc.Text.createTextCursorByRange(paragraphs[ordinal]) for ordinal in ordinals]
+
 
 
     # ------------------------------------------------
@@ -219,19 +639,18 @@ class Format:
     # ------------------------------------------------
 
     def set_bold(self,cursor, value=True):
+        from com.sun.star.awt.FontWeight import BOLD
         cursor = cursor
         cursor.CharWeight = BOLD
 
     def set_italic(self,cursor, value=True):
+        from com.sun.star.awt.FontSlant import ITALIC
         cursor = cursor
         cursor.CharPosture = ITALIC
 
     def set_underline(self, cursor, value):
         try:
-            print(f"value:{value}")
-
             val_str = str(value).strip()
-            print(f"val_str{val_str}")
             style_part = "1"
             color_part = None
 
@@ -255,10 +674,8 @@ class Format:
             else:
                 cursor.CharUnderlineHasColor = False
 
-            print(f"Fixed Debug - Raw: {val_str}, Style: {cursor.CharUnderline}, HasColor: {cursor.CharUnderlineHasColor}")
-
         except Exception as e:
-            print(f"Critical Underline Error: {e}")
+            log_to_console(f"Critical Underline Error: {e}", level=logging.WARNING)
             cursor.CharUnderline = 0
 
 
@@ -303,7 +720,7 @@ class Format:
                 cursor.CharFontNameComplex = target_font   
                 
             except Exception as e:
-                log_to_console(f"Error setting font name: {e}")
+                log_to_console(f"Error setting font name: {e}", level=logging.WARNING)
 
 
 
@@ -321,7 +738,7 @@ class Format:
             
             cursor.CharColor = int(rgb) 
         except Exception as e:
-            log_to_console(f"Error setting color: {e}")
+            log_to_console(f"Error setting color: {e}", level=logging.WARNING)
 
 
     def highlight(self, cursor, color=None):
@@ -344,6 +761,7 @@ class Format:
     # ------------------------------------------------
 
     def align_center(self, cursor):
+        from com.sun.star.style.ParagraphAdjust import CENTER
 
         cursor.gotoStartOfParagraph(False)
         cursor.gotoEndOfParagraph(True)
@@ -351,16 +769,19 @@ class Format:
         cursor.ParaAdjust = CENTER
 
     def align_left(self, cursor):
+        from com.sun.star.style.ParagraphAdjust import LEFT
         cursor.gotoStartOfParagraph(False)
         cursor.gotoEndOfParagraph(True)
         cursor.ParaAdjust = LEFT
 
     def align_right(self, cursor):
+        from com.sun.star.style.ParagraphAdjust import RIGHT
         cursor.gotoStartOfParagraph(False)
         cursor.gotoEndOfParagraph(True)
         cursor.ParaAdjust = RIGHT
 
     def align_justify(self, cursor):
+        from com.sun.star.style.ParagraphAdjust import BLOCK
         cursor.gotoStartOfParagraph(False)
         cursor.gotoEndOfParagraph(True)
         cursor.ParaAdjust = BLOCK
@@ -380,7 +801,7 @@ class Format:
                     selected_range = selection.getByIndex(0)
                     return self.doc.Text.createTextCursorByRange(selected_range)
             except Exception as e:
-                log_to_console(f"Error getting selection cursor: {e}")
+                log_to_console(f"Error getting selection cursor: {e}", level=logging.WARNING)
             
             # 修复点：确保这里也使用 self.doc 或调用已有的获取全篇游标的方法
             return self.get_document_cursor()
@@ -409,7 +830,7 @@ class Format:
             cursor.collapseToEnd()
             
         except Exception as e:
-            log_to_console(f"Error in insert_text_at_cursor: {e}")
+            log_to_console(f"Error in insert_text_at_cursor: {e}", level=logging.WARNING)
 
 
     def replace_selection(self, cursor, text):
@@ -418,7 +839,7 @@ class Format:
                 # 这里的逻辑不需要 doc，直接操作 cursor 即可
                 cursor.setString(text)
         except Exception as e:
-            log_to_console(f"Error in replace_selection: {e}")
+            log_to_console(f"Error in replace_selection: {e}", level=logging.WARNING)
 
     # 确保这个函数和 replace_selection 对齐
     def get_selected_text(self, cursor):
@@ -427,6 +848,9 @@ class Format:
         return ""
 
     def clear_format(self, cursor):
+        from com.sun.star.awt.FontWeight import NORMAL
+        from com.sun.star.awt.FontSlant import NONE
+        from com.sun.star.awt.FontUnderline import NONE as UNDERLINE_NONE
 
         cursor.CharWeight = NORMAL
         cursor.CharPosture = NONE
@@ -442,80 +866,1058 @@ class Format:
         
     
   
-def execute_format_request(format_request, fmt):
+# UNO 桥调用统计：property_writes 为提交的属性个数，bridge_calls 为实际发出的写调用次数，
+# saved_calls 为合并批量写入后省下的调用次数
+bridge_stats = {"property_writes": 0, "bridge_calls": 0, "saved_calls": 0, "skipped_writes": 0}
+
+
+def same_value(current, wanted):
+    """读回的属性值是否已等于要写入的值 (CharHeight 等浮点属性按近似相等比较)。"""
+    if isinstance(current, float) or isinstance(wanted, float):
+        try:
+            return abs(float(current) - float(wanted)) < 1e-6
+        except (TypeError, ValueError):
+            return False
+    return current == wanted
+
+
+class PropertyBatch:
+    """
+    代替 cursor 传给 Format.set_* 方法，记录属性写入，flush 时通过 XMultiPropertySet
+    一次 setPropertyValues 提交。
+
+    读取已记录的属性返回待写入的值；调用 cursor 的方法 (如 gotoStartOfParagraph) 前会先
+    flush，保证移动光标之前的写入仍作用在原来的范围上。
+    target 为 None 时只记录不写入。
+
+    skip_unchanged 为 True 时 flush 先用一次 getPropertyStates 和一次 getPropertyValues 读回
+    当前值，只写入与目标值不同的属性；范围内格式不一致 (AMBIGUOUS_VALUE) 的属性
+    按段落 (Para*) 或文本片段 (Char*) 逐个比较和写入。跳过的写入计入 bridge_stats["skipped_writes"]，
+    execute_format_request 把本次运行跳过的个数记入 RunTrace 的 skipped_writes。
+    """
+
+    def __init__(self, target, skip_unchanged=False):
+        object.__setattr__(self, "target", target)
+        object.__setattr__(self, "skip_unchanged", skip_unchanged)
+        object.__setattr__(self, "operation", None)
+        object.__setattr__(self, "_pending", {})
+        object.__setattr__(self, "_owners", {})
+
+    def __setattr__(self, name, value):
+        # UNO 属性名首字母大写，其余为批处理自身的字段
+        if name[:1].isupper():
+            self._pending[name] = value
+            self._owners[name] = self.operation
+        else:
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        pending = self.__dict__["_pending"]
+        if name in pending:
+            return pending[name]
+        if self.target is None:
+            # 只记录不写入 (collect_properties)：忽略光标移动
+            return lambda *args: None
+        attr = getattr(self.target, name)
+        if name[:1].isupper() or not callable(attr):
+            return attr
+
+        def call(*args):
+            self.flush()
+            return attr(*args)
+        return call
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self.skip_unchanged:
+            self._drop_unchanged()
+            if not self._pending:
+                return
+        names = tuple(sorted(self._pending))
+        values = tuple(self._pending[name] for name in names)
+        try:
+            # XMultiPropertySet 要求属性名按字母顺序排列
+            self.target.setPropertyValues(names, values)
+            bridge_stats["bridge_calls"] += 1
+            bridge_stats["saved_calls"] += len(names) - 1
+        except Exception as e:
+            # 批量写入失败时逐个写入，以便定位是哪一项出错
+            log_to_console(f"Batched write failed ({e}), retrying per property", level=logging.WARNING)
+            for name, value in zip(names, values):
+                bridge_stats["bridge_calls"] += 1
+                try:
+                    setattr(self.target, name, value)
+                except Exception as e:
+                    log_to_console(f"Error executing {self._owners[name]} ({name}) on cursor: {e}", level=logging.WARNING)
+        bridge_stats["property_writes"] += len(names)
+        self._pending.clear()
+        self._owners.clear()
+
+    def _drop_unchanged(self):
+        """从待写入的属性中去掉范围内已经是目标值的属性；格式不一致的属性逐段/逐片段写入。"""
+        from com.sun.star.beans.PropertyState import AMBIGUOUS_VALUE
+
+        names = tuple(sorted(self._pending))
+        try:
+            states = self.target.getPropertyStates(names)
+            current = self.target.getPropertyValues(names)
+            bridge_stats["bridge_calls"] += 2
+        except Exception as e:
+            # 有属性无法读取时照常全部写入
+            log_to_console("Could not read current values, writing all:", e, level=logging.DEBUG)
+            return
+        ambiguous = []
+        for name, state, value in zip(names, states, current):
+            if state == AMBIGUOUS_VALUE:
+                ambiguous.append(name)
+            elif same_value(value, self._pending[name]):
+                bridge_stats["skipped_writes"] += 1
+                del self._pending[name]
+        if ambiguous:
+            self._write_portions(ambiguous)
+
+    def _write_portions(self, names):
+        """
+        对范围内格式不一致的属性，按段落 (Para*) 或文本片段 (其余) 只写入不同的部分。
+        字段、脚注标记等非 Text 片段同样逐个写入；书签等零宽片段跳过。
+        有片段无法读写时，这些字符属性仍对整个范围写入。
+        """
+        wanted = {name: self._pending.pop(name) for name in names}
+        para_names = tuple(name for name in names if name.startswith("Para"))
+        char_names = tuple(name for name in names if not name.startswith("Para"))
+        try:
+            # 光标范围的枚举只包含选中的部分：首尾段落的片段被截取到范围内
+            paragraphs = self.target.createEnumeration()
+            while paragraphs.hasMoreElements():
+                paragraph = paragraphs.nextElement()
+                if not paragraph.supportsService("com.sun.star.text.Paragraph"):
+                    continue
+                if para_names:
+                    self._write_changed(paragraph, para_names, wanted)
+                if char_names:
+                    portions = paragraph.createEnumeration()
+                    while portions.hasMoreElements():
+                        portion = portions.nextElement()
+                        if _is_collapsed(portion):
+                            continue
+                        try:
+                            self._write_changed(portion, char_names, wanted)
+                        except Exception as e:
+                            log_to_console("Could not write portion, writing whole range:",
+                                           portion.TextPortionType, e, level=logging.DEBUG)
+                            self._pending.update((name, wanted[name]) for name in char_names)
+                            char_names = ()
+                            break
+        except Exception as e:
+            log_to_console(f"Per-portion write failed ({e}), writing whole range", level=logging.WARNING)
+            self._pending.update(wanted)
+
+    def _write_changed(self, target, names, wanted):
+        current = target.getPropertyValues(names)
+        bridge_stats["bridge_calls"] += 1
+        changed = tuple(name for name, value in zip(names, current) if not same_value(value, wanted[name]))
+        bridge_stats["skipped_writes"] += len(names) - len(changed)
+        if changed:
+            target.setPropertyValues(changed, tuple(wanted[name] for name in changed))
+            bridge_stats["bridge_calls"] += 1
+            bridge_stats["property_writes"] += len(changed)
+
+
+def _is_collapsed(portion):
+    """书签、引用标记等只占一个位置的片段没有文字，不需要写入字符属性。"""
+    try:
+        return bool(portion.IsCollapsed)
+    except Exception:
+        return portion.TextPortionType == "SoftPageBreak"
+
+
+@contextmanager
+def undo_context(doc, title="AI Formatter"):
+    """把期间的所有修改合并成一个撤销步骤。"""
+    undo_manager = doc.getUndoManager()
+    undo_manager.enterUndoContext(title)
+    try:
+        yield undo_manager
+    finally:
+        undo_manager.leaveUndoContext()
+
+
+@contextmanager
+def suspended_layout(doc, title="AI Formatter"):
+    """
+    锁定控制器 (不重绘) 并持有 action lock (不重新排版)，同时把期间的所有修改
+    合并成一个撤销步骤。出现异常时同样按相反顺序释放。
+    """
+    doc.lockControllers()
+    try:
+        doc.addActionLock()
+        try:
+            with undo_context(doc, title) as undo_manager:
+                yield undo_manager
+        finally:
+            doc.removeActionLock()
+    finally:
+        doc.unlockControllers()
+
+
+class RunTrace:
+    """
+    一次运行的分阶段耗时 (秒)，同名阶段累加：
+    dialog (等待用户输入)、context (生成文档概要)、model (模型延迟)、parse (解析和编译计划)、
+    resolve (解析页/段范围)、apply (写入文档)，批量处理另有 load / store。
+    finish() 时把一条 JSON 记录追加到 UserConfig/writerai_trace.jsonl，
+    文件超过 MAX_BYTES 时轮换为 .1。
+    """
+
+    FILE_NAME = "writerai_trace.jsonl"
+    MAX_BYTES = 1024 * 1024
+
+    def __init__(self, path=None, **fields):
+        self.path = path
+        self.fields = fields
+        self.phases = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, **fields):
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        record.update(self.fields)
+        record.update(fields)
+        record["total"] = round(time.perf_counter() - self.started, 4)
+        record["phases"] = {name: round(seconds, 4) for name, seconds in self.phases.items()}
+        log_to_console(f"Run trace: {record}")
+        if self.path:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.MAX_BYTES:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                log_to_console(f"Error writing trace: {e}", level=logging.WARNING)
+        return record
+
+
+def trace_phase(trace, name):
+    """trace 为 None 时返回空的上下文管理器。"""
+    if trace is None:
+        from contextlib import nullcontext
+        return nullcontext()
+    return trace.phase(name)
+
+
+def execute_format_request(format_request, fmt, suspend_layout=False, trace=None):
+    """
+    执行格式化计划，返回耗时 (秒)。
+    format_request 可以是模型返回的字典，也可以是 compile_plan 编译好的 FormatPlan。
+    suspend_layout 为 True 时整个计划在 suspended_layout 中执行。
+    trace 为可选的 RunTrace，记录 parse / resolve / apply 耗时。
+    """
     if not format_request:
-        return
+        return 0.0
+
+    started = time.perf_counter()
+    skipped = bridge_stats["skipped_writes"]
+    with trace_phase(trace, "parse"):
+        plan = format_request if isinstance(format_request, FormatPlan) else compile_plan(format_request)
+    # 计划自身的修改不使段落索引失效：段落对象在编辑过程中保持稳定，
+    # 页码按计划开始时 (即用户看到的) 版面解析
+    with fmt.index.paused():
+        if suspend_layout:
+            with suspended_layout(fmt.doc):
+                _run_format_plan(plan, fmt, trace)
+        else:
+            _run_format_plan(plan, fmt, trace)
+    elapsed = time.perf_counter() - started
+    if trace is not None:
+        trace.fields["skipped_writes"] = bridge_stats["skipped_writes"] - skipped
+
+    log_to_console(f"Format plan applied in {elapsed:.3f}s (layout suspended: {suspend_layout})")
+    log_to_console("Property batches:", bridge_stats, level=logging.DEBUG)
+    return elapsed
+
+
+def _run_format_plan(plan, fmt, trace=None):
+    # 计划中涉及的页一次性解析
+    pages = plan.pages()
+    if pages:
+        try:
+            with trace_phase(trace, "resolve"):
+                fmt.index.pages.prefetch(pages)
+        except Exception as e:
+            log_to_console(f"Error resolving pages {pages}: {e}", level=logging.WARNING)
+
+    # 连续的全文范围操作一起执行 (正文和其他文本各遍历一次)；
+    # 在下一个其他范围的操作之前完成，后面的 find 等操作不会被覆盖
+    pending = []
+    for operation in plan.operations:
+        if operation.scope == "document":
+            pending.append(operation)
+            continue
+        if pending:
+            apply_document_operations(fmt, pending, trace)
+            pending = []
+        apply_operation(fmt, operation, trace)
+    if pending:
+        apply_document_operations(fmt, pending, trace)
+
+
+# 按文本匹配定位的顶层范围，值为一个搜索条目或条目列表
+SEARCH_SCOPES = ("find", "replace_all")
+
+# 搜索条目中描述匹配方式的键，其余键 (未给出 "format" 时) 视为样式
+SEARCH_OPTION_KEYS = ("text", "regex", "match_case", "whole_words", "replace_with", "format")
+
+
+def is_nested_scope(key):
+    """page_n 和 paragraph_style 的值是 {子范围: 样式字典}，其余顶层范围的值直接是样式字典。"""
+    return key == "paragraph_style" or re.fullmatch(r"page_\d+", str(key)) is not None
 
+
+def iter_format_entries(format_request):
+    """
+    把计划展开为 (page_key, line_key, style_dict)；
+    selection / all_pages 等顶层范围的 line_key 为 None，
+    paragraph_style 的 line_key 为样式名，find / replace_all 的列表逐项展开。
+    """
     for page_key, page_value in format_request.items():
-        # --- 核心修改点 ---
-        # 如果 key 是 selection，或者 page_value 包含特定指示
-        if page_key == "selection":
-            cursor = fmt.get_selection_cursor() # 你需要在 Format 类实现这个方法
-            apply_styles(fmt, cursor, page_value)
+        if is_nested_scope(page_key) and isinstance(page_value, dict):
+            for line_key, line_value in page_value.items():
+                yield page_key, line_key, line_value
+        elif page_key in SEARCH_SCOPES and isinstance(page_value, list):
+            for item in page_value:
+                yield page_key, None, item
+        else:
+            yield page_key, None, page_value
+
+
+def plan_from_entries(entries):
+    """iter_format_entries 的逆操作：把 (page_key, line_key, style_dict) 条目重新组装为计划。"""
+    format_request = {}
+    for page_key, line_key, style_dict in entries:
+        if line_key is None:
+            if page_key in SEARCH_SCOPES and page_key in format_request:
+                previous = format_request[page_key]
+                previous = previous if isinstance(previous, list) else [previous]
+                format_request[page_key] = previous + (style_dict if isinstance(style_dict, list) else [style_dict])
+            else:
+                format_request[page_key] = style_dict
+        else:
+            format_request.setdefault(page_key, {})[line_key] = style_dict
+    return format_request
+
+
+def apply_format_entry(fmt, page_key, line_key, style_dict, trace=None):
+    """解析一个计划条目的目标范围并应用样式 (流式执行时逐条调用)。"""
+    if page_key in SEARCH_SCOPES and isinstance(style_dict, list):
+        for item in style_dict:
+            apply_format_entry(fmt, page_key, line_key, item, trace)
+        return
+    operation = FormatOp.from_entry(page_key, line_key, style_dict)
+    if operation is not None:
+        apply_operation(fmt, operation, trace)
+
+
+def resolve_cursors(fmt, operation):
+    """返回操作作用的 TextCursor 列表。"""
+    if operation.scope == "selection":
+        return [fmt.get_selection_cursor()]
+    if operation.scope == "document":
+        return [fmt.get_document_cursor()]
+    if operation.scope == "page":
+        return [fmt.get_all_lines_cursor(operation.page)]
+    if operation.scope in ("headings", "style"):
+        # 按样式索引一次查出所有目标段落，逐段应用
+        return fmt.get_style_cursors(operation.style)
+    return [fmt.get_lines_cursor(operation.page, operation.first, operation.last)]
+
+
+def apply_operation(fmt, operation, trace=None):
+    """
+    解析操作的目标范围并应用样式。
+    全文范围的操作交给 apply_document_operations (fmt.traverse_all_text 时同时作用于表格、文本框和页眉页脚)。
+    """
+    if operation.scope == "document":
+        apply_document_operations(fmt, [operation], trace)
+        return
+    try:
+        props = operation.props
+        if operation.scope in ("find", "replace"):
+            # 查找和写入在同一次 replaceAll / findAll 中完成，计入 apply
+            with trace_phase(trace, "apply"):
+                apply_search_operation(fmt, operation)
+            return
+
+        with trace_phase(trace, "resolve"):
+            cursors = resolve_cursors(fmt, operation)
+        # 调用具体的样式应用函数
+        with trace_phase(trace, "apply"):
+            for cursor in cursors:
+                apply_styles(fmt, cursor, line_style_dict=props)
+
+    except Exception as e:
+        log_to_console(f"Error processing {operation}: {e}", level=logging.WARNING)
+
+
+def iter_text_containers(doc):
+    """
+    依次返回正文之外的每个文本 (XText)：所有表格 (包括嵌套表格和页眉页脚、文本框中的表格) 的每个单元格、
+    所有文本框，以及正在使用的页面样式的页眉和页脚 (左右页、首页不共享时分别返回)。
+    光标范围不包含其中嵌套的表格，因此每段文字只属于一个文本。
+    """
+    tables = doc.getTextTables()
+    for i in range(tables.getCount()):
+        table = tables.getByIndex(i)
+        for name in table.getCellNames():
+            yield table.getCellByName(name)
+
+    frames = doc.getTextFrames()
+    for i in range(frames.getCount()):
+        yield frames.getByIndex(i).getText()
+
+    page_styles = doc.getStyleFamilies().getByName("PageStyles")
+    for name in page_styles.getElementNames():
+        style = page_styles.getByName(name)
+        if not style.isInUse():
             continue
+        for part in ("Header", "Footer"):
+            if not style.getPropertyValue(f"{part}IsOn"):
+                continue
+            yield style.getPropertyValue(f"{part}Text")
+            if not style.getPropertyValue(f"{part}IsShared"):
+                yield style.getPropertyValue(f"{part}TextLeft")
+            try:
+                # FirstIsShared 在较新的 LibreOffice 中才有
+                if not style.getPropertyValue("FirstIsShared"):
+                    yield style.getPropertyValue(f"{part}TextFirst")
+            except Exception:
+                pass
+
+
+def apply_document_operations(fmt, operations, trace=None):
+    """
+    一起执行一组全文范围的操作：正文一个光标，fmt.traverse_all_text 时每个表格单元格、文本框、
+    页眉页脚各一个光标，每个光标上按顺序应用全部操作，属性写入合并在同一个 PropertyBatch 中提交，
+    每个文本只遍历一次。
+    样式模式下先修改段落样式，剩余的属性直接写入正文；其他文本的段落样式不一定与正文相同，
+    始终直接写入。插入/替换文本只作用于正文。
+    """
+    body_dicts = []
+    for operation in operations:
+        props = operation.props
+        if fmt.style_mode:
+            try:
+                with trace_phase(trace, "apply"):
+                    props = apply_to_paragraph_styles(fmt, props)
+            except Exception as e:
+                log_to_console(f"Error processing {operation}: {e}", level=logging.WARNING)
+                continue
+        if props:
+            body_dicts.append(props)
+    if body_dicts:
+        try:
+            with trace_phase(trace, "resolve"):
+                cursor = fmt.get_document_cursor()
+            with trace_phase(trace, "apply"):
+                _apply_all(fmt, cursor, body_dicts)
+        except Exception as e:
+            log_to_console(f"Error applying {len(body_dicts)} document operations: {e}", level=logging.WARNING)
+
+    if not fmt.traverse_all_text:
+        return
+    style_dicts = [{key: value for key, value in operation.props.items() if key not in TEXT_EDIT_KEYS}
+                   for operation in operations]
+    style_dicts = [style_dict for style_dict in style_dicts if style_dict]
+    if not style_dicts:
+        return
+    count = 0
+    try:
+        with trace_phase(trace, "apply"):
+            for text in iter_text_containers(fmt.doc):
+                count += 1
+                cursor = text.createTextCursor()
+                cursor.gotoStart(False)
+                cursor.gotoEnd(True)
+                _apply_all(fmt, cursor, style_dicts)
+    except Exception as e:
+        log_to_console(f"Error formatting tables, frames, headers and footers: {e}", level=logging.WARNING)
+    log_to_console(f"Applied {len(style_dicts)} document operations to {count} table cells, frames, headers and footers")
+
+
+def _apply_all(fmt, cursor, style_dicts):
+    """在同一个光标上依次应用多个样式字典，属性写入共用一个 PropertyBatch。"""
+    batch = PropertyBatch(cursor, skip_unchanged=fmt.skip_unchanged)
+    start, end = cursor.getStart(), cursor.getEnd()
+    for style_dict in style_dicts:
+        apply_styles(fmt, cursor, line_style_dict=style_dict, batch=batch)
+        if any(key.startswith("align_") or key in TEXT_EDIT_KEYS for key in style_dict):
+            # 对齐和文本编辑会移动光标，恢复原来的范围供后面的操作使用 (经由 batch，先提交已记录的写入)
+            batch.gotoRange(start, False)
+            batch.gotoRange(end, True)
+    batch.flush()
+
+
+# ------------------------------------------------
+# Plan compiler
+# ------------------------------------------------
+
+# 不带参数的操作：值为 false 时什么也不做
+NO_PARAM_ACTIONS = (
+    "bold", "italic", "clear_format", "remove_highlight",
+    "align_center", "align_left", "align_right", "align_justify",
+)
+
+# 修改文本内容的操作：不参与覆盖消除和合并
+TEXT_EDIT_KEYS = ("insert_text", "insert_before", "replace_text")
+
+# 每个格式操作写入的 UNO 属性
+WRITTEN_PROPERTIES = {
+    "bold": {"CharWeight"},
+    "italic": {"CharPosture"},
+    "font_size": {"CharHeight", "CharHeightAsian"},
+    "font_color": {"CharColor"},
+    "font_name": {"CharFontName", "CharFontNameAsian", "CharFontNameComplex"},
+    "font_family": {"CharFontName", "CharFontNameAsian", "CharFontNameComplex"},
+    "highlight": {"CharBackColor"},
+    "remove_highlight": {"CharBackColor"},
+    "align_center": {"ParaAdjust"},
+    "align_left": {"ParaAdjust"},
+    "align_right": {"ParaAdjust"},
+    "align_justify": {"ParaAdjust"},
+    "clear_format": {"CharWeight", "CharPosture", "CharUnderline", "CharStrikeout",
+                     "CharColor", "CharBackColor", "CharHeight"},
+}
+
+
+def written_properties(operation, value):
+    """返回一个格式操作写入的属性集合；未知或修改文本的操作返回 None。"""
+    if operation == "underline":
+        names = {"CharUnderline", "CharUnderlineHasColor"}
+        if len(str(value).strip()) >= 7:
+            names.add("CharUnderlineColor")
+        return names
+    return WRITTEN_PROPERTIES.get(operation)
+
+
+class FormatOp:
+    """
+    编译后的单个操作：作用范围 + 样式字典。
+    scope 为 "selection" / "document" / "page" (page_n.line_all) / "lines" (page 的第 first..last 段)
+    / "headings" (所有标题段落) / "style" (样式为 style 的所有段落)
+    / "find" (search 的所有匹配) / "replace" (对 search 的所有匹配做替换，props 为空)。
+    """
+
+    __slots__ = ("scope", "page", "first", "last", "style", "props", "search")
+
+    def __init__(self, scope, props, page=None, first=None, last=None, style=None, search=None):
+        self.scope = scope
+        self.props = props
+        self.page = page
+        self.first = first
+        self.last = last
+        self.style = style
+        self.search = search
+
+    @classmethod
+    def from_entry(cls, page_key, line_key, style_dict):
+        if page_key in SEARCH_SCOPES and isinstance(style_dict, dict):
+            return cls.from_search(page_key, style_dict)
+
+        if not isinstance(style_dict, dict):
+            log_to_console(f"Skipping {page_key}.{line_key}: not a style dict", level=logging.WARNING)
+            return None
+
+        if page_key == "selection":
+            return cls("selection", style_dict)
 
         if page_key in ["all_pages", "document", "entire_doc"]:
             # 如果 AI 脑抽在 all_pages 里提到了 selection，优先处理选区
-            if "selection" in str(page_value).lower():
-                cursor = fmt.get_selection_cursor()
-            else:
-                cursor = fmt.get_document_cursor()
-            
-            apply_styles(fmt, cursor, page_value)
-            continue
-            
+            if "selection" in str(style_dict).lower():
+                return cls("selection", style_dict)
+            return cls("document", style_dict)
+
+        if page_key == "headings":
+            return cls("headings", style_dict)
+
+        if page_key == "paragraph_style":
+            return cls("style", style_dict, style=line_key)
+
         # 2. 按页处理逻辑 (page_n)
         try:
-            if "_" not in page_key:
+            page_num = int(str(page_key).split("_")[1])
+            if line_key in ["line_all", "all"]:
+                return cls("page", style_dict, page=page_num)
+            line_num = int(str(line_key).split("_")[1])
+            return cls("lines", style_dict, page=page_num, first=line_num, last=line_num)
+        except (ValueError, IndexError):
+            log_to_console(f"Skipping unknown scope {page_key}.{line_key}", level=logging.WARNING)
+            return None
+
+    @classmethod
+    def from_search(cls, page_key, entry):
+        text = entry.get("text")
+        if not text:
+            log_to_console(f"Skipping {page_key}: no search text", level=logging.WARNING)
+            return None
+        search = {
+            "text": str(text),
+            "regex": bool(entry.get("regex", False)),
+            "match_case": bool(entry.get("match_case", False)),
+            "whole_words": bool(entry.get("whole_words", False)),
+        }
+
+        if page_key == "replace_all":
+            if "replace_with" not in entry:
+                log_to_console(f"Skipping replace_all {text!r}: no replace_with", level=logging.WARNING)
+                return None
+            search["replace_with"] = str(entry["replace_with"])
+            return cls("replace", {}, search=search)
+
+        # 样式放在 "format" 下；模型直接把样式写在条目里时也接受
+        style_dict = entry.get("format")
+        if style_dict is None:
+            style_dict = {key: value for key, value in entry.items() if key not in SEARCH_OPTION_KEYS}
+        if not isinstance(style_dict, dict):
+            log_to_console(f"Skipping find {text!r}: not a style dict", level=logging.WARNING)
+            return None
+        return cls("find", style_dict, search=search)
+
+    def position(self):
+        """排序用的位置：选区、全文和按样式的范围在前，其余按页、段排列。"""
+        if self.page is None:
+            return (0, 0)
+        return (self.page, 0 if self.scope == "page" else self.first)
+
+    def contains(self, other):
+        """self 的范围是否一定覆盖 other 的范围。"""
+        if self.scope == "document":
+            # 搜索会匹配到表格、文本框中的文字，不一定在正文光标的范围内
+            return other.scope not in ("selection", "find", "replace")
+        if self.scope == "page" and other.scope == "lines":
+            # 页首段落可能从上一页开始，不完全在本页的范围内
+            return self.page == other.page and other.first > 1
+        if self.scope != other.scope or self.scope in ("find", "replace"):
+            return False
+        if self.scope == "selection" or self.scope == "headings":
+            return True
+        if self.scope == "style":
+            return str(self.style).lower() == str(other.style).lower()
+        if self.page != other.page:
+            return False
+        return self.scope == "page" or (self.first <= other.first and other.last <= self.last)
+
+    def may_overlap(self, other):
+        """两个操作的范围是否可能重叠 (保守判断，重叠的操作不交换顺序)。"""
+        if self.page is None or other.page is None:
+            return True
+        low, high = sorted((self, other), key=lambda op: op.page)
+        if high.page - low.page > 1:
+            return False
+        if low.page == high.page:
+            return "page" in (low.scope, high.scope) or (low.first <= high.last and high.first <= low.last)
+        # 相邻页：下一页的第 1 段可能是上一页末段的延续
+        return "page" in (low.scope, high.scope) or high.first == 1
+
+    def __repr__(self):
+        if self.scope == "page":
+            return f"page_{self.page}.line_all"
+        if self.scope == "lines":
+            lines = f"line_{self.first}" if self.first == self.last else f"line_{self.first}-{self.last}"
+            return f"page_{self.page}.{lines}"
+        if self.scope == "style":
+            return f"paragraph_style.{self.style}"
+        if self.scope == "find":
+            return f"find[{self.search['text']!r}]"
+        if self.scope == "replace":
+            return f"replace_all[{self.search['text']!r}]"
+        return self.scope
+
+
+class FormatPlan:
+    """compile_plan 的结果：按执行顺序排列的 FormatOp 列表和优化统计。"""
+
+    def __init__(self, operations, stats=None):
+        self.operations = operations
+        self.stats = stats or {}
+
+    def pages(self):
+        return sorted({op.page for op in self.operations if op.page is not None})
+
+    def __bool__(self):
+        return bool(self.operations)
+
+
+def rebase_plan(format_request, first_page, page_count):
+    """
+    只保留分块请求返回的计划中属于该块的页：块概要使用文档页码，page_n 不做换算，
+    块外的页 (如模型按"第 2 段"给出的 page_1) 被丢弃，同一位置不会被每个块各执行一次；
+    其他范围原样保留。
+    """
+    last_page = first_page + page_count - 1
+    rebased = {}
+    for key, value in format_request.items():
+        match = re.fullmatch(r"page_(\d+)", str(key))
+        if match is None:
+            rebased[key] = value
+            continue
+        if not first_page <= int(match.group(1)) <= last_page:
+            log_to_console(f"Dropping {key}: outside chunk pages {first_page}-{last_page}", level=logging.DEBUG)
+            continue
+        rebased[key] = value
+    return rebased
+
+
+def merge_plans(format_requests):
+    """
+    合并各块的计划 (按块的顺序)：各块的 page_n 互不重叠；其他范围的字典合并，
+    find / replace_all 条目去重 (每块都可能给出同一个全文替换，重复执行会出错)。
+    """
+    merged = {}
+    for format_request in format_requests:
+        for key, value in format_request.items():
+            if key in SEARCH_SCOPES:
+                entries = merged.setdefault(key, [])
+                for item in value if isinstance(value, list) else [value]:
+                    if item not in entries:
+                        entries.append(item)
+            elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**merged[key], **value}
+            else:
+                merged[key] = value
+    return merged
+
+
+def validate_plan(format_request):
+    """检查计划的每个条目能否解析为操作、是否只使用已知的属性；返回问题列表，空列表表示有效。"""
+    if not isinstance(format_request, dict) or not format_request:
+        return ["plan must be a non-empty JSON object"]
+    problems = []
+    for page_key, line_key, style_dict in iter_format_entries(format_request):
+        operation = FormatOp.from_entry(page_key, line_key, style_dict)
+        if operation is None:
+            problems.append(f"invalid entry {page_key}.{line_key}")
+            continue
+        unknown = [key for key in operation.props if key not in FORMAT_FUNCTION_MAP and key != "insert_before"]
+        if unknown:
+            problems.append(f"{operation}: unknown properties {unknown}")
+    return problems
+
+
+def compile_plan(format_request):
+    """
+    把模型返回的计划编译为 FormatPlan：
+    1. 展开为 FormatOp，去掉值为 false 的无参操作；
+    2. 删除被后续覆盖同一范围、写入相同属性的操作 (包括同一字典内的前后覆盖)，
+       以及被之前覆盖它的操作写过相同值的属性；
+    3. 在不改变重叠范围先后顺序的前提下按页、段排序，减少光标跳转；
+    4. 合并同一页相邻段落上样式完全相同的操作。
+    """
+    operations = []
+    for page_key, line_key, style_dict in iter_format_entries(format_request):
+        operation = FormatOp.from_entry(page_key, line_key, style_dict)
+        if operation is not None:
+            operations.append(operation)
+    input_ops = len(operations)
+    input_writes = sum(len(op.props) for op in operations)
+
+    for operation in operations:
+        operation.props = {key: value for key, value in operation.props.items()
+                           if not (key in NO_PARAM_ACTIONS and value is False)}
+
+    _drop_overridden(operations)
+    _drop_redundant(operations)
+    operations = [op for op in operations if op.props or op.scope == "replace"]
+    operations = _order_operations(operations)
+    operations, merged = _merge_adjacent(operations)
+
+    # 合并后的操作按原来的段数计算写入次数，removed_writes 只统计真正被删除的写入
+    output_writes = sum(len(op.props) * (op.last - op.first + 1 if op.scope == "lines" else 1)
+                        for op in operations)
+    stats = {
+        "input_operations": input_ops,
+        "operations": len(operations),
+        "removed_operations": input_ops - len(operations) - merged,
+        "merged_operations": merged,
+        "removed_writes": input_writes - output_writes,
+    }
+    log_to_console(f"Compiled plan: {stats}")
+    return FormatPlan(operations, stats)
+
+
+def _drop_overridden(operations):
+    """从后往前记录已被写入的属性，删除之后会被完整覆盖的写入。"""
+    for index, operation in enumerate(operations):
+        for key, value in list(operation.props.items()):
+            written = written_properties(key, value)
+            if not written:
                 continue
-                
-            page_num = int(page_key.split("_")[1])
-            fmt.goto_page(page_num)
+            covered = set()
+            # 同一字典中排在后面的键
+            keys = list(operation.props)
+            for later_key in keys[keys.index(key) + 1:]:
+                covered |= written_properties(later_key, operation.props[later_key]) or set()
+            # 之后覆盖该范围的操作
+            for later in operations[index + 1:]:
+                if later.contains(operation):
+                    for later_key, later_value in later.props.items():
+                        covered |= written_properties(later_key, later_value) or set()
+            if written <= covered:
+                del operation.props[key]
+
+
+def _drop_redundant(operations):
+    """
+    删除之前已由覆盖该范围的操作写入相同值的属性 (如 line_all 加粗后再加粗 line_3)。
+    两次写入之间有其他可能重叠的操作写入同样的属性、或任一方修改文本时不删除；
+    对齐会把光标收缩到单个段落，不算覆盖。
+    """
+    for index, operation in enumerate(operations):
+        if any(key in TEXT_EDIT_KEYS for key in operation.props):
+            continue
+        for key, value in list(operation.props.items()):
+            written = written_properties(key, value)
+            if not written or key.startswith("align_"):
+                continue
+            keys = list(operation.props)
+            # 本操作中排在前面的键 (如 clear_format) 可能先重置了该属性
+            if any(_writes_any(earlier_key, operation.props[earlier_key], written)
+                   for earlier_key in keys[:keys.index(key)]):
+                continue
+            for earlier_index in range(index - 1, -1, -1):
+                earlier = operations[earlier_index]
+                if (earlier.contains(operation) and earlier.props.get(key) == value
+                        and not any(k in TEXT_EDIT_KEYS for k in earlier.props)):
+                    earlier_keys = list(earlier.props)
+                    if not any(_writes_any(later_key, earlier.props[later_key], written)
+                               for later_key in earlier_keys[earlier_keys.index(key) + 1:]):
+                        del operation.props[key]
+                    break
+                if any(_writes_any(k, v, written) for k, v in earlier.props.items()) \
+                        and earlier.may_overlap(operation):
+                    break
+
+
+def _writes_any(key, value, names):
+    """key 是否可能写入 names 中的属性 (未知或修改文本的操作视为可能)。"""
+    written = written_properties(key, value)
+    return written is None or bool(written & names)
+
+
+def _order_operations(operations):
+    """稳定的插入排序：只有在范围不可能重叠时才把操作移到前面。"""
+    ordered = []
+    for operation in operations:
+        position = len(ordered)
+        while position > 0:
+            previous = ordered[position - 1]
+            if previous.position() <= operation.position() or previous.may_overlap(operation):
+                break
+            position -= 1
+        ordered.insert(position, operation)
+    return ordered
+
+
+def _mergeable(operation):
+    # 对齐方法会把光标收缩到单个段落，插入/替换文本对每个范围只执行一次，都不能跨段合并
+    return operation.scope == "lines" and not any(
+        key in TEXT_EDIT_KEYS or key.startswith("align_") for key in operation.props)
+
+
+def _merge_adjacent(operations):
+    merged_ops, merged = [], 0
+    for operation in operations:
+        previous = merged_ops[-1] if merged_ops else None
+        if (previous is not None and _mergeable(previous) and _mergeable(operation)
+                and previous.page == operation.page and previous.last + 1 == operation.first
+                and previous.props == operation.props):
+            previous.last = operation.last
+            merged += 1
+            continue
+        merged_ops.append(operation)
+    return merged_ops, merged
+
+
+# 建立指令与类方法的映射映射
+FORMAT_FUNCTION_MAP = {
+    "bold": "set_bold",
+    "italic": "set_italic",
+    "underline": "set_underline",
+    "font_size": "set_font_size",
+    "font_color": "set_font_color",
+    "font_name": "set_font_name",  
+    "font_family": "set_font_name", 
+    "highlight": "highlight",
+    "remove_highlight": "remove_highlight",
+    "align_center": "align_center",
+    "align_left": "align_left",
+    "align_right": "align_right",
+    "align_justify": "align_justify",
+    "replace_text": "replace_selection",
+    "insert_text": "insert_text_at_cursor", # 插入文本
+    "clear_format": "clear_format"
+}
+
+
+# 样式模式下可以写到段落样式上的操作
+STYLE_MODE_KEYS = (
+    "bold", "italic", "underline", "font_size", "font_color", "font_name", "font_family",
+    "highlight", "remove_highlight", "align_center", "align_left", "align_right", "align_justify",
+)
 
-            for line_key, line_value in page_value.items():
-                # 确定每一行的 Cursor 范围
-                if line_key in ["line_all", "all"]:
-                    cursor = fmt.get_all_lines_cursor(page_num)
-                else:
-                    try:
-                        line_num = int(line_key.split("_")[1])
-                        cursor = fmt.goto_line(line_num)
-                    except (ValueError, IndexError):
-                        continue
-                
-                # 调用具体的样式应用函数
-                apply_styles(fmt, cursor, line_style_dict=line_value)
 
-        except Exception as e:
-            log_to_console(f"Error processing page {page_key}: {e}")
-            
-            
-def apply_styles(fmt_instance, target_cursor, line_style_dict):
+def collect_properties(fmt, style_dict):
+    """不写入文档，返回 style_dict 中各格式操作会写入的 {属性名: 值}。"""
+    recorder = PropertyBatch(None)
+    for operation, value in style_dict.items():
+        func = getattr(fmt, FORMAT_FUNCTION_MAP[operation])
+        recorder.operation = operation
+        if operation in NO_PARAM_ACTIONS:
+            if value is not False:
+                func(recorder)
+        else:
+            func(recorder, value)
+    return dict(recorder._pending)
+
+
+def apply_to_paragraph_styles(fmt, style_dict):
+    """
+    样式模式：把全文范围的字符/段落属性写到正文正在使用的各个段落样式上
+    (每个样式一次 setPropertyValues，只写入请求的属性)。正文中这些属性已有的直接格式
+    用 skip_unchanged 的 PropertyBatch 改写为目标值 (与样式值相同的部分不写入)，
+    其他直接格式保持不变。
+
+    不开启 traverse_all_text 时，若有样式同时用在表格、文本框或页眉页脚中，修改样式会
+    超出请求的范围，整个字典回退到直接格式化。
+
+    返回仍需直接格式化的部分：插入/替换文本原样返回；含有 clear_format 等无法用样式
+    表达、又会与样式属性冲突的操作时，或修改样式失败时，整个字典回退到直接格式化。
+    """
+    style_keys = {key: value for key, value in style_dict.items() if key in STYLE_MODE_KEYS}
+    remaining = {key: value for key, value in style_dict.items() if key not in STYLE_MODE_KEYS}
+    if not style_keys or any(written_properties(key, value) for key, value in remaining.items()):
+        return style_dict
+
+    try:
+        properties = collect_properties(fmt, style_keys)
+        if not properties:
+            return remaining
+        style_names = fmt.index.style_names()
+        if not fmt.traverse_all_text:
+            shared = styles_used_outside_body(fmt.doc, style_names)
+            if shared:
+                log_to_console(f"Paragraph styles {shared} are also used outside the body text, "
+                               f"using direct formatting")
+                return style_dict
+        names = tuple(sorted(properties))
+        values = tuple(properties[name] for name in names)
+        paragraph_styles = fmt.doc.getStyleFamilies().getByName("ParagraphStyles")
+        for style_name in style_names:
+            paragraph_styles.getByName(style_name).setPropertyValues(names, values)
+            bridge_stats["bridge_calls"] += 1
+        batch = PropertyBatch(fmt.get_document_cursor(), skip_unchanged=True)
+        for name, value in properties.items():
+            setattr(batch, name, value)
+        batch.flush()
+    except Exception as e:
+        log_to_console(f"Style mode failed ({e}), falling back to direct formatting", level=logging.WARNING)
+        return style_dict
+
+    log_to_console(f"Applied {sorted(style_keys)} through paragraph styles {style_names}")
+    return remaining
+
+
+def styles_used_outside_body(doc, style_names):
+    """返回 style_names 中同时用在表格、文本框或页眉页脚段落上的样式名。"""
+    wanted = set(style_names)
+    shared = set()
+    for text in iter_text_containers(doc):
+        paragraphs = text.createEnumeration()
+        while paragraphs.hasMoreElements():
+            paragraph = paragraphs.nextElement()
+            if paragraph.supportsService("com.sun.star.text.Paragraph") and paragraph.ParaStyleName in wanted:
+                shared.add(paragraph.ParaStyleName)
+    return sorted(shared)
+
+
+# 可以作为替换属性随 replaceAll 一次写入的字符格式操作；对齐 (段落属性) 和文本编辑逐个匹配执行
+SEARCH_ATTRIBUTE_KEYS = (
+    "bold", "italic", "underline", "font_size", "font_color", "font_name", "font_family",
+    "highlight", "remove_highlight", "clear_format",
+)
+
+
+def escape_search_text(text):
+    """转义 ICU 正则的元字符，使字面文本可以用在正则搜索中。"""
+    return re.sub(r"([\\^$.|?*+()\[\]{}])", r"\\\1", text)
+
+
+def apply_search_operation(fmt, operation):
+    """
+    find / replace 范围通过文档的 XReplaceable 执行，不在 Python 侧遍历文本：
+    - replace：一次 replaceAll；正则模式下替换串可用 $1、$2 引用捕获组。
+    - find 只含字符格式时：用正则把每个匹配替换为自身 ("&")，并把样式作为替换属性，
+      所有匹配在一次 replaceAll 中完成格式化。
+    - 其余 find (对齐、插入文本等)：findAll 一次取回所有匹配，逐个匹配应用样式。
+    """
+    search = operation.search
+    descriptor = fmt.doc.createReplaceDescriptor()
+    descriptor.SearchString = search["text"]
+    descriptor.SearchRegularExpression = search["regex"]
+    descriptor.SearchCaseSensitive = search["match_case"]
+    descriptor.SearchWords = search["whole_words"]
+
+    if operation.scope == "replace":
+        descriptor.ReplaceString = search["replace_with"]
+        count = fmt.doc.replaceAll(descriptor)
+        bridge_stats["bridge_calls"] += 1
+        log_to_console(f"{operation}: replaced {count} matches")
+        return
+
+    if all(key in SEARCH_ATTRIBUTE_KEYS for key in operation.props):
+        properties = collect_properties(fmt, operation.props)
+        if not properties:
+            return
+        if not search["regex"]:
+            descriptor.SearchString = escape_search_text(search["text"])
+            descriptor.SearchRegularExpression = True
+        descriptor.ReplaceString = "&"
+        descriptor.setReplaceAttributes(tuple(
+            make_property(name, properties[name]) for name in sorted(properties)))
+        count = fmt.doc.replaceAll(descriptor)
+        bridge_stats["bridge_calls"] += 1
+        bridge_stats["property_writes"] += len(properties)
+        log_to_console(f"{operation}: formatted {count} matches")
+        return
+
+    found = fmt.doc.findAll(descriptor)
+    matches = [found.getByIndex(i) for i in range(found.getCount())]
+    for match in matches:
+        cursor = match.getText().createTextCursorByRange(match)
+        apply_styles(fmt, cursor, line_style_dict=operation.props)
+    log_to_console(f"{operation}: formatted {len(matches)} matches")
+
+
+def apply_styles(fmt_instance, target_cursor, line_style_dict, batch=None):
     """
     在指定的 cursor 上应用具体的样式属性
     :param fmt_instance: Format 类的实例 (用于调用 set_bold 等方法)
     :param target_cursor: 当前操作的 LibreOffice TextCursor 对象
     :param line_style_dict: 具体的样式字典, 如 {"bold": true, "font_color": "FF0000"}
+    :param batch: 可选的 PropertyBatch，多个样式字典共用时由调用方 flush
     """
-    # 建立指令与类方法的映射映射
-    FORMAT_FUNCTION_MAP = {
-        "bold": "set_bold",
-        "italic": "set_italic",
-        "underline": "set_underline",
-        "font_size": "set_font_size",
-        "font_color": "set_font_color",
-        "font_name": "set_font_name",  
-        "font_family": "set_font_name", 
-        "highlight": "highlight",
-        "remove_highlight": "remove_highlight",
-        "align_center": "align_center",
-        "align_left": "align_left",
-        "align_right": "align_right",
-        "align_justify": "align_justify",
-        "replace_text": "replace_selection",
-        "insert_text": "insert_text_at_cursor", # 插入文本
-        "clear_format": "clear_format"
-    }
+    if batch is not None and any(key in line_style_dict for key in TEXT_EDIT_KEYS):
+        # 先提交之前的写入，再修改文本
+        batch.flush()
 
     # 特殊处理：替换文本
     if "replace_text" in line_style_dict:
@@ -528,6 +1930,11 @@ def apply_styles(fmt_instance, target_cursor, line_style_dict):
         is_before = line_style_dict.get("insert_before", False)
         fmt_instance.insert_text_at_cursor(target_cursor, text_to_insert, insert_before=is_before)
 
+    # 属性写入先记录在 PropertyBatch 中，最后一次性提交
+    shared = batch is not None
+    if not shared:
+        batch = PropertyBatch(target_cursor, skip_unchanged=fmt_instance.skip_unchanged)
+
     # 遍历字典执行其他操作
     for operation, value in line_style_dict.items():
         # 跳过已经处理过的插入指令或逻辑控制键
@@ -538,6 +1945,7 @@ def apply_styles(fmt_instance, target_cursor, line_style_dict):
             func_name = FORMAT_FUNCTION_MAP[operation]
             # 从 fmt 实例中获取对应的方法
             func = getattr(fmt_instance, func_name)
+            batch.operation = operation
 
             try:
                 # 定义不需要参数的方法名
@@ -549,97 +1957,209 @@ def apply_styles(fmt_instance, target_cursor, line_style_dict):
                 if operation in no_param_actions:
                     # 如果大模型返回 "bold": true，则执行
                     if value is not False: 
-                        func(target_cursor)
+                        func(batch)
                 else:
                     # 需要传参的方法 (如颜色、字号)
-                    func(target_cursor, value)
+                    func(batch, value)
                     
             except Exception as e:
-                log_to_console(f"Error executing {operation} on cursor: {e}")
+                log_to_console(f"Error executing {operation} on cursor: {e}", level=logging.WARNING)
+
+    if not shared:
+        batch.flush()
                 
                 
-class MainJob(unohelper.Base, XJobExecutor):
-    def __init__(self, ctx):
-        log_to_console("MainJob.__init__ called.")
-
-        self.ctx = ctx
+class BatchFormatJob:
+    """
+    批量处理：逐个隐藏加载文档，执行同一份格式化计划，保存并关闭。
+    所有 UNO 调用都在调用 run() 的线程 (即主线程) 上进行，不创建窗口、不渲染；
+    run() 在每个文件之前调用 step(已完成数, 总数, 文件 URL)，由调用方处理界面事件，
+    step 返回 False 时停止。全部处理完且至少一个文件成功时调用 on_success()。
+    """
 
+    def __init__(self, ctx, desktop, file_urls, format_request, suspend_layout=True, format_options=None,
+                 trace_path=None, on_success=None):
+        self.ctx = ctx
+        self.desktop = desktop
+        self.file_urls = list(file_urls)
+        self.format_request = format_request
+        self.suspend_layout = suspend_layout
+        self.format_options = format_options or {}
+        # 每个文件一条 RunTrace 记录 (load / parse / resolve / apply / store)
+        self.trace_path = trace_path
+        self.on_success = on_success
+        self.results = []
+
+    def run(self, step=None):
+        for done, file_url in enumerate(self.file_urls):
+            if step is not None and not step(done, len(self.file_urls), file_url):
+                log_to_console(f"Batch cancelled, {len(self.file_urls) - done} file(s) not processed.")
+                break
+            self.results.append(self.process(file_url))
+        failed = [r for r in self.results if not r["ok"]]
+        log_to_console(f"Batch finished: {len(self.results) - len(failed)} ok, {len(failed)} failed.")
+        if self.on_success is not None and len(failed) < len(self.results):
+            self.on_success()
+        return self.results
+
+    def process(self, file_url):
+        started = time.perf_counter()
+        trace = RunTrace(self.trace_path, mode="batch_item", file=file_url)
+        doc = None
         try:
-            self.sm = ctx.getServiceManager()
+            with trace.phase("load"):
+                doc = self.desktop.loadComponentFromURL(
+                    file_url, "_blank", 0, (make_property("Hidden", True),))
+            if doc is None or not doc.supportsService("com.sun.star.text.TextDocument"):
+                raise RuntimeError("not a Writer document")
+            execute_format_request(self.format_request, Format(self.ctx, doc, **self.format_options),
+                                   suspend_layout=self.suspend_layout, trace=trace)
+            with trace.phase("store"):
+                doc.store()
+            result = {"file": file_url, "ok": True, "skipped_writes": trace.fields.get("skipped_writes", 0)}
+        except Exception as e:
+            log_to_console(f"Error formatting {file_url}: {e}", level=logging.WARNING)
+            result = {"file": file_url, "ok": False, "error": str(e)}
+        finally:
+            if doc is not None:
+                try:
+                    doc.close(True)
+                except Exception as e:
+                    log_to_console(f"Error closing {file_url}: {e}", level=logging.WARNING)
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        log_to_console(f"Batch item: {result}")
+        trace.finish(ok=result["ok"])
+        return result
 
-            self.desktop = self.sm.createInstanceWithContext(
-                "com.sun.star.frame.Desktop",
-                ctx
-            )
 
-        except Exception as e:
-            log_to_console(f"Failed to initialize Desktop: {e}")
-            raise
+class PlanStreamParser:
+    """
+    增量解析模型流式输出的 JSON 计划。
 
-    def get_config(self, key, default):
-        name_file = "writerai.json"
-        path_settings = self.sm.createInstanceWithContext('com.sun.star.util.PathSettings', self.ctx)
-        user_config_path = getattr(path_settings, "UserConfig")
-        if user_config_path.startswith('file://'):
-            user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
-        config_file_path = os.path.join(user_config_path, name_file)
-        if not os.path.exists(config_file_path):
-            return default
-        try:
-            with open(config_file_path, 'r') as file:
-                config_data = json.load(file)
-        except (IOError, json.JSONDecodeError):
-            return default
-        return config_data.get(key, default)
+    feed() 接收新到的文本片段，返回其中刚刚闭合的完整条目 (page_key, line_key, value)：
+    page_n 下的每个 line_n / line_all 对象 (以及 paragraph_style 下的每个样式) 闭合时立即返回，其他顶层范围 (selection、
+    all_pages 等) 在其值闭合时返回。第一个 "{" 之前的内容 (如 ```json) 被忽略。
+    """
 
-    def set_config(self, key, value):
-        name_file = "writerai.json"
-        path_settings = self.sm.createInstanceWithContext('com.sun.star.util.PathSettings', self.ctx)
-        user_config_path = getattr(path_settings, "UserConfig")
-        if user_config_path.startswith('file://'):
-            user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
-        config_file_path = os.path.join(user_config_path, name_file)
-        config_data = {}
-        if os.path.exists(config_file_path):
-            try:
-                with open(config_file_path, 'r') as file:
-                    config_data = json.load(file)
-            except (IOError, json.JSONDecodeError):
-                pass
-        config_data[key] = value
+    def __init__(self):
+        self.buffer = []
+        self.started = False
+        self.finished = False
+        self._stack = []        # [(起始位置, 键名)]，每个未闭合的 { 或 [
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._pending_key = None
+
+    def feed(self, text):
+        entries = []
+        for char in text:
+            if self.finished:
+                break
+            if not self.started:
+                if char != "{":
+                    continue
+                self.started = True
+            position = len(self.buffer)
+            self.buffer.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = json.loads("".join(self.buffer[self._string_start:]))
+            elif char == '"':
+                self._in_string = True
+                self._string_start = position
+            elif char == ":":
+                self._pending_key = self._last_string
+            elif char == ",":
+                self._pending_key = None
+            elif char in "{[":
+                self._stack.append((position, self._pending_key))
+                self._pending_key = None
+            elif char in "}]":
+                start, key = self._stack.pop()
+                entry = self._closed(start, key)
+                if entry is not None:
+                    entries.append(entry)
+                if not self._stack:
+                    self.finished = True
+        return entries
+
+    def _closed(self, start, key):
+        depth = len(self._stack)
+        if depth == 1 and not is_nested_scope(key):
+            return key, None, self._value(start)
+        if depth == 2 and is_nested_scope(self._stack[1][1]):
+            return self._stack[1][1], key, self._value(start)
+        return None
+
+    def _value(self, start):
+        return json.loads("".join(self.buffer[start:]))
+
+    def result(self):
+        """返回完整的计划；输出不完整时返回 None。"""
+        if not self.finished:
+            return None
+        return json.loads("".join(self.buffer))
+
+
+class RateLimiter:
+    """多个线程共享：保证相邻两次 wait() 返回的间隔不小于 1 / rate 秒。"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ModelCall(threading.Thread):
+    """在后台线程执行一次模型调用，结果或异常保存在 result / error 中。"""
+
+    def __init__(self, func):
+        super().__init__(name="writerai-model-call", daemon=True)
+        self.func = func
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
         try:
-            with open(config_file_path, 'w') as file:
-                json.dump(config_data, file, indent=4)
-        except IOError as e:
-            log_to_console(f"Error writing to config: {e}")
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
 
-    def _as_bool(self, value):
-        if isinstance(value, str):
-            return value.lower() in ('true', '1', 't', 'y', 'yes')
-        return bool(value)
 
-    BACKEND_PRESETS = [
-        ("Gemini 3 Pro", "chat", "https://generativelanguage.googleapis.com/v1beta"),
-        ("Gemini 3 Flash", "chat", "https://generativelanguage.googleapis.com/v1beta"),
-        ("QWen", "chat", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"),
-    ]
-    
-    @staticmethod
-    def askQwen(query,api_key = "sk-f361ac282d2044d1a9523413ee925382"):
-        """
-    使用 Qwen 大模型将自然语言指令转换为 LibreOffice Writer 的结构化配置字典。
-    
-    Args:
-        user_input: 用户输入的自然语言，如 "将第一页第一行进行黄色高亮标记"
-        api_key: 阿里云 DashScope 的 API Key
-        
-    Returns:
-        dict: 结构化后的指令字典。若解析失败则返回空字典。
-    """
-        print(f"original query is :{query}")
-        
-        # 1. 构造系统提示词，严格定义输出规范
-        system_prompt = ("""
+class CancelListener(unohelper.Base, XActionListener):
+    def __init__(self):
+        self.cancelled = False
+
+    def actionPerformed(self, event):
+        self.cancelled = True
+
+    def disposing(self, event):
+        pass
+
+
+# 系统提示词，严格定义输出规范。
+# 修改提示词内容时同步递增 SYSTEM_PROMPT_VERSION，旧的缓存结果随之失效。
+SYSTEM_PROMPT_VERSION = 5
+SYSTEM_PROMPT = """
                             # Role
                             You are a formatting expert specifically designed for LibreOffice Writer. Your mission is to translate natural language instructions from users into precise JSON formatting commands.
 
@@ -750,11 +2270,33 @@ class MainJob(unohelper.Base, XJobExecutor):
                                 - If the user says "replace" WITHOUT specifying a line number OR "selection":
                                 - DO NOT default to "line_1". 
                                 - Instead, ALWAYS use "selection" as the default scope. 
+                                - Exception: "replace all X with Y" / "every X" without a location means every occurrence; use "replace_all".
                                 - Logic: Users usually want to operate where their cursor is currently blinking.
 
                             - **Strict All Pages**:
                                 - Only use "all_pages" if the user says "whole document", "everything", or "all".
 
+                            - **Paragraph Style Scopes**:
+                                - If the user refers to headings by type ("all headings", "every heading", "所有标题"), use "headings" as the top-level key.
+                                - Example: {"headings": {"bold": true}}
+                                - If the user names a paragraph style ("Heading 2", "Title", "Text body"), use "paragraph_style" with the style name as the inner key.
+                                - Example: {"paragraph_style": {"Heading 2": {"font_color": "0000FF"}}}
+
+                            - **Search Scopes (keywords and patterns)**:
+                                - If the user wants every occurrence of a word or phrase formatted ("highlight all 'AI'", "bold every 'Python'", "把所有'人工智能'标红"), use "find" as the top-level key, with the text in "text" and the style dict in "format".
+                                - Example: {"find": {"text": "AI", "format": {"highlight": "FFFF00"}}}
+                                - If the user wants every occurrence replaced ("replace all X with Y", "把所有X改成Y"), use "replace_all" with "text" and "replace_with".
+                                - Example: {"replace_all": {"text": "colour", "replace_with": "color"}}
+                                - Optional flags for both: "match_case" (bool), "whole_words" (bool), "regex" (bool, ICU regular expression). With "regex": true, "$1", "$2" in "replace_with" refer to capture groups.
+                                - Example: {"replace_all": {"text": "([0-9]+)-([0-9]+)", "regex": true, "replace_with": "$2-$1"}}
+                                - Several searches may be given as a list: {"find": [{"text": "AI", "format": {"bold": true}}, {"text": "LLM", "format": {"italic": true}}]}
+
+                            - **Document Outline**:
+                                - The message may start with a "# Document outline" block, one paragraph per row as `page.line [paragraph style] text` (text may be truncated with "…"). The instruction follows under "# User instruction".
+                                - Use it to resolve references such as "the title", "the conclusion" or "the paragraph about X": row `3.2` maps to {"page_3": {"line_2": ...}}.
+                                - The outline is read-only context: never copy its text into "insert_text" or "replace_text" unless the user asks for it.
+                                - If the outline header says "part k of n", you only see those pages: use page numbers exactly as shown in the outline, never refer to pages outside them, and return an empty object {} when nothing in this part matches the instruction.
+
                             # 7. Operational Constraints
                             - NO REDUNDANCY: Do not invent keys like "underline_color".
                             - NO ASSUMPTIONS: Do not add a "highlight" if the user only asked for "underline".
@@ -771,45 +2313,1159 @@ class MainJob(unohelper.Base, XJobExecutor):
                               Assistant: {"page_2": {"line_4": {"highlight": "FFB7C5"}}}
 
                   """
-                
-        )
-        # 2. 调用 Qwen 模型 (以 qwen-turbo 为例，也可根据需求换成 qwen-max)
-        dashscope.api_key = api_key
-        #print("1")
-        response = dashscope.Generation.call(
-            model=dashscope.Generation.Models.qwen_turbo,
-            messages=[
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': query}
-            ],
-            result_format='message'
-        )
-        #print("2")
 
-        # 3. 处理响应结果
-        if response.status_code == HTTPStatus.OK:
-            #print("3")
-            content = response.output.choices[0].message.content
-            print(f"content:{content}")
+
+# UserConfig 目录，由 MainJob.user_config_dir 在首次使用时解析
+_user_config_dir = None
+
+
+class ConfigStore:
+    """
+    writerai.json 的内存副本：首次读取时加载，之后仅在文件 mtime 变化时重新加载；
+    update 把所有变更的键合并后一次性原子写入 (写临时文件再 rename)。
+    """
+
+    FILE_NAME = "writerai.json"
+
+    _instances = {}
+
+    @classmethod
+    def for_path(cls, path):
+        store = cls._instances.get(path)
+        if store is None:
+            store = cls._instances[path] = cls(path)
+        return store
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        mtime = self._stat_mtime()
+        if self._data is None or mtime != self._mtime:
+            data = {}
+            if mtime is not None:
+                try:
+                    with open(self.path, 'r') as file:
+                        data = json.load(file)
+                    if not isinstance(data, dict):
+                        raise ValueError("not a JSON object")
+                except (IOError, ValueError) as e:
+                    # 文件损坏或正在被其他程序写入：沿用上次读到的设置
+                    log_to_console(f"Ignoring unreadable config {self.path}: {e}", level=logging.WARNING)
+                    data = self._data or {}
+            self._data, self._mtime = data, mtime
+        return self._data
+
+    def get(self, key, default):
+        with self._lock:
+            return self._load().get(key, default)
+
+    def update(self, values):
+        with self._lock:
+            data = self._load()
+            changed = {key: value for key, value in values.items()
+                       if key not in data or data[key] != value}
+            if not changed:
+                return
+            data = dict(data, **changed)
+            tmp_path = self.path + ".tmp"
             try:
-                # 1. 清理字符串
-                clean_json = content.replace("```json", "").replace("```", "").strip()
-                
-                # 2. 只解析一次并存储在变量中
-                data = json.loads(clean_json)
-                
-                # 3. 打印并返回
-                log_to_console(f"Structured query: {data}")
-                return data
-            except Exception as e:
-                log_to_console(f"JSON Parsing Error: {e}")
+                with open(tmp_path, 'w') as file:
+                    json.dump(data, file, indent=4)
+                os.replace(tmp_path, self.path)
+            except IOError as e:
+                log_to_console(f"Error writing to config: {e}", level=logging.WARNING)
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return
+            self._data, self._mtime = data, self._stat_mtime()
+
+
+class ResponseCache:
+    """
+    askQwen 的响应缓存：内存 LRU + 磁盘 JSON 存储 (UserConfig/writerai_cache.json)。
+
+    键由规范化后的指令、模型名和 SYSTEM_PROMPT_VERSION 组成；条目按 TTL 过期，
+    超过 max_entries 时淘汰最久未使用的条目。
+
+    附带文档概要时，计划中有 page_n 的 (依赖文档版面) 以概要的结构 (页.行和样式，不含正文)
+    为键的一部分，其余计划 (全文、选区、标题、查找替换) 与文档无关，仍按指令本身缓存；
+    因此修改正文或只改格式 (如刚执行的计划) 不会使重复的指令失去缓存。
+    """
+
+    FILE_NAME = "writerai_cache.json"
+    DEFAULT_TTL = 7 * 24 * 3600
+    DEFAULT_MAX_ENTRIES = 500
+    MEMORY_ENTRIES = 64
+
+    _instances = {}
+
+    @classmethod
+    def for_path(cls, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """每个缓存文件在进程内只保留一个实例，使内存层和计数器跨调用复用。"""
+        cache = cls._instances.get(path)
+        if cache is None:
+            cache = cls._instances[path] = cls(path, ttl, max_entries)
+        else:
+            cache.ttl = ttl
+            cache.max_entries = max_entries
+        return cache
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._disk = None
+        # 分块请求时多个线程同时读写
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def normalize_query(query):
+        # 只做空白和全角/半角规范化；不改大小写，避免 insert_text 等指令的文本内容被合并
+        query = unicodedata.normalize("NFKC", str(query))
+        return " ".join(query.split())
+
+    def make_key(self, query, model, context=""):
+        parts = [self.normalize_query(query), str(model), SYSTEM_PROMPT_VERSION]
+        if context:
+            parts.append(self.outline_structure(context))
+        raw = json.dumps(parts, ensure_ascii=False)
+        import hashlib
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def plan_keys(self, query, model, context=""):
+        """返回 (与文档无关的键, 文档结构键)；没有概要时两者相同。"""
+        key = self.make_key(query, model)
+        return key, (self.make_key(query, model, context) if context else key)
+
+    @staticmethod
+    def outline_structure(context):
+        """去掉概要每行的正文，只保留 "页.行 [样式]"。"""
+        return re.sub(r"(?m)^(\d+\.\d+ \[[^\]\n]*\]).*$", r"\1", str(context))
+
+    @staticmethod
+    def key_for_plan(keys, plan):
+        """计划中有 page_n 时按文档结构键保存，否则按与文档无关的键保存。"""
+        if any(re.fullmatch(r"page_\d+", str(scope)) for scope in plan):
+            return keys[1]
+        return keys[0]
+
+    def get(self, *keys):
+        """按顺序查找 keys，返回第一个未过期的条目；无论查了几个键都只计一次命中或未命中。"""
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is None:
+                    entry = self._load_disk().get(key)
+                if entry is not None and self._expired(entry):
+                    self._drop(key)
+                    entry = None
+                if entry is not None:
+                    break
+            if entry is None:
+                self.misses += 1
+                return None
+            # 记录最近使用时间供淘汰使用，随下一次 put 写入磁盘
+            entry["used"] = time.time()
+            self._remember(key, entry)
+            self.hits += 1
+            self.saved_seconds += entry.get("latency", 0.0)
+            # 返回副本，调用方修改计划不会污染缓存
+            return json.loads(json.dumps(entry["value"]))
+
+    def put(self, key, value, latency=0.0):
+        entry = {"time": time.time(), "latency": latency, "value": value}
+        with self._lock:
+            self._remember(key, entry)
+            disk = self._load_disk()
+            disk[key] = entry
+            self._evict(disk)
+            self._write_disk(disk)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+    def _expired(self, entry):
+        return self.ttl > 0 and time.time() - entry.get("time", 0) > self.ttl
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+    def _drop(self, key):
+        self._memory.pop(key, None)
+        disk = self._load_disk()
+        if disk.pop(key, None) is not None:
+            self._write_disk(disk)
+
+    def _evict(self, disk):
+        for key in [k for k, entry in disk.items() if self._expired(entry)]:
+            del disk[key]
+        if len(disk) > self.max_entries:
+            oldest = sorted(disk, key=lambda k: disk[k].get("used", disk[k].get("time", 0)))
+            for key in oldest[:len(disk) - self.max_entries]:
+                del disk[key]
+                self._memory.pop(key, None)
+
+    def _load_disk(self):
+        if self._disk is None:
+            self._disk = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as file:
+                        self._disk = json.load(file)
+                except (IOError, json.JSONDecodeError) as e:
+                    log_to_console(f"Ignoring unreadable response cache: {e}", level=logging.WARNING)
+        return self._disk
+
+    def _write_disk(self, disk):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(disk, file, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except IOError as e:
+            log_to_console(f"Error writing response cache: {e}", level=logging.WARNING)
+
+
+class PresetStore:
+    """
+    格式预设：名称 -> 验证过的计划，保存在 UserConfig/writerai_presets.json。
+
+    每个进程只读取一次文件，读取和保存时把计划编译为 FormatPlan 保存在内存中，
+    回放既不调用模型也不再编译。last 为本次会话最近一次成功执行的 (指令, 计划)，
+    供"保存预设"使用。
+    """
+
+    FILE_NAME = "writerai_presets.json"
+
+    _instances = {}
+
+    @classmethod
+    def for_path(cls, path):
+        store = cls._instances.get(path)
+        if store is None:
+            store = cls._instances[path] = cls(path)
+        return store
+
+    def __init__(self, path):
+        self.path = path
+        self.last = None
+        self._presets = {}      # 名称 -> {"plan", "query", "time"}
+        self._compiled = {}     # 名称 -> FormatPlan
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (IOError, json.JSONDecodeError) as e:
+            log_to_console(f"Ignoring unreadable presets: {e}", level=logging.WARNING)
+            return
+        for name, entry in data.items():
+            plan = entry.get("plan") if isinstance(entry, dict) else None
+            problems = validate_plan(plan)
+            if problems:
+                log_to_console(f"Skipping invalid preset {name!r}: {problems}", level=logging.WARNING)
+                continue
+            self._presets[name] = entry
+            self._compiled[name] = compile_plan(plan)
+
+    def names(self):
+        return sorted(self._presets, key=str.lower)
+
+    def plan(self, name):
+        """返回编译好的 FormatPlan；没有该预设时返回 None。"""
+        return self._compiled.get(name)
+
+    def raw_plan(self, name):
+        """返回预设的 JSON 计划 (副本)。"""
+        return json.loads(json.dumps(self._presets[name]["plan"]))
+
+    def remember(self, query, format_request):
+        if format_request:
+            self.last = (query, json.loads(json.dumps(format_request)))
+
+    def save(self, name, format_request, query=""):
+        """验证并保存预设，同名预设被覆盖；计划无效时抛出 ValueError。"""
+        name = str(name).strip()
+        if not name:
+            raise ValueError("preset name is empty")
+        problems = validate_plan(format_request)
+        if problems:
+            raise ValueError("; ".join(problems))
+        plan = json.loads(json.dumps(format_request))
+        with self._lock:
+            self._presets[name] = {"plan": plan, "query": query, "time": time.time()}
+            self._compiled[name] = compile_plan(plan)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self._presets, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        log_to_console(f"Saved preset {name!r}")
+
+
+DASHSCOPE_ENDPOINT = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+DEFAULT_DASHSCOPE_KEY = "sk-f361ac282d2044d1a9523413ee925382"
+
+
+class BackendError(RuntimeError):
+    pass
+
+
+class HTTPConnectionPool:
+    """
+    进程级 keep-alive HTTP(S) 连接池，按 (scheme, host, port) 复用连接，
+    第二次及以后的请求跳过 TCP/TLS 握手。线程安全。
+    """
+
+    MAX_IDLE_PER_HOST = 4
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+        self.created = 0
+        self.reused = 0
+
+    def _acquire(self, key, timeout):
+        import ssl
+        import http.client
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.created += 1
+        scheme, host, port = key
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.MAX_IDLE_PER_HOST:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def open(self, method, url, body=None, headers=None, timeout=60):
+        """
+        发送请求，返回 (response, release)。读完响应后调用 release(True) 归还连接，
+        出错时调用 release(False) 关闭连接。复用的连接已被服务器关闭时自动重试一次。
+        """
+        import http.client
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        scheme = parts.scheme or "https"
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            def release(ok, conn=conn):
+                if ok and not response.will_close:
+                    self._release(key, conn)
+                else:
+                    conn.close()
+            return response, release
+
+    def stats(self):
+        return {"created": self.created, "reused": self.reused}
+
+
+http_pool = HTTPConnectionPool()
+
+
+class LLMBackend(ABC):
+    """
+    模型后端基类：complete 返回完整文本，stream 逐段产出增量文本。
+    网络、HTTP 状态和响应格式的错误都以 BackendError 抛出。
+    """
+
+    def __init__(self, model, endpoint, api_key="", timeout=60):
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.timeout = timeout
+
+    @abstractmethod
+    def complete(self, system_prompt, query):
+        """返回模型对 query 的完整回复文本。"""
+
+    def stream(self, system_prompt, query):
+        # 不支持流式的后端一次性产出全部内容
+        yield self.complete(system_prompt, query)
+
+    def _post_json(self, url, payload, headers):
+        import http.client
+        from http import HTTPStatus
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = dict(headers, **{"Content-Type": "application/json"})
+        try:
+            response, release = http_pool.open("POST", url, body, headers, self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            raise BackendError(f"{self.model}: {e}") from e
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            # 读取超时 (socket.timeout 是 OSError)、连接中断、响应不完整
+            release(False)
+            raise BackendError(f"{self.model}: reading response failed: {e!r}") from e
+        release(True)
+        if response.status != HTTPStatus.OK:
+            raise BackendError(f"{self.model}: HTTP {response.status} {data[:500].decode('utf-8', 'replace')}")
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise BackendError(f"{self.model}: invalid JSON response {data[:200].decode('utf-8', 'replace')!r}") from e
+
+    def _post_sse(self, url, payload, headers):
+        """发送请求并逐个产出 Server-Sent Events 的 data 内容 (已解析为 JSON)。"""
+        import http.client
+        from http import HTTPStatus
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = dict(headers, **{"Content-Type": "application/json", "Accept": "text/event-stream"})
+        try:
+            response, release = http_pool.open("POST", url, body, headers, self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            raise BackendError(f"{self.model}: {e}") from e
+        ok = False
+        try:
+            if response.status != HTTPStatus.OK:
+                raise BackendError(f"{self.model}: HTTP {response.status} "
+                                   f"{response.read()[:500].decode('utf-8', 'replace')}")
+            for raw_line in response:
+                line = raw_line.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    data = line[5:].strip()
+                    if data and data != "[DONE]":
+                        yield json.loads(data)
+            ok = True
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise BackendError(f"{self.model}: reading stream failed: {e!r}") from e
+        finally:
+            release(ok)
+
+
+class DashScopeBackend(LLMBackend):
+    def _payload(self, system_prompt, query, stream):
+        parameters = {"result_format": "message"}
+        if stream:
+            parameters["incremental_output"] = True
+        return {
+            "model": self.model,
+            "input": {"messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query},
+            ]},
+            "parameters": parameters,
+        }
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    @staticmethod
+    def _content(data):
+        if "output" not in data:
+            raise BackendError(f"{data.get('code')} - {data.get('message')}")
+        try:
+            return data["output"]["choices"][0]["message"]["content"] or ""
+        except (KeyError, IndexError, TypeError) as e:
+            raise BackendError(f"unexpected response {str(data)[:200]}") from e
+
+    def complete(self, system_prompt, query):
+        data = self._post_json(self.endpoint, self._payload(system_prompt, query, False), self._headers())
+        return self._content(data)
+
+    def stream(self, system_prompt, query):
+        headers = dict(self._headers(), **{"X-DashScope-SSE": "enable"})
+        for data in self._post_sse(self.endpoint, self._payload(system_prompt, query, True), headers):
+            yield self._content(data)
+
+
+class GeminiBackend(LLMBackend):
+    def _payload(self, system_prompt, query):
+        return {
+            "systemInstruction": {"parts": [{"text": system_prompt}]},
+            "contents": [{"role": "user", "parts": [{"text": query}]}],
+            "generationConfig": {"responseMimeType": "application/json"},
+        }
+
+    def _url(self, method):
+        from urllib.parse import quote
+        return f"{self.endpoint.rstrip('/')}/models/{quote(self.model)}:{method}"
+
+    @staticmethod
+    def _content(data):
+        candidates = data.get("candidates") or []
+        if not candidates:
+            raise BackendError(str(data.get("error") or data.get("promptFeedback") or data))
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+
+    def complete(self, system_prompt, query):
+        data = self._post_json(self._url("generateContent"), self._payload(system_prompt, query),
+                               {"x-goog-api-key": self.api_key})
+        return self._content(data)
+
+    def stream(self, system_prompt, query):
+        for data in self._post_sse(self._url("streamGenerateContent") + "?alt=sse",
+                                   self._payload(system_prompt, query), {"x-goog-api-key": self.api_key}):
+            yield self._content(data)
+
+
+class MockBackend(LLMBackend):
+    """
+    离线测试用的本地后端，不访问网络：
+    指令本身是 JSON 计划时原样返回，否则返回设置中的 mock_response。
+    """
+
+    def __init__(self, model="mock", endpoint="", api_key="", timeout=60, response="{}"):
+        super().__init__(model, endpoint, api_key, timeout)
+        self.response = response
+
+    def complete(self, system_prompt, query):
+        try:
+            if isinstance(json.loads(query), dict):
+                return query
+        except ValueError:
+            pass
+        return self.response
+
+
+# 设置对话框中的预设名 -> (后端类, 模型 ID)
+BACKEND_MODELS = {
+    "gemini 3 pro": (GeminiBackend, "gemini-3-pro-preview"),
+    "gemini 3 flash": (GeminiBackend, "gemini-3-flash-preview"),
+    "qwen": (DashScopeBackend, "qwen-turbo"),
+    "local mock": (MockBackend, "mock"),
+}
+
+
+def create_backend(config):
+    """
+    根据配置 (model / endpoint / api_key / request_timeout) 创建模型后端。
+    未配置模型时沿用 Qwen 与内置的 DashScope Key。
+    """
+    name = str(config.get("model") or "QWen").lower()
+    backend_class, model_id = BACKEND_MODELS.get(name, (DashScopeBackend, "qwen-turbo"))
+    timeout = float(config.get("request_timeout") or 60)
+    if backend_class is MockBackend:
+        return MockBackend(timeout=timeout, response=config.get("mock_response") or "{}")
+    endpoint = config.get("endpoint") or (
+        DASHSCOPE_ENDPOINT if backend_class is DashScopeBackend
+        else "https://generativelanguage.googleapis.com/v1beta")
+    api_key = config.get("api_key") or (DEFAULT_DASHSCOPE_KEY if backend_class is DashScopeBackend else "")
+    return backend_class(model_id, endpoint, api_key, timeout)
+
+
+# ------------------------------------------------
+# Local instruction parser
+# ------------------------------------------------
+
+# 常见的固定句式 ("bold page 2 line 3"、"全文字号12"、"remove highlight") 在本地直接转换为计划，
+# 不请求模型。planner_stats 统计本地解析 (local) 和交给模型 (model) 的指令数。
+planner_stats = {"local": 0, "model": 0}
+
+LOCAL_COLORS = {
+    "red": "FF0000", "blue": "0000FF", "green": "008000", "yellow": "FFFF00", "black": "000000",
+    "white": "FFFFFF", "orange": "FFA500", "purple": "800080", "gray": "808080", "grey": "808080",
+    "pink": "FFC0CB", "gold": "FFD700",
+    "红": "FF0000", "蓝": "0000FF", "绿": "008000", "黄": "FFFF00", "黑": "000000",
+    "白": "FFFFFF", "橙": "FFA500", "紫": "800080", "灰": "808080", "粉": "FFC0CB", "金": "FFD700",
+}
+
+LOCAL_ORDINALS = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10, "last": None,
+}
+
+CHINESE_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+# 可以忽略的词：语气词、动词、介词和标点
+_LOCAL_FILLER = (r"\s+|[,，.。;；:：!！]|(?:please|make|set|change|turn|apply|the|to|in|on|of|for|and|with|"
+                 r"text|it|font|be)\b|请|帮我|把|将|给|使|让|设置为|设置成|设为|改为|改成|变为|变成|设置|调整为|"
+                 r"的|并且|并|和|然后|再|文字|文本|字体|一下")
+
+_local_rules = None
+
+
+def local_number(token):
+    """把 "3"、"3rd"、"third"、"三"、"十二" 转换为整数；无法识别时返回 None。"""
+    token = token.strip()
+    match = re.fullmatch(r"(\d+)(?:st|nd|rd|th)?", token)
+    if match:
+        return int(match.group(1))
+    if token in LOCAL_ORDINALS:
+        return LOCAL_ORDINALS[token]
+    if token and all(char in CHINESE_DIGITS or char == "十" for char in token):
+        if "十" not in token:
+            return int("".join(str(CHINESE_DIGITS[char]) for char in token))
+        tens, _, ones = token.partition("十")
+        return CHINESE_DIGITS.get(tens, 1) * 10 + CHINESE_DIGITS.get(ones, 0)
+    return None
+
+
+def local_rules():
+    """
+    返回 [(正则, 处理函数)]，按顺序在当前位置尝试；处理函数返回 ("scope", 范围) 或 (属性, 值)。
+    首次使用时编译，避免增加扩展加载时间。
+    """
+    global _local_rules
+    if _local_rules is not None:
+        return _local_rules
+
+    number = r"(\d+(?:st|nd|rd|th)?|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth)"
+    cn_number = r"(\d+|[零一二两三四五六七八九十]+)"
+    size = r"(\d+(?:\.\d+)?)"
+    color = "(" + "|".join(sorted((name for name in LOCAL_COLORS if name.isascii()), key=len, reverse=True)) + ")"
+    cn_color = "([" + "".join(name for name in LOCAL_COLORS if not name.isascii()) + "])色"
+    line = r"(?:line|paragraph|para)"
+
+    def line_scope(page, line_number):
+        return "scope", (f"page_{page}", f"line_{line_number}")
+
+    def page_scope(page):
+        return "scope", (f"page_{page}", "line_all")
+
+    target = r"(?:text|words?|letters?|characters?|sentences?|parts?|paragraphs?|lines?|ones?)"
+    cn_target = r"(?:文字|文本|字|内容|部分|句子|段落?|行|标题)"
+
+    rules = [
+        # ---- 选择条件 ----
+        # 修饰目标的颜色 ("the red text"、"红色的文字") 是按颜色选择文字，不是设置颜色
+        (rf"{color} (?:(?:highlighted|underlined|colou?red|bold|italic) )?{target}\b", lambda m: ("selector", None)),
+        (rf"{cn_color}(?:高亮)?的?{cn_target}", lambda m: ("selector", None)),
+        # ---- 范围 ----
+        (rf"page {number},? {line} {number}\b",
+         lambda m: line_scope(local_number(m.group(1)), local_number(m.group(2)))),
+        (rf"{line} {number} (?:of|on|in) page {number}\b",
+         lambda m: line_scope(local_number(m.group(2)), local_number(m.group(1)))),
+        (rf"{number} {line} (?:of|on|in) page {number}\b",
+         lambda m: line_scope(local_number(m.group(2)), local_number(m.group(1)))),
+        (rf"(?:(?:all|every ?thing) (?:of|on) |(?:the )?(?:whole|entire) )?page {number}\b",
+         lambda m: page_scope(local_number(m.group(1)))),
+        (rf"{line} {number}\b", lambda m: line_scope(1, local_number(m.group(1)))),
+        (rf"{number} {line}\b", lambda m: line_scope(1, local_number(m.group(1)))),
+        (r"(?:(?:the )?(?:whole|entire) (?:document|doc|text)|all pages|all (?:the )?text|every ?thing|"
+         r"the document|document[- ]wide)\b", lambda m: ("scope", "all_pages")),
+        (r"(?:all|every|each) (?:the )?headings?\b|(?:all )?the headings\b", lambda m: ("scope", "headings")),
+        (r"(?:the )?(?:current )?(?:selection|selected (?:text|part|words?))\b", lambda m: ("scope", "selection")),
+        (rf"第{cn_number}页第{cn_number}(?:行|段)",
+         lambda m: line_scope(local_number(m.group(1)), local_number(m.group(2)))),
+        (rf"第{cn_number}页", lambda m: page_scope(local_number(m.group(1)))),
+        (rf"第{cn_number}(?:行|段)", lambda m: line_scope(1, local_number(m.group(1)))),
+        (r"全文|全部内容|整篇(?:文档|文章)?|整个文档|所有(?:页面?|内容)", lambda m: ("scope", "all_pages")),
+        (r"(?:所有|全部|每个)(?:的)?标题", lambda m: ("scope", "headings")),
+        (r"选中(?:的)?(?:文字|文本|内容|部分)?|所选(?:内容|文字)?|选区", lambda m: ("scope", "selection")),
+        # ---- 格式 ----
+        (r"(?:remove|clear|delete|turn off)(?: the| all)? highlight(?:s|ing)?\b|un-?highlight\b",
+         lambda m: ("remove_highlight", True)),
+        (r"(?:取消|去掉|去除|删除|移除|清除)高亮", lambda m: ("remove_highlight", True)),
+        (r"(?:clear|remove)(?: all| the)? (?:formatting|format)\b", lambda m: ("clear_format", True)),
+        (r"清除格式", lambda m: ("clear_format", True)),
+        (rf"(?:{color} )?highlight(?:ed)?(?: (?:in |with )?{color})?\b",
+         lambda m: ("highlight", LOCAL_COLORS.get(m.group(1) or m.group(2)))),
+        (rf"(?:{cn_color})?高亮(?:显示)?(?:为|成)?(?:{cn_color})?",
+         lambda m: ("highlight", LOCAL_COLORS.get(m.group(1) or m.group(2)))),
+        (rf"(?:{color} )?(double )?underline(?:d)?(?: (?:in )?{color})?\b",
+         lambda m: ("underline", ("2" if m.group(2) else "1") + (LOCAL_COLORS.get(m.group(1) or m.group(3)) or ""))),
+        (rf"(?:加)?(?:{cn_color})?(双)?下划线",
+         lambda m: ("underline", ("2" if m.group(2) else "1") + (LOCAL_COLORS.get(m.group(1)) or ""))),
+        (rf"(?:font )?size(?: to| of| =)? {size}(?: ?(?:pt|points?))?\b|{size} ?(?:pt|points?)(?: size)?\b",
+         lambda m: ("font_size", float(m.group(1) or m.group(2)))),
+        (rf"(?:字号|字体大小|大小)(?:设为|设置为|改为|为|是)?\s*{size}(?:号|磅|pt)?|{size}(?:号字?|磅)",
+         lambda m: ("font_size", float(m.group(1) or m.group(2)))),
+        (rf"(?:(?:font )?colou?r(?: to)? )?{color}(?: colou?r)?\b", lambda m: ("font_color", LOCAL_COLORS[m.group(1)])),
+        (rf"(?:颜色)?(?:设为|改为|为)?{cn_color}", lambda m: ("font_color", LOCAL_COLORS[m.group(1)])),
+        (r"(?:bold|embolden|bolden)\b", lambda m: ("bold", True)),
+        (r"加粗|粗体", lambda m: ("bold", True)),
+        (r"(?:italic(?:ize|ise|s)?)\b", lambda m: ("italic", True)),
+        (r"斜体|倾斜", lambda m: ("italic", True)),
+        (r"(?:align (?:to (?:the )?)?)?(?:center|centre)(?:ed)?(?: align(?:ed)?)?\b", lambda m: ("align_center", True)),
+        # 单独的 left / right 可能表示位置 ("the text on the left")，必须带 align
+        (r"align(?:ed)? (?:to (?:the )?)?left\b|left[- ]align(?:ed)?\b", lambda m: ("align_left", True)),
+        (r"align(?:ed)? (?:to (?:the )?)?right\b|right[- ]align(?:ed)?\b", lambda m: ("align_right", True)),
+        (r"justif(?:y|ied)\b|align justify\b", lambda m: ("align_justify", True)),
+        (r"居中(?:对齐)?", lambda m: ("align_center", True)),
+        (r"左对齐", lambda m: ("align_left", True)),
+        (r"右对齐", lambda m: ("align_right", True)),
+        (r"两端对齐", lambda m: ("align_justify", True)),
+    ]
+    _local_rules = [(re.compile(pattern), handler) for pattern, handler in rules] + [
+        (re.compile(_LOCAL_FILLER), None)]
+    return _local_rules
+
+
+def parse_instruction(query):
+    """
+    在本地把常见的固定句式转换为计划，形式与模型的输出相同 (page_n / line_n / all_pages /
+    selection / headings)。指令中每个词都必须被规则识别，范围唯一、同一属性没有矛盾的值，
+    否则返回 None (不确定，交给模型)。未指明范围时与模型一致，作用于选中内容。
+    颜色词修饰目标文字 ("bold the red text") 时是按颜色选择，同样交给模型。
+    未带颜色的高亮/下划线与单独的颜色词同时出现时 ("highlight page 4 in yellow")，
+    颜色属于哪一项不确定，同样交给模型。
+    """
+    text = str(query or "").strip().lower()
+    if not text or len(text) > 200:
+        return None
+    rules = local_rules()
+    scope = None
+    props = {}
+    position = 0
+    while position < len(text):
+        for pattern, handler in rules:
+            match = pattern.match(text, position)
+            if match is None or match.end() == position:
+                continue
+            position = match.end()
+            if handler is None:
+                break
+            key, value = handler(match)
+            if key == "selector":
                 return None
+            if key == "scope":
+                if isinstance(value, tuple) and None in value:
+                    return None
+                if scope is not None and scope != value:
+                    return None
+                scope = value
+            else:
+                if props.get(key, value) != value:
+                    return None
+                props[key] = value
+            break
         else:
-            print(f"API 请求失败: {response.code} - {response.message}")
-            return {}     
+            return None
+    if not props:
+        return None
+    if "font_color" in props and (props.get("highlight", "") is None or props.get("underline") in ("1", "2")):
+        return None
+    if "highlight" in props and props["highlight"] is None:
+        props["highlight"] = LOCAL_COLORS["yellow"]
+
+    if isinstance(scope, tuple):
+        page_key, line_key = scope
+        if page_key == "page_0" or line_key == "line_0":
+            return None
+        plan = {page_key: {line_key: props}}
+    else:
+        plan = {scope or "selection": props}
+    if validate_plan(plan):
+        return None
+    return plan
+
+
+def record_planner(path, trace=None):
+    """记录一条指令由本地解析 ("local") 还是模型 ("model") 生成计划。"""
+    planner_stats[path] += 1
+    if trace is not None:
+        trace.fields["planner"] = path
+    total = sum(planner_stats.values())
+    log_to_console(f"Planner: {path} (local {planner_stats['local']}/{total}, model {planner_stats['model']}/{total})")
+
+
+class MainJob(unohelper.Base, XJobExecutor):
+    def __init__(self, ctx):
+        log_to_console("MainJob.__init__ called.", level=logging.DEBUG)
+
+        self.ctx = ctx
+
+        try:
+            self.sm = ctx.getServiceManager()
 
+            self.desktop = self.sm.createInstanceWithContext(
+                "com.sun.star.frame.Desktop",
+                ctx
+            )
 
+        except Exception as e:
+            log_to_console(f"Failed to initialize Desktop: {e}", level=logging.WARNING)
+            raise
+
+        try:
+            set_log_level(self.get_config("log_level", "WARNING"))
+        except Exception as e:
+            log_to_console(f"Error reading log_level: {e}", level=logging.WARNING)
+
+    def user_config_dir(self):
+        """UserConfig 目录 (writerai.json 所在位置)，每个进程只解析一次。"""
+        global _user_config_dir
+        if _user_config_dir is None:
+            path_settings = self.sm.createInstanceWithContext('com.sun.star.util.PathSettings', self.ctx)
+            user_config_path = getattr(path_settings, "UserConfig")
+            if user_config_path.startswith('file://'):
+                user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
+            _user_config_dir = user_config_path
+        return _user_config_dir
+
+    def config_store(self):
+        return ConfigStore.for_path(os.path.join(self.user_config_dir(), ConfigStore.FILE_NAME))
+
+    def get_config(self, key, default):
+        return self.config_store().get(key, default)
+
+    def get_response_cache(self):
+        """返回与 writerai.json 同目录的响应缓存（进程内共享）。"""
+        return ResponseCache.for_path(
+            os.path.join(self.user_config_dir(), ResponseCache.FILE_NAME),
+            ttl=float(self.get_config("cache_ttl", ResponseCache.DEFAULT_TTL)),
+            max_entries=int(self.get_config("cache_size", ResponseCache.DEFAULT_MAX_ENTRIES)),
+        )
+
+    def set_config(self, key, value):
+        self.config_store().update({key: value})
+
+    def preset_store(self):
+        return PresetStore.for_path(os.path.join(self.user_config_dir(), PresetStore.FILE_NAME))
+
+    def new_trace(self, **fields):
+        """创建一次运行的 RunTrace；trace_enabled 为 false 时只记日志不写文件。"""
+        path = None
+        if self._as_bool(self.get_config("trace_enabled", True)):
+            path = os.path.join(self.user_config_dir(), RunTrace.FILE_NAME)
+        return RunTrace(path, **fields)
+
+    def _as_bool(self, value):
+        if isinstance(value, str):
+            return value.lower() in ('true', '1', 't', 'y', 'yes')
+        return bool(value)
+
+    BACKEND_PRESETS = [
+        ("Gemini 3 Pro", "chat", "https://generativelanguage.googleapis.com/v1beta"),
+        ("Gemini 3 Flash", "chat", "https://generativelanguage.googleapis.com/v1beta"),
+        ("QWen", "chat", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"),
+        ("Local Mock", "mock", ""),
+    ]
+    
+    @staticmethod
+    def model_message(query, context=""):
+        """附带文档概要时，把概要放在用户指令之前。"""
+        if not context:
+            return query
+        return f"{context}\n\n# User instruction\n{query}"
+
+    @staticmethod
+    def askQwen(query,api_key = DEFAULT_DASHSCOPE_KEY, cache=None, backend=None, context="", trace=None):
+        """
+    使用大模型将自然语言指令转换为 LibreOffice Writer 的结构化配置字典。
     
+    Args:
+        user_input: 用户输入的自然语言，如 "将第一页第一行进行黄色高亮标记"
+        api_key: 阿里云 DashScope 的 API Key (未指定 backend 时使用 Qwen)
+        cache: 可选的 ResponseCache；命中时直接返回，不发起网络请求
+        backend: 可选的 LLMBackend，默认为 qwen-turbo
+        context: 可选的文档概要 (DocumentContext.outline)
+        trace: 可选的 RunTrace，记录 model / parse 耗时
+        
+    Returns:
+        dict: 结构化后的指令字典。若解析失败则返回空字典。
+    """
+        log_to_console("original query is:", query, level=logging.DEBUG)
+
+        if backend is None:
+            backend = DashScopeBackend("qwen-turbo", DASHSCOPE_ENDPOINT, api_key)
+        cache_keys = None
+        if cache is not None:
+            cache_keys = cache.plan_keys(query, backend.model, context)
+            cached = cache.get(*cache_keys)
+            if cached is not None:
+                log_to_console(f"Response cache hit: {cache.stats()}")
+                if trace is not None:
+                    trace.fields["cache_hit"] = True
+                return cached
+        
+        # 2. 调用模型
+        started = time.perf_counter()
+        try:
+            content = backend.complete(SYSTEM_PROMPT, MainJob.model_message(query, context))
+        except BackendError as e:
+            log_to_console(f"API 请求失败: {e}", level=logging.WARNING)
+            return {}
+        latency = time.perf_counter() - started
+        if trace is not None:
+            trace.add("model", latency)
+
+        # 3. 处理响应结果
+        log_to_console("content:", content, level=logging.DEBUG)
+        try:
+            # 1. 清理字符串
+            clean_json = content.replace("```json", "").replace("```", "").strip()
+            
+            # 2. 只解析一次并存储在变量中
+            with trace_phase(trace, "parse"):
+                data = json.loads(clean_json)
+            
+            # 3. 写入缓存，打印并返回
+            if cache is not None and data:
+                cache.put(ResponseCache.key_for_plan(cache_keys, data), data, latency)
+                log_to_console(f"Response cache miss: {cache.stats()}")
+            log_to_console("Structured query:", data, level=logging.DEBUG)
+            return data
+        except Exception as e:
+            log_to_console(f"JSON Parsing Error: {e}", level=logging.WARNING)
+            return None
+
+
+    @staticmethod
+    def askQwenChunked(query, chunks, cache=None, backend=None, workers=4, rate=2.0, trace=None, timeout=None):
+        """
+        大文档的分块请求：每块概要 (DocumentContext.chunks) 与同一条指令一起并发发送，
+        线程池最多 workers 个线程，每秒最多发出 rate 个请求。
+        各块计划只保留块内的页后合并为一个计划；失败的块和 timeout 秒内没有完成的块被跳过。
+        trace 的 model 阶段记录并发请求的总耗时 (墙钟时间)。
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        limiter = RateLimiter(rate)
+
+        def ask(chunk):
+            first_page, page_count, context = chunk
+            limiter.wait()
+            try:
+                plan = MainJob.askQwen(query, cache=cache, backend=backend, context=context)
+                return rebase_plan(plan, first_page, page_count) if plan else {}
+            except Exception:
+                # 一块失败不影响其他块的计划
+                log_to_console(f"Chunk at page {first_page} failed:\n{traceback.format_exc()}", level=logging.WARNING)
+                return {}
+
+        started = time.perf_counter()
+        pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="writerai-chunk")
+        futures = [pool.submit(ask, chunk) for chunk in chunks]
+        wait(futures, timeout)
+        plans = []
+        for chunk, future in zip(chunks, futures):
+            if future.done():
+                plans.append(future.result())
+            else:
+                log_to_console(f"Chunk at page {chunk[0]} timed out, skipped", level=logging.WARNING)
+        # 未完成的块不再等待，尚未开始的直接取消
+        pool.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.perf_counter() - started
+        if trace is not None:
+            trace.add("model", elapsed)
+            trace.fields["chunks"] = len(chunks)
+        data = merge_plans(plans)
+        log_to_console(f"Chunked request: {len(chunks)} chunks, {workers} workers, {elapsed:.3f}s")
+        log_to_console("Merged plan:", data, level=logging.DEBUG)
+        return data
+
+    @staticmethod
+    def askQwenStream(query, api_key = DEFAULT_DASHSCOPE_KEY, cache=None, backend=None, context=""):
+        """
+        askQwen 的流式版本：边接收模型输出边解析，逐个产出已闭合的计划条目
+        (page_key, line_key, style_dict)。完整输出解析成功后写入缓存。
+        """
+        if backend is None:
+            backend = DashScopeBackend("qwen-turbo", DASHSCOPE_ENDPOINT, api_key)
+        cache_keys = None
+        if cache is not None:
+            cache_keys = cache.plan_keys(query, backend.model, context)
+            cached = cache.get(*cache_keys)
+            if cached is not None:
+                log_to_console(f"Response cache hit: {cache.stats()}")
+                yield from iter_format_entries(cached)
+                return
+
+        started = time.perf_counter()
+        parser = PlanStreamParser()
+        # 出错时 BackendError 直接抛出，让调用方撤销已经应用的条目
+        for delta in backend.stream(SYSTEM_PROMPT, MainJob.model_message(query, context)):
+            yield from parser.feed(delta)
+
+        data = parser.result()
+        if data is None:
+            raise ValueError("JSON Parsing Error: incomplete streamed plan")
+        if cache is not None and data:
+            cache.put(ResponseCache.key_for_plan(cache_keys, data), data, time.perf_counter() - started)
+            log_to_console(f"Response cache miss: {cache.stats()}")
+        log_to_console("Structured query:", data, level=logging.DEBUG)
+
+    def suspend_layout(self):
+        """执行计划时是否暂停重绘和排版 (设置 suspend_layout，默认开启)。"""
+        return self._as_bool(self.get_config("suspend_layout", True))
+
+    def format_options(self):
+        """从设置中读取传给 Format 的选项。"""
+        return {
+            "style_mode": self._as_bool(self.get_config("style_mode", False)),
+            "skip_unchanged": self._as_bool(self.get_config("skip_unchanged", False)),
+            "traverse_all_text": self._as_bool(self.get_config("traverse_all_text", True)),
+        }
+
+    def document_context(self, fmt, trace=None):
+        """按设置的 token 预算 (context_budget，0 表示不发送) 生成 fmt 文档的概要。"""
+        budget = int(self.get_config("context_budget", DocumentContext.DEFAULT_BUDGET))
+        if budget <= 0:
+            return ""
+        try:
+            started = time.perf_counter()
+            with trace_phase(trace, "context"):
+                outline = fmt.index.context.outline(budget)
+            log_to_console(f"Document context: {estimate_tokens(outline)} tokens in "
+                           f"{time.perf_counter() - started:.3f}s")
+            return outline
+        except Exception as e:
+            log_to_console(f"Error building document context: {e}", level=logging.WARNING)
+            return ""
+
+    def document_chunks(self, fmt, trace=None):
+        """
+        开启 chunked_context (默认关闭) 时按 context_budget 把 fmt 文档的概要按页分块，
+        返回 [(首页, 页数, 块概要)]；多于一块时使用 askQwenChunked。
+        关闭时概要由 document_context 按预算裁剪，每条指令只请求一次模型。
+        """
+        budget = int(self.get_config("context_budget", DocumentContext.DEFAULT_BUDGET))
+        if budget <= 0 or not self._as_bool(self.get_config("chunked_context", False)):
+            return []
+        try:
+            with trace_phase(trace, "context"):
+                return fmt.index.context.chunks(budget)
+        except Exception as e:
+            log_to_console(f"Error splitting document context: {e}", level=logging.WARNING)
+            return []
+
+    def get_backend(self):
+        """按设置中保存的模型预设创建后端。"""
+        return create_backend({
+            "model": self.get_config("model", ""),
+            "endpoint": self.get_config("endpoint", ""),
+            "api_key": self.get_config("api_key", ""),
+            "request_timeout": self.get_config("request_timeout", 60),
+            "mock_response": self.get_config("mock_response", "{}"),
+        })
+
+    def local_plan(self, user_input):
+        """local_parser 开启 (默认) 时返回本地解析的计划，不确定时返回 None。"""
+        if not self._as_bool(self.get_config("local_parser", True)):
+            return None
+        return parse_instruction(user_input)
+
+    def plan_request(self, user_input, fmt=None, cache=None, backend=None, trace=None):
+        """
+        返回 (ask, timeout)：ask() 在任意线程中向模型请求计划，timeout 为建议的等待时间。
+        本地解析器能确定的指令直接返回计划，不构建概要也不请求模型。
+        fmt 不为 None 时附带该文档的概要；开启分块且概要超出预算时改为分块并发请求，
+        所有块共用同一个 timeout，到时未完成的块被跳过。
+        """
+        timeout = float(self.get_config("request_timeout", 60))
+        plan = self.local_plan(user_input)
+        if plan is not None:
+            record_planner("local", trace)
+            return (lambda: plan), timeout
+        record_planner("model", trace)
+        chunks = self.document_chunks(fmt, trace) if fmt is not None else []
+        if len(chunks) > 1:
+            workers = max(1, int(self.get_config("chunk_workers", 4)))
+            rate = float(self.get_config("chunk_rate", 2.0))
+            # 比外层的等待略短，留出合并计划的时间
+            deadline = max(1.0, timeout - 1.0)
+            return (lambda: MainJob.askQwenChunked(user_input, chunks, cache=cache, backend=backend,
+                                                   workers=workers, rate=rate, trace=trace,
+                                                   timeout=deadline)), timeout
+        context = self.document_context(fmt, trace) if fmt is not None else ""
+        return (lambda: MainJob.askQwen(user_input, cache=cache, backend=backend, context=context,
+                                        trace=trace)), timeout
+
+    def response_cache(self):
+        """cache_enabled 为 false 时返回 None。"""
+        if self._as_bool(self.get_config("cache_enabled", True)):
+            return self.get_response_cache()
+        return None
+
+    def stream_format(self, user_input, fmt, cache=None, suspend_layout=False, trace=None):
+        """
+        流式执行：模型每输出一个完整条目就在主线程上应用，编辑与生成重叠进行。
+        整个过程是一个撤销步骤；取消、超时或出错时撤销已应用的条目，文档保持原样。
+        默认只用 undo_context，已应用的条目边生成边显示；suspend_layout 为 True 时
+        锁定控制器，直到流结束才显示。
+        trace 的 model 阶段为等待模型输出的时间 (总时间减去期间的 resolve / apply)。
+        """
+        title = "AI Formatter (streaming)"
+        applied = []
+
+        def on_entry(entry):
+            apply_format_entry(fmt, *entry, trace=trace)
+            applied.append(entry)
+
+        record_planner("model", trace)
+        backend = self.get_backend()
+        context = self.document_context(fmt, trace)
+
+        def produce(emit):
+            for entry in MainJob.askQwenStream(user_input, cache=cache, backend=backend, context=context):
+                emit(entry)
+
+        scope = suspended_layout(fmt.doc, title) if suspend_layout else undo_context(fmt.doc, title)
+        started = time.perf_counter()
+        editing = trace.phases.get("resolve", 0.0) + trace.phases.get("apply", 0.0) if trace else 0.0
+        with fmt.index.paused():
+            with scope as undo_manager:
+                status, _ = self.run_with_progress(
+                    "AI Formatter", "Applying as the model writes...", produce,
+                    timeout=float(self.get_config("request_timeout", 60)),
+                    on_item=on_entry,
+                )
+        if trace is not None:
+            editing = trace.phases.get("resolve", 0.0) + trace.phases.get("apply", 0.0) - editing
+            trace.add("model", time.perf_counter() - started - editing)
+        if status != "done" and applied and undo_manager.getCurrentUndoActionTitle() == title:
+            undo_manager.undo()
+            log_to_console(f"Reverted {len(applied)} streamed entries.")
+        elif status == "done":
+            self.preset_store().remember(user_input, plan_from_entries(applied))
+        log_to_console(f"Streamed {len(applied)} entries, status: {status}")
+        return status
+
     def _detect_backend(self):
         # ... [Unchanged] ...
         model_name = self.get_config("model", "").lower()
@@ -832,17 +3488,18 @@ class MainJob(unohelper.Base, XJobExecutor):
         return result
 
     def _save_settings(self, result):
-        log_to_console("Saving settings:", result)
+        log_to_console("Saving settings:", result, level=logging.DEBUG)
         if not result:
-            log_to_console("No settings to save.")
+            log_to_console("No settings to save.", level=logging.DEBUG)
             return
-        for key, value in result.items():
-            self.set_config(key, value)
-        log_to_console("Settings saved.")
+        self.config_store().update(result)
+        log_to_console("Settings saved.", level=logging.DEBUG)
 
 
     def settings_box(self, title="", x=None, y=None):
-        log_to_console("--- Starting settings_box ---")
+        from com.sun.star.awt.PosSize import SIZE, POSSIZE
+        from com.sun.star.awt.PushButtonType import OK, CANCEL
+        log_to_console("--- Starting settings_box ---", level=logging.DEBUG)
         WIDTH, HEIGHT = 600, 150
         HORI_MARGIN, VERT_MARGIN = 10, 10
         BUTTON_WIDTH, BUTTON_HEIGHT = 100, 26
@@ -851,21 +3508,21 @@ class MainJob(unohelper.Base, XJobExecutor):
         
         ctx = self.ctx
         def create(name):
-            log_to_console(f"  Creating service: {name}")
+            log_to_console("  Creating service:", name, level=logging.DEBUG)
             return ctx.getServiceManager().createInstanceWithContext(name, ctx)
 
         try:
             dialog = create("com.sun.star.awt.UnoControlDialog")
             dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
-            log_to_console("Dialog and model created.")
+            log_to_console("Dialog and model created.", level=logging.DEBUG)
             
             dialog.setModel(dialog_model)
             dialog.setTitle(title)
             dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
-            log_to_console("Dialog model set, title and size set.")
+            log_to_console("Dialog model set, title and size set.", level=logging.DEBUG)
 
             def add(name, ctrl_type, x, y, width, height, props):
-                log_to_console(f"  Adding control '{name}' of type '{ctrl_type}'")
+                log_to_console("  Adding control", name, "of type", ctrl_type, level=logging.DEBUG)
                 model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + ctrl_type + "Model")
                 dialog_model.insertByName(name, model)
                 control = dialog.getControl(name)
@@ -895,37 +3552,35 @@ class MainJob(unohelper.Base, XJobExecutor):
             add("btn_ok", "Button", button_start_x, y_pos, BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
             add("btn_cancel", "Button", button_start_x + BUTTON_WIDTH + HORI_SEP, y_pos, BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": CANCEL})
 
-            log_to_console("All controls added.")
+            log_to_console("All controls added.", level=logging.DEBUG)
 
             frame = self.desktop.getCurrentFrame()
             window = frame.getContainerWindow() if frame else None
             if not window:
-                log_to_console("ERROR: Could not get window to create dialog.")
+                log_to_console("ERROR: Could not get window to create dialog.", level=logging.WARNING)
                 return {}
             
-            log_to_console("About to create peer.")
+            log_to_console("About to create peer.", level=logging.DEBUG)
             dialog.createPeer(create("com.sun.star.awt.Toolkit"), window)
-            log_to_console("Peer created.")
+            log_to_console("Peer created.", level=logging.DEBUG)
             
             ret = {}
-            log_to_console("About to execute dialog.")
+            log_to_console("About to execute dialog.", level=logging.DEBUG)
             if dialog.execute():
-                log_to_console("Dialog executed, OK pressed.")
+                log_to_console("Dialog executed, OK pressed.", level=logging.DEBUG)
                 ret = self._read_dialog_config(controls)
             else:
-                log_to_console("Dialog executed, Cancel pressed.")
+                log_to_console("Dialog executed, Cancel pressed.", level=logging.DEBUG)
             
-        except Exception as e:
-            log_to_console("--- EXCEPTION in settings_box ---")
-            log_to_console(e)
-            traceback.print_exc(file=sys.stderr)
+        except Exception:
+            log_to_console(f"--- EXCEPTION in settings_box ---\n{traceback.format_exc()}", level=logging.ERROR)
             ret = {}
         finally:
-            log_to_console("Finally block: Disposing dialog.")
+            log_to_console("Finally block: Disposing dialog.", level=logging.DEBUG)
             if 'dialog' in locals() and dialog:
                 dialog.dispose()
         
-        log_to_console("--- Exiting settings_box ---")
+        log_to_console("--- Exiting settings_box ---", level=logging.DEBUG)
         return ret
 
     def input_box(self, message, title="", default="", x=None, y=None):
@@ -990,24 +3645,254 @@ class MainJob(unohelper.Base, XJobExecutor):
         return ret
 
 
+    def list_box(self, message, title="", items=()):
+        """列表选择对话框：返回选中的项，取消时返回空字符串。"""
+        WIDTH = 400
+        HORI_MARGIN = 10
+        VERT_MARGIN = 10
+        BUTTON_WIDTH = 80
+        BUTTON_HEIGHT = 25
+        HORI_SEP = 10
+        VERT_SEP = 10
+        LABEL_HEIGHT = 25
+        LIST_HEIGHT = 25 * 8
+
+        HEIGHT = VERT_MARGIN * 3 + LABEL_HEIGHT + VERT_SEP + LIST_HEIGHT + BUTTON_HEIGHT
+
+        from com.sun.star.awt.PosSize import SIZE, POSSIZE
+        from com.sun.star.awt.PushButtonType import OK, CANCEL
+
+        ctx = self.ctx
+        def create(name):
+            return ctx.getServiceManager().createInstanceWithContext(name, ctx)
+
+        dialog = create("com.sun.star.awt.UnoControlDialog")
+        dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
+        dialog.setModel(dialog_model)
+        dialog.setVisible(False)
+        dialog.setTitle(title)
+        dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
+
+        def add(name, ctrl_type, x, y, width, height, props):
+            model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + ctrl_type + "Model")
+            dialog_model.insertByName(name, model)
+            control = dialog.getControl(name)
+            control.setPosSize(x, y, width, height, POSSIZE)
+            for key, value in props.items():
+                setattr(model, key, value)
+
+        add("label", "FixedText", HORI_MARGIN, VERT_MARGIN, WIDTH - HORI_MARGIN * 2, LABEL_HEIGHT, {"Label": str(message)})
+
+        list_y = VERT_MARGIN + LABEL_HEIGHT + VERT_SEP
+        add("list", "ListBox", HORI_MARGIN, list_y, WIDTH - HORI_MARGIN * 2, LIST_HEIGHT,
+            {"StringItemList": tuple(items), "SelectedItems": (0,) if items else ()})
+
+        buttons_y = list_y + LIST_HEIGHT + VERT_SEP
+        ok_x = (WIDTH - (BUTTON_WIDTH * 2 + HORI_SEP)) / 2
+        add("btn_ok", "Button", ok_x, buttons_y, BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
+        cancel_x = ok_x + BUTTON_WIDTH + HORI_SEP
+        add("btn_cancel", "Button", cancel_x, buttons_y, BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": CANCEL})
+
+        frame = self.desktop.getCurrentFrame()
+        window = frame.getContainerWindow() if frame else None
+        dialog.createPeer(create("com.sun.star.awt.Toolkit"), window)
+
+        ret = dialog.getControl("list").getSelectedItem() if dialog.execute() else ""
+        dialog.dispose()
+        return ret
+
+    def message_box(self, message, title="AI Formatter"):
+        BUTTONS_OK = uno.getConstantByName("com.sun.star.awt.MessageBoxButtons.BUTTONS_OK")
+        frame = self.desktop.getCurrentFrame()
+        window = frame.getContainerWindow() if frame else None
+        toolkit = self.sm.createInstanceWithContext("com.sun.star.awt.Toolkit", self.ctx)
+        toolkit.createMessageBox(window, "infobox", BUTTONS_OK, title, message).execute()
+
+    def save_preset(self):
+        """把本次会话最近一次成功执行的计划保存为预设。"""
+        store = self.preset_store()
+        if store.last is None:
+            self.message_box("No formatting plan has been applied in this session yet.")
+            return
+        query, format_request = store.last
+        name = self.input_box("Preset name:", "Save Formatting Preset", " ".join(query.split())[:40]).strip()
+        if not name:
+            return
+        try:
+            store.save(name, format_request, query)
+        except (ValueError, OSError) as e:
+            self.message_box(f"Cannot save preset: {e}")
+            return
+        self.message_box(f"Saved preset \"{name}\".")
+
+    def apply_preset(self):
+        """把选中的预设直接应用到当前文档，不调用模型。"""
+        store = self.preset_store()
+        names = store.names()
+        if not names:
+            self.message_box("No presets saved yet. Format a document, then use Save Preset.")
+            return
+        doc = self.desktop.getCurrentComponent()
+        if doc is None or not doc.supportsService("com.sun.star.text.TextDocument"):
+            self.message_box("Presets can only be applied to Writer documents.")
+            return
+        name = self.list_box("Preset:", "Apply Formatting Preset", names)
+        if not name:
+            return
+        trace = self.new_trace(mode="preset", preset=name, status="done")
+        try:
+            execute_format_request(store.plan(name), Format(self.ctx, doc, **self.format_options()),
+                                   suspend_layout=self.suspend_layout(),
+                                   trace=trace)
+        except Exception:
+            trace.fields["status"] = "error"
+            raise
+        finally:
+            trace.finish()
+
+    @contextmanager
+    def progress_window(self, title, message):
+        """
+        显示带进度条和取消按钮的非模态窗口，产出 (label, bar, cancel_listener, toolkit)；
+        调用方在主线程的循环中更新进度并调用 toolkit.reschedule() 处理界面事件。
+        """
+        from com.sun.star.awt.PosSize import SIZE, POSSIZE
+        WIDTH, HEIGHT = 360, 110
+        MARGIN, LABEL_HEIGHT, BAR_HEIGHT = 10, 20, 16
+        BUTTON_WIDTH, BUTTON_HEIGHT = 80, 25
+
+        ctx = self.ctx
+        def create(name):
+            return ctx.getServiceManager().createInstanceWithContext(name, ctx)
+
+        dialog = None
+        try:
+            dialog = create("com.sun.star.awt.UnoControlDialog")
+            dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
+            dialog.setModel(dialog_model)
+            dialog.setTitle(title)
+            dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
+
+            def add(name, ctrl_type, x, y, width, height, props):
+                model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + ctrl_type + "Model")
+                dialog_model.insertByName(name, model)
+                control = dialog.getControl(name)
+                control.setPosSize(x, y, width, height, POSSIZE)
+                for key, value in props.items():
+                    setattr(model, key, value)
+                return control
+
+            label = add("label", "FixedText", MARGIN, MARGIN, WIDTH - MARGIN * 2, LABEL_HEIGHT, {"Label": message})
+            bar = add("progress", "ProgressBar", MARGIN, MARGIN + LABEL_HEIGHT + 5, WIDTH - MARGIN * 2, BAR_HEIGHT,
+                      {"ProgressValueMin": 0, "ProgressValueMax": 100})
+            cancel_button = add("btn_cancel", "Button", (WIDTH - BUTTON_WIDTH) / 2, HEIGHT - BUTTON_HEIGHT - MARGIN,
+                                BUTTON_WIDTH, BUTTON_HEIGHT, {"Label": "Cancel"})
+            cancel_listener = CancelListener()
+            cancel_button.addActionListener(cancel_listener)
+
+            frame = self.desktop.getCurrentFrame()
+            window = frame.getContainerWindow() if frame else None
+            toolkit = create("com.sun.star.awt.Toolkit")
+            dialog.createPeer(toolkit, window)
+            dialog.setVisible(True)
+            yield label, bar, cancel_listener, toolkit
+        finally:
+            if dialog is not None:
+                dialog.dispose()
+
+    def run_with_progress(self, title, message, func, timeout=None, on_item=None):
+        """
+        在后台线程中执行 func，同时显示带取消按钮的进度窗口，主线程持续处理界面事件。
+        返回 (status, result)，status 为 "done" / "cancelled" / "timeout" / "error"。
+        取消或超时后后台线程的结果会被丢弃。
+
+        指定 on_item 时，func 以 emit 回调为参数，emit 的每一项都在主线程上交给 on_item。
+        """
+        items = queue.Queue()
+        if on_item is not None:
+            worker = ModelCall(lambda: func(items.put))
+        else:
+            worker = ModelCall(func)
+
+        def drain():
+            while True:
+                try:
+                    item = items.get_nowait()
+                except queue.Empty:
+                    return
+                on_item(item)
+
+        with self.progress_window(title, message) as (label, bar, cancel_listener, toolkit):
+            worker.start()
+            started = time.monotonic()
+            status = "done"
+            while not worker.finished.wait(0.05):
+                elapsed = time.monotonic() - started
+                if cancel_listener.cancelled:
+                    status = "cancelled"
+                    break
+                if timeout and elapsed > timeout:
+                    status = "timeout"
+                    break
+                if on_item is not None:
+                    drain()
+                bar.getModel().ProgressValue = int(elapsed * 25) % 101
+                label.getModel().Label = f"{message} ({int(elapsed)}s)"
+                toolkit.reschedule()
+            if status == "done" and on_item is not None:
+                drain()
+
+        if status != "done":
+            log_to_console(f"Model call {status}.")
+            return status, None
+        if worker.error is not None:
+            log_to_console(f"Model call failed: {worker.error}", level=logging.WARNING)
+            return "error", None
+        return status, worker.result
+
+    def run_batch(self, job):
+        """
+        在主线程上逐个处理 job 的文件 (UNO 调用不离开主线程)，每个文件之间
+        更新进度窗口并调用 toolkit.reschedule()；点击取消后剩余的文件不再处理。
+        """
+        with self.progress_window("AI Formatter", "Formatting documents...") as (label, bar, cancel_listener, toolkit):
+            def step(done, total, file_url):
+                bar.getModel().ProgressValue = int(done * 100 / total)
+                label.getModel().Label = f"{done + 1}/{total}: {os.path.basename(uno.fileUrlToSystemPath(file_url))}"
+                toolkit.reschedule()
+                return not cancel_listener.cancelled
+            return job.run(step)
+
     def trigger(self, args):
         BUTTONS_YES_NO = uno.getConstantByName("com.sun.star.awt.MessageBoxButtons.BUTTONS_YES_NO")
         YES = uno.getConstantByName("com.sun.star.awt.MessageBoxResults.YES")
         
-        log_to_console(f"\n--- Trigger called with args: {args} ---")
+        log_to_console("\n--- Trigger called with args:", args, "---", level=logging.DEBUG)
 
         if args == "setting":
-            log_to_console("Entering settings branch...")
+            log_to_console("Entering settings branch...", level=logging.DEBUG)
             try:
                 result = self.settings_box("Writer.ai Settings")
                 self._save_settings(result)
-            except Exception as e:
-                log_to_console("--- EXCEPTION in trigger(setting) ---")
-                log_to_console(e)
-                traceback.print_exc(file=sys.stderr)
+            except Exception:
+                log_to_console(f"--- EXCEPTION in trigger(setting) ---\n{traceback.format_exc()}", level=logging.ERROR)
         
+        elif args == "save_preset":
+            try:
+                self.save_preset()
+            except Exception:
+                log_to_console(f"--- EXCEPTION in trigger(save_preset) ---\n{traceback.format_exc()}", level=logging.ERROR)
+
+        elif args == "apply_preset":
+            try:
+                self.apply_preset()
+            except Exception:
+                log_to_console(f"--- EXCEPTION in trigger(apply_preset) ---\n{traceback.format_exc()}", level=logging.ERROR)
+
         elif args == "format":
-            log_to_console("Entering format branch...")
+            log_to_console("Entering format branch...", level=logging.DEBUG)
+            # 每次运行的分阶段耗时写入 writerai_trace.jsonl；status 在各个出口更新
+            trace = self.new_trace(mode="format", status="cancelled")
             try:
                 # 1. Initialize UNO environment
                 smgr = self.ctx.getServiceManager() # 建议使用 self.ctx
@@ -1025,54 +3910,89 @@ class MainJob(unohelper.Base, XJobExecutor):
                     "Would you like to format the CURRENTLY active document?\n\n(Select 'No' to pick a different file.)"
                 )
                 
-                choice = msg_box.execute()
+                with trace.phase("dialog"):
+                    choice = msg_box.execute()
                 target_doc = None
+                file_urls = []
 
                 if choice == YES:
                     target_doc = desktop.getCurrentComponent()
-                    log_to_console("Mode: Processing active document.")
+                    log_to_console("Mode: Processing active document.", level=logging.DEBUG)
+
+                    # 3. Validation: Ensure it's a Writer document
+                    if not target_doc or not hasattr(target_doc, "supportsService") or \
+                       not target_doc.supportsService("com.sun.star.text.TextDocument"):
+                        log_to_console("Error: Selected component is not a Writer document.", level=logging.WARNING)
+                        return
                 else:
-                    file_url = pick_writer_file(self.ctx)
-                    if file_url:
-                        # Open the selected file
-                        target_doc = desktop.loadComponentFromURL(file_url, "_blank", 0, ())
-                        log_to_console(f"Mode: Opened new document {file_url}")
-                    else:
-                        log_to_console("User cancelled file selection.")
+                    with trace.phase("dialog"):
+                        file_urls = pick_writer_files(self.ctx)
+                    if not file_urls:
+                        log_to_console("User cancelled file selection.", level=logging.DEBUG)
                         return # Exit gracefully
-
-                # 3. Validation: Ensure it's a Writer document
-                if not target_doc or not hasattr(target_doc, "supportsService") or \
-                   not target_doc.supportsService("com.sun.star.text.TextDocument"):
-                    log_to_console("Error: Selected component is not a Writer document.")
-                    return
+                    log_to_console("Mode: Batch of", len(file_urls), "document(s).", level=logging.DEBUG)
 
                 # 4. Get User Input for AI
-                user_input = self.input_box(
-                    "Document Format:",
-                    "AI Formatter",
-                    "Example: Bold all headings or highlight keywords."
-                )
+                with trace.phase("dialog"):
+                    user_input = self.input_box(
+                        "Document Format:",
+                        "AI Formatter",
+                        "Example: Bold all headings or highlight keywords."
+                    )
 
                 if not user_input:
-                    log_to_console("User cancelled input.")
+                    log_to_console("User cancelled input.", level=logging.DEBUG)
                     return
 
                 # 5. AI Process & Execution
                 # Note: Passing target_doc to your formatting logic is CRITICAL
-                format_request = MainJob.askQwen(user_input)
-                
-                # Make sure your Format class is initialized with the CORRECT doc
-                fmt = Format(self.ctx, target_doc) 
+                cache = self.response_cache()
+                suspend_layout = self.suspend_layout()
+                # 本地解析器能处理的指令不需要流式请求
+                if not file_urls and self._as_bool(self.get_config("stream_response", False)) \
+                        and self.local_plan(user_input) is None:
+                    trace.fields["mode"] = "stream"
+                    # 流式执行不暂停排版 (suspend_layout 只用于一次性执行的计划)，条目应用后立即可见
+                    trace.fields["status"] = self.stream_format(
+                        user_input, Format(self.ctx, target_doc, **self.format_options()), cache, trace=trace)
+                    return
+
+                # 单个文档时附带文档概要，批量处理的计划不依赖某一份文档
+                fmt = None if file_urls else Format(self.ctx, target_doc, **self.format_options())
+                ask, timeout = self.plan_request(user_input, fmt, cache, self.get_backend(), trace)
+                status, format_request = self.run_with_progress(
+                    "AI Formatter", "Waiting for the model...", ask, timeout=timeout,
+                )
+                trace.fields["status"] = status
+                if status != "done":
+                    # 取消或超时：不修改文档
+                    return
+
+                if file_urls:
+                    # 同一份计划应用到所有选中的文件：在主线程上隐藏处理，文件之间处理界面事件
+                    trace.fields["mode"] = "batch"
+                    if not format_request:
+                        log_to_console("Empty format plan, nothing to apply.")
+                        return
+                    self.run_batch(BatchFormatJob(
+                        self.ctx, desktop, file_urls, format_request,
+                        suspend_layout=suspend_layout,
+                        format_options=self.format_options(),
+                        trace_path=trace.path,
+                        on_success=lambda: self.preset_store().remember(user_input, format_request)))
+                    return
                 
-                execute_format_request(format_request, fmt)
+                execute_format_request(format_request, fmt, suspend_layout=suspend_layout, trace=trace)
+                if isinstance(format_request, dict):
+                    self.preset_store().remember(user_input, format_request)
 
                 log_to_console("Formatting completed successfully.")
 
-            except Exception as e:
-                log_to_console("--- EXCEPTION in trigger(format) ---")
-                log_to_console(str(e))
-                traceback.print_exc(file=sys.stderr)
+            except Exception:
+                trace.fields["status"] = "error"
+                log_to_console(f"--- EXCEPTION in trigger(format) ---\n{traceback.format_exc()}", level=logging.ERROR)
+            finally:
+                trace.finish()
                 
 g_ImplementationHelper = unohelper.ImplementationHelper()
 g_ImplementationHelper.addImplementation(
@@ -1080,4 +4000,4 @@ g_ImplementationHelper.addImplementation(
     "org.extension.writerai.do",
     ("com.sun.star.task.Job",),
 )
-log_to_console("Script loaded, implementation added.")
+log_to_console("Script loaded, implementation added.", level=logging.DEBUG)
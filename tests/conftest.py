@@ -0,0 +1,68 @@
+"""
+测试在普通 Python 中运行：没有 pyuno 时为 main.py 提供最小的 uno / unohelper / com.sun.star 替身，
+只覆盖模块导入和纯 Python 逻辑 (计划编译、本地解析、后端错误处理等) 用到的部分。
+"""
+import importlib.abc
+import importlib.machinery
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _UnoNamespace(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """com.sun.star.* 的替身：接口名返回空类，常量和枚举值返回其完整名称。"""
+
+    def find_spec(self, name, path, target=None):
+        if name == "com" or name.startswith("com."):
+            return importlib.machinery.ModuleSpec(name, self, is_package=True)
+        return None
+
+    def create_module(self, spec):
+        module = types.ModuleType(spec.name)
+        module.__path__ = []
+
+        def getattr_(attr, _name=spec.name):
+            if attr.startswith("__"):
+                raise AttributeError(attr)
+            if attr.startswith("X"):
+                return type(attr, (), {})
+            return f"{_name}.{attr}"
+        module.__getattr__ = getattr_
+        return module
+
+    def exec_module(self, module):
+        pass
+
+
+def _install_uno_stubs():
+    uno = types.ModuleType("uno")
+    uno.systemPathToFileUrl = lambda path: "file://" + path
+    uno.fileUrlToSystemPath = lambda url: url[len("file://"):]
+    uno.getConstantByName = lambda name: name
+
+    class _Struct:
+        def __init__(self, name):
+            self.typeName = name
+    uno.createUnoStruct = _Struct
+
+    def getComponentContext():
+        raise RuntimeError("no office in tests")
+    uno.getComponentContext = getComponentContext
+
+    unohelper = types.ModuleType("unohelper")
+    unohelper.Base = type("Base", (), {})
+    unohelper.ImplementationHelper = type("ImplementationHelper", (), {"addImplementation": lambda self, *a: None})
+    unohelper.systemPathToFileUrl = uno.systemPathToFileUrl
+    unohelper.fileUrlToSystemPath = uno.fileUrlToSystemPath
+
+    sys.modules["uno"] = uno
+    sys.modules["unohelper"] = unohelper
+    sys.meta_path.insert(0, _UnoNamespace())
+
+
+try:
+    import uno  # noqa: F401
+except ImportError:
+    _install_uno_stubs()
@@ -0,0 +1,57 @@
+import socket
+
+import pytest
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, status=200, body=b"{}", error=None):
+        self.status = status
+        self.body = body
+        self.error = error
+        self.will_close = False
+
+    def read(self):
+        if self.error is not None:
+            raise self.error
+        return self.body
+
+
+@pytest.fixture
+def respond(monkeypatch):
+    released = []
+
+    def install(response):
+        monkeypatch.setattr(main.http_pool, "open",
+                            lambda method, url, body, headers, timeout: (response, released.append))
+        return released
+    return install
+
+
+def backend():
+    return main.DashScopeBackend("qwen-turbo", "https://example.invalid/api", "key", timeout=1)
+
+
+def test_backend_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        main.LLMBackend("model", "endpoint")
+
+
+def test_read_timeout_becomes_backend_error(respond):
+    released = respond(FakeResponse(error=socket.timeout("timed out")))
+    with pytest.raises(main.BackendError):
+        backend().complete("system", "bold line 1")
+    assert released == [False]
+
+
+def test_non_json_body_becomes_backend_error(respond):
+    respond(FakeResponse(body=b"<html>gateway</html>"))
+    with pytest.raises(main.BackendError):
+        backend().complete("system", "bold line 1")
+
+
+def test_ask_qwen_falls_back_to_empty_plan_on_read_timeout(respond):
+    respond(FakeResponse(error=socket.timeout("timed out")))
+    assert main.MainJob.askQwen("make the conclusion bold", backend=backend()) == {}
+
@@ -0,0 +1,10 @@
+import writerai_batch
+
+
+def test_collect_files_keeps_paths_relative_to_each_root(tmp_path):
+    for name in ("a/report.docx", "b/report.docx", "b/notes.txt", "top.odt"):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+    files = writerai_batch.collect_files([str(tmp_path), str(tmp_path / "top.odt")])
+    assert [relative for _, relative in files] == ["top.odt", "a/report.docx", "b/report.docx"]
+    assert files[1][0] == str(tmp_path / "a" / "report.docx")
@@ -0,0 +1,27 @@
+import main
+
+
+def run_job(outcomes):
+    remembered = []
+    job = main.BatchFormatJob(None, None, list(outcomes), {"all_pages": {"line_all": {"font_size": 12}}},
+                              on_success=lambda: remembered.append(True))
+    job.process = lambda url: {"file": url, "ok": outcomes[url]}
+    job.run()
+    return remembered
+
+
+def test_remembers_after_a_successful_file():
+    assert run_job({"a.odt": False, "b.odt": True}) == [True]
+
+
+def test_does_not_remember_when_every_file_fails():
+    assert run_job({"a.odt": False, "b.odt": False}) == []
+
+
+def test_step_runs_before_each_file_and_can_stop_the_batch():
+    steps = []
+    job = main.BatchFormatJob(None, None, ["a.odt", "b.odt", "c.odt"], {"all_pages": {"line_all": {"bold": True}}})
+    job.process = lambda url: {"file": url, "ok": True}
+    results = job.run(lambda done, total, url: steps.append((done, total, url)) or done < 1)
+    assert steps == [(0, 3, "a.odt"), (1, 3, "b.odt")]
+    assert [result["file"] for result in results] == ["a.odt"]
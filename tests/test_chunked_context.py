@@ -0,0 +1,84 @@
+import main
+
+
+class FakeParagraph:
+    def __init__(self, text):
+        self.text = text
+
+    def getString(self):
+        return self.text
+
+
+class FakeIndex:
+    """六页，每页两段。"""
+    revision = 0
+
+    def __init__(self):
+        self.paragraphs = [FakeParagraph(f"paragraph {n} " + "word " * 20) for n in range(12)]
+
+    def paragraph_styles(self):
+        return ["Standard"] * len(self.paragraphs)
+
+    def heading_paragraphs(self):
+        return []
+
+    def page_starts(self):
+        return list(range(0, 12, 2))
+
+
+def test_chunks_keep_document_page_numbers():
+    chunks = main.DocumentContext(FakeIndex()).chunks(budget=120)
+    assert len(chunks) > 1
+    first, count, outline = chunks[1]
+    assert first > 1
+    pages = [int(line.split(".")[0]) for line in outline.splitlines() if line[:1].isdigit()]
+    assert pages[0] == first
+    assert set(pages) <= set(range(first, first + count))
+
+
+def test_rebase_plan_drops_pages_outside_the_chunk_without_shifting():
+    plan = {"page_1": {"line_2": {"bold": True}}, "page_4": {"line_1": {"italic": True}},
+            "all_pages": {"line_all": {"font_size": 12}}}
+    assert main.rebase_plan(plan, 3, 2) == {"page_4": {"line_1": {"italic": True}},
+                                            "all_pages": {"line_all": {"font_size": 12}}}
+
+
+def test_positional_instruction_is_applied_once_across_chunks(monkeypatch):
+    # 每块都按提示词把"第 2 段"答成 page_1.line_2
+    monkeypatch.setattr(main.MainJob, "askQwen", staticmethod(
+        lambda query, cache=None, backend=None, context="", trace=None:
+            {"page_1": {"line_2": {"insert_text": "Hello", "insert_before": False}}}))
+    chunks = [(1, 2, "part 1"), (3, 2, "part 2"), (5, 2, "part 3")]
+    plan = main.MainJob.askQwenChunked("insert 'Hello' after the 2nd paragraph", chunks, rate=1000)
+    operations = main.compile_plan(plan).operations
+    assert len(operations) == 1
+    assert (operations[0].page, operations[0].first) == (1, 2)
+
+
+def test_unfinished_chunks_are_skipped_at_the_deadline(monkeypatch):
+    import threading
+    release = threading.Event()
+
+    def ask(query, cache=None, backend=None, context="", trace=None):
+        if context == "slow":
+            release.wait(5)
+            return {"page_3": {"line_1": {"bold": True}}}
+        return {"page_1": {"line_1": {"bold": True}}}
+    monkeypatch.setattr(main.MainJob, "askQwen", staticmethod(ask))
+    try:
+        plan = main.MainJob.askQwenChunked("bold the first line", [(1, 2, "fast"), (3, 2, "slow")],
+                                           rate=1000, timeout=0.2)
+    finally:
+        release.set()
+    assert plan == {"page_1": {"line_1": {"bold": True}}}
+
+
+def test_ask_qwen_chunked_skips_failed_chunks(monkeypatch):
+    def ask(query, cache=None, backend=None, context="", trace=None):
+        if "part 2" in context:
+            raise RuntimeError("unexpected failure")
+        return {"page_1": {"line_1": {"bold": True}}}
+    monkeypatch.setattr(main.MainJob, "askQwen", staticmethod(ask))
+    plan = main.MainJob.askQwenChunked("bold the first line", [(1, 2, "part 1"), (3, 2, "part 2")],
+                                       rate=1000)
+    assert plan == {"page_1": {"line_1": {"bold": True}}}
@@ -0,0 +1,70 @@
+import main
+
+
+def compiled(plan):
+    result = main.compile_plan(plan)
+    return {repr(op): op.props for op in result.operations}, result.stats
+
+
+def test_page_op_contains_later_lines():
+    page = main.FormatOp.from_entry("page_1", "line_all", {"bold": True})
+    line = main.FormatOp.from_entry("page_1", "line_3", {"bold": True})
+    other_page = main.FormatOp.from_entry("page_2", "line_3", {"bold": True})
+    first_line = main.FormatOp.from_entry("page_1", "line_1", {"bold": True})
+    assert page.contains(line)
+    assert not page.contains(other_page)
+    # 页首段落可能从上一页开始
+    assert not page.contains(first_line)
+    assert not line.contains(page)
+
+
+def test_drops_lines_repeating_page_values():
+    ops, stats = compiled({"page_1": {"line_all": {"bold": True, "font_size": 12},
+                                      "line_3": {"bold": True, "font_size": 12}}})
+    assert ops == {"page_1.line_all": {"bold": True, "font_size": 12}}
+    assert stats["removed_operations"] == 1
+    assert stats["removed_writes"] == 2
+
+
+def test_drops_lines_repeating_document_values():
+    ops, stats = compiled({"all_pages": {"font_color": "FF0000"},
+                           "page_2": {"line_3": {"font_color": "FF0000", "italic": True}}})
+    assert ops == {"document": {"font_color": "FF0000"}, "page_2.line_3": {"italic": True}}
+    assert stats["removed_writes"] == 1
+
+
+def test_keeps_values_that_differ():
+    ops, _ = compiled({"all_pages": {"font_size": 12}, "page_1": {"line_3": {"font_size": 14}}})
+    assert ops == {"document": {"font_size": 12}, "page_1.line_3": {"font_size": 14}}
+
+
+def test_keeps_repeat_after_conflicting_write():
+    ops, _ = compiled({"all_pages": {"bold": True},
+                       "page_1": {"line_all": {"clear_format": True}, "line_3": {"bold": True}}})
+    assert ops["page_1.line_3"] == {"bold": True}
+    ops, _ = compiled({"all_pages": {"bold": True, "clear_format": True}, "page_1": {"line_3": {"bold": True}}})
+    assert ops["page_1.line_3"] == {"bold": True}
+
+
+def test_keeps_repeat_with_text_edit():
+    ops, _ = compiled({"page_1": {"line_all": {"bold": True},
+                                  "line_3": {"replace_text": "new", "bold": True}}})
+    assert ops["page_1.line_3"] == {"replace_text": "new", "bold": True}
+
+
+def test_alignment_is_not_treated_as_covering():
+    ops, _ = compiled({"all_pages": {"align_center": True}, "page_1": {"line_3": {"align_center": True}}})
+    assert ops["page_1.line_3"] == {"align_center": True}
+
+
+def test_later_containing_op_overrides_earlier_write():
+    ops, stats = compiled({"page_1": {"line_3": {"bold": True}}, "all_pages": {"bold": True}})
+    assert ops == {"document": {"bold": True}}
+    assert stats["removed_operations"] == 1
+
+
+def test_merges_adjacent_lines_and_drops_false_actions():
+    ops, stats = compiled({"page_1": {"line_1": {"italic": True}, "line_2": {"italic": True},
+                                      "line_4": {"bold": False}}})
+    assert ops == {"page_1.line_1-2": {"italic": True}}
+    assert stats["merged_operations"] == 1
@@ -0,0 +1,69 @@
+import json
+import os
+
+import main
+
+
+def write(path, data, mtime_ns=None):
+    path.write_text(data if isinstance(data, str) else json.dumps(data))
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_reloads_only_when_mtime_changes(tmp_path):
+    path = tmp_path / "writerai.json"
+    write(path, {"model": "qwen"}, 1_000_000_000)
+    store = main.ConfigStore(str(path))
+    assert store.get("model", "") == "qwen"
+    # 内容变了但 mtime 未变：仍使用内存副本
+    write(path, {"model": "gemini 3 pro"}, 1_000_000_000)
+    assert store.get("model", "") == "qwen"
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    assert store.get("model", "") == "gemini 3 pro"
+
+
+def test_update_writes_atomically_and_merges(tmp_path, monkeypatch):
+    path = tmp_path / "writerai.json"
+    write(path, {"model": "qwen", "api_key": "k"})
+    store = main.ConfigStore(str(path))
+    replaced = []
+    real_replace = os.replace
+
+    def replace(src, dst):
+        # rename 之前临时文件已经完整写入
+        replaced.append(json.loads(open(src).read()))
+        real_replace(src, dst)
+    monkeypatch.setattr(main.os, "replace", replace)
+    store.update({"model": "gemini 3 flash", "api_key": "k"})
+    assert replaced == [{"model": "gemini 3 flash", "api_key": "k"}]
+    assert json.loads(path.read_text()) == replaced[0]
+    assert not (tmp_path / "writerai.json.tmp").exists()
+    store.update({"api_key": "k"})
+    assert len(replaced) == 1
+
+
+def test_failed_write_keeps_the_original_file(tmp_path, monkeypatch):
+    path = tmp_path / "writerai.json"
+    write(path, {"model": "qwen"})
+    store = main.ConfigStore(str(path))
+
+    def replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(main.os, "replace", replace)
+    store.update({"model": "gemini 3 pro"})
+    assert json.loads(path.read_text()) == {"model": "qwen"}
+    assert not (tmp_path / "writerai.json.tmp").exists()
+
+
+def test_malformed_json_falls_back(tmp_path):
+    path = tmp_path / "writerai.json"
+    write(path, "{broken", 1_000_000_000)
+    store = main.ConfigStore(str(path))
+    assert store.get("model", "default") == "default"
+    write(path, {"model": "qwen"}, 2_000_000_000)
+    assert store.get("model", "default") == "qwen"
+    # 之后又被写坏：沿用上次读到的设置
+    write(path, "[1, 2", 3_000_000_000)
+    assert store.get("model", "default") == "qwen"
+    write(path, "[1, 2]", 4_000_000_000)
+    assert store.get("model", "default") == "qwen"
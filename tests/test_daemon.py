@@ -0,0 +1,77 @@
+import threading
+
+import writerai_daemon
+
+
+class SlowWorker(writerai_daemon.Worker):
+    def __init__(self):
+        super().__init__(office=None)
+        self.release = threading.Event()
+        self.processed_paths = []
+
+    def process(self, request):
+        self.release.wait()
+        self.processed_paths.append(request["path"])
+        return {"ok": True}
+
+
+def test_task_timed_out_in_queue_is_not_run():
+    worker = SlowWorker()
+    worker.start()
+    first = {}
+    thread = threading.Thread(target=lambda: first.update(worker.submit({"path": "a.odt"}, 10)))
+    thread.start()
+    # b.odt 在 a.odt 执行期间排队并超时
+    result = worker.submit({"path": "b.odt"}, 0.05)
+    assert result["ok"] is False and "not run" in result["error"]
+    worker.release.set()
+    thread.join()
+    assert first["ok"] is True
+    worker.submit({"path": "c.odt"}, 10)
+    assert worker.processed_paths == ["a.odt", "c.odt"]
+
+
+def test_running_task_times_out_and_finishes_on_its_own():
+    worker = SlowWorker()
+    worker.start()
+    result = worker.submit({"path": "a.odt"}, 0.05)
+    assert result["timeout"] is True and result["state"] == "running"
+    worker.release.set()
+    # 调用方已返回，任务仍由工作线程执行完
+    worker.submit({"path": "b.odt"}, 10)
+    assert worker.processed_paths == ["a.odt", "b.odt"]
+
+
+class FakeConfigJob:
+    def __init__(self, config):
+        self.config = config
+
+    def get_config(self, key, default):
+        return self.config.get(key, default)
+
+    def set_config(self, key, value):
+        self.config[key] = value
+
+    def user_config_dir(self):
+        return "/tmp"
+
+
+def test_daemon_token_is_generated_once_and_saved():
+    job = FakeConfigJob({})
+    token = writerai_daemon.daemon_token(job)
+    assert token and job.config["daemon_token"] == token
+    assert writerai_daemon.daemon_token(job) == token
+
+
+def make_handler(token, authorization=None):
+    handler = writerai_daemon.Handler.__new__(writerai_daemon.Handler)
+    handler.token = token
+    handler.headers = {"Authorization": authorization} if authorization else {}
+    return handler
+
+
+def test_format_requires_the_daemon_token():
+    assert make_handler("secret", "Bearer secret").authorized()
+    assert not make_handler("secret", "Bearer wrong").authorized()
+    assert not make_handler("secret").authorized()
+    assert not make_handler(None, "Bearer ").authorized()
@@ -0,0 +1,57 @@
+import main
+
+
+class FakeParagraph:
+    def __init__(self, text, reads):
+        self.text = text
+        self.reads = reads
+
+    def getString(self):
+        self.reads.append(self.text)
+        return self.text
+
+
+class FakeText:
+    def __init__(self, index):
+        self.index = index
+
+    def getString(self):
+        return "\n".join(paragraph.text for paragraph in self.index.paragraphs)
+
+
+class FakeIndex:
+    def __init__(self, texts):
+        self.reads = []
+        self.revision = 0
+        self.paragraphs = [FakeParagraph(text, self.reads) for text in texts]
+        self.doc = type("Doc", (), {})()
+        self.doc.Text = FakeText(self)
+
+    def paragraph_styles(self):
+        return ["Standard"] * len(self.paragraphs)
+
+    def heading_paragraphs(self):
+        return []
+
+    def page_starts(self):
+        return [0]
+
+
+def test_format_only_edit_does_not_reread_paragraphs():
+    index = FakeIndex(["Title", "Body text"])
+    context = main.DocumentContext(index)
+    first = context.outline()
+    assert len(index.reads) == 2
+    index.revision += 1     # 只改了格式
+    assert context.outline() == first
+    assert len(index.reads) == 2
+
+
+def test_text_edit_rereads_paragraphs():
+    index = FakeIndex(["Title", "Body text"])
+    context = main.DocumentContext(index)
+    context.outline()
+    index.paragraphs[1].text = "Changed body"
+    index.revision += 1
+    assert "Changed body" in context.outline()
+    assert len(index.reads) == 4
@@ -0,0 +1,83 @@
+import main
+
+
+class FakeViewCursor:
+    def __init__(self, moves):
+        self.moves = moves
+        self.page = 1
+
+    def jumpToPage(self, page):
+        self.moves.append(("page", page))
+        self.page = page
+
+    def jumpToLastPage(self):
+        self.moves.append(("last",))
+        self.page = 3
+
+    def jumpToStartOfPage(self):
+        pass
+
+    def jumpToEndOfPage(self):
+        pass
+
+    def getPage(self):
+        return self.page
+
+    def getStart(self):
+        return ("start", self.page)
+
+    def getEnd(self):
+        return ("end", self.page)
+
+
+class FakeController:
+    PageCount = 3
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.cursor = FakeViewCursor(calls)
+
+    def getViewCursor(self):
+        return self.cursor
+
+    def getSelection(self):
+        return "selection"
+
+    def getViewData(self):
+        return "view data"
+
+    def select(self, selection):
+        self.calls.append(("select", selection))
+
+    def restoreViewData(self, data):
+        self.calls.append(("restore", data))
+
+
+class FakeDoc:
+    def __init__(self):
+        self.calls = []
+        self.controller = FakeController(self.calls)
+
+    def getCurrentController(self):
+        return self.controller
+
+    def lockControllers(self):
+        self.calls.append(("lock",))
+
+    def unlockControllers(self):
+        self.calls.append(("unlock",))
+
+
+def test_page_count_does_not_move_the_view_cursor():
+    doc = FakeDoc()
+    assert main.PageResolver(doc).page_count() == 3
+    assert doc.calls == []
+
+
+def test_prefetch_restores_the_user_view_once():
+    doc = FakeDoc()
+    resolver = main.PageResolver(doc)
+    resolver.prefetch([2, 3])
+    assert resolver.page_range(2) == (("start", 2), ("end", 2))
+    assert doc.calls == [("lock",), ("page", 2), ("page", 3), ("select", "selection"),
+                         ("restore", "view data"), ("unlock",)]
@@ -0,0 +1,60 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("query, plan", [
+    ("bold page 2 line 3", {"page_2": {"line_3": {"bold": True}}}),
+    ("font size 12 for the whole document", {"all_pages": {"font_size": 12.0}}),
+    ("remove highlight", {"selection": {"remove_highlight": True}}),
+    ("center line 1", {"page_1": {"line_1": {"align_center": True}}}),
+    ("Bold the first line", {"page_1": {"line_1": {"bold": True}}}),
+    ("make line 3 of page 2 italic and red", {"page_2": {"line_3": {"italic": True, "font_color": "FF0000"}}}),
+    ("align left page 3", {"page_3": {"line_all": {"align_left": True}}}),
+    ("right-align the second paragraph", {"page_1": {"line_2": {"align_right": True}}}),
+    ("bold all headings", {"headings": {"bold": True}}),
+    ("red double underline line 2", {"page_1": {"line_2": {"underline": "2FF0000"}}}),
+    ("第二页第三行加粗", {"page_2": {"line_3": {"bold": True}}}),
+    ("全文字号设为12", {"all_pages": {"font_size": 12.0}}),
+    ("取消高亮", {"selection": {"remove_highlight": True}}),
+    ("第一段居中", {"page_1": {"line_1": {"align_center": True}}}),
+    ("第一段左对齐", {"page_1": {"line_1": {"align_left": True}}}),
+    ("全文右对齐", {"all_pages": {"align_right": True}}),
+    ("所有标题加粗并且斜体", {"headings": {"bold": True, "italic": True}}),
+    ("make the text red", {"selection": {"font_color": "FF0000"}}),
+    ("第一段改成红色的", {"page_1": {"line_1": {"font_color": "FF0000"}}}),
+])
+def test_parses_formulaic_instructions(query, plan):
+    assert main.parse_instruction(query) == plan
+
+
+@pytest.mark.parametrize("query", [
+    # 位置词，不是对齐
+    "make the text on the left bold",
+    "bold the text to the right",
+    "italic the left column",
+    "把左边的文字加粗",
+    "align the selection to the right",
+    "靠右的段落加粗",
+    # 需要模型理解的指令
+    "bold wave underline line 1",
+    "make the conclusion bold",
+    "bold line 1 and italic line 2",
+    "replace hello with world",
+    "highlight all 'AI'",
+    "highlight page 4 in yellow",
+    "bold the last line",
+    "set font to Arial",
+    "bold page 0",
+    "标红第一行",
+    # 颜色修饰目标文字：按颜色选择，不是改颜色
+    "bold the red text",
+    "make the yellow text bold",
+    "italic the blue words",
+    "underline the red highlighted text",
+    "红色的文字加粗",
+    "红色文字加粗",
+    "把黄色的字改成斜体",
+])
+def test_falls_back_to_model(query):
+    assert main.parse_instruction(query) is None
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import main
+
+PLAN = {
+    "page_1": {"line_1": {"bold": True}, "line_2": {"insert_text": 'say "hi" {x} [y] \\ done'}},
+    "all_pages": {"font_size": 12},
+    "find": [{"text": "a}b", "format": {"italic": True}}],
+}
+
+
+def feed_all(pieces):
+    parser = main.PlanStreamParser()
+    entries = []
+    for piece in pieces:
+        entries.extend(parser.feed(piece))
+    return parser, entries
+
+
+def expected_entries():
+    return [
+        ("page_1", "line_1", {"bold": True}),
+        ("page_1", "line_2", PLAN["page_1"]["line_2"]),
+        ("all_pages", None, {"font_size": 12}),
+        ("find", None, PLAN["find"]),
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_entries_do_not_depend_on_how_the_stream_is_split(size):
+    text = "```json\n" + json.dumps(PLAN, ensure_ascii=False) + "\n```"
+    parser, entries = feed_all(text[i:i + size] for i in range(0, len(text), size))
+    assert entries == expected_entries()
+    assert parser.result() == PLAN
+
+
+def test_escaped_quotes_and_brackets_inside_strings_do_not_close_scopes():
+    parser, entries = feed_all(['{"selection": {"replace_text": "\\"}{]\\\\"}}'])
+    assert entries == [("selection", None, {"replace_text": '"}{]\\'})]
+    assert parser.finished
+
+
+def test_entry_is_emitted_as_soon_as_it_closes():
+    parser = main.PlanStreamParser()
+    assert parser.feed('{"page_2": {"line_3": {"bold": tr') == []
+    assert parser.feed('ue}') == [("page_2", "line_3", {"bold": True})]
+    assert parser.feed(', "line_4": {"italic": true}}}') == [("page_2", "line_4", {"italic": True})]
+
+
+def test_truncated_stream_keeps_closed_entries_and_has_no_result():
+    parser, entries = feed_all(['{"page_1": {"line_1": {"bold": true}, "line_2": {"ital'])
+    assert entries == [("page_1", "line_1", {"bold": True})]
+    assert not parser.finished
+    assert parser.result() is None
+
+
+def test_trailing_garbage_after_the_plan_is_ignored():
+    parser, entries = feed_all(['{"selection": {"bold": true}}', '\n``` extra {"page_9": {}}'])
+    assert entries == [("selection", None, {"bold": True})]
+    assert parser.result() == {"selection": {"bold": True}}
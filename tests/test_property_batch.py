@@ -0,0 +1,73 @@
+import main
+
+
+class FakeEnumeration:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def hasMoreElements(self):
+        return bool(self.items)
+
+    def nextElement(self):
+        return self.items.pop(0)
+
+
+class FakePortion:
+    def __init__(self, portion_type, values, collapsed=False):
+        self.TextPortionType = portion_type
+        self.IsCollapsed = collapsed
+        self.values = dict(values)
+        self.writes = []
+
+    def getPropertyValues(self, names):
+        return tuple(self.values[name] for name in names)
+
+    def setPropertyValues(self, names, values):
+        self.writes.append(dict(zip(names, values)))
+        self.values.update(zip(names, values))
+
+
+class FakeParagraph(FakePortion):
+    def __init__(self, portions):
+        super().__init__("Paragraph", {})
+        self.portions = portions
+
+    def supportsService(self, name):
+        return name == "com.sun.star.text.Paragraph"
+
+    def createEnumeration(self):
+        return FakeEnumeration(self.portions)
+
+
+class FakeRange:
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+
+    def createEnumeration(self):
+        return FakeEnumeration(self.paragraphs)
+
+
+def test_write_portions_covers_fields_and_skips_collapsed(monkeypatch):
+    monkeypatch.setitem(main.bridge_stats, "skipped_writes", 0)
+    text = FakePortion("Text", {"CharWeight": 150.0})
+    field = FakePortion("TextField", {"CharWeight": 100.0})
+    footnote = FakePortion("Footnote", {"CharWeight": 100.0})
+    bookmark = FakePortion("Bookmark", {}, collapsed=True)
+    batch = main.PropertyBatch(FakeRange([FakeParagraph([text, bookmark, field, footnote])]), skip_unchanged=True)
+    batch.CharWeight = 150.0
+    batch._write_portions(["CharWeight"])
+    assert text.writes == [] and bookmark.writes == []
+    assert field.writes == [{"CharWeight": 150.0}] and footnote.writes == [{"CharWeight": 150.0}]
+    assert main.bridge_stats["skipped_writes"] == 1
+    assert batch._pending == {}
+
+
+def test_unwritable_portion_falls_back_to_whole_range():
+    class Unreadable(FakePortion):
+        def getPropertyValues(self, names):
+            raise RuntimeError("unknown property")
+
+    batch = main.PropertyBatch(FakeRange([FakeParagraph([Unreadable("Ruby", {})])]), skip_unchanged=True)
+    batch.CharHeight = 12.0
+    batch._write_portions(["CharHeight"])
+    assert batch._pending == {"CharHeight": 12.0}
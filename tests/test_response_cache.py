@@ -0,0 +1,93 @@
+import json
+
+import main
+
+
+class CountingBackend(main.MockBackend):
+    def __init__(self, plan):
+        super().__init__(response=json.dumps(plan))
+        self.calls = 0
+
+    def complete(self, system_prompt, query):
+        self.calls += 1
+        return super().complete(system_prompt, query)
+
+
+OUTLINE = "# Document outline (page.line [paragraph style] text)\n1.1 [Heading 1] Intro\n1.2 [Standard] Some text"
+EDITED = "# Document outline (page.line [paragraph style] text)\n1.1 [Heading 1] Intro\n1.2 [Standard] Other text"
+RESTRUCTURED = OUTLINE + "\n2.1 [Standard] A new page"
+
+
+def ask(cache, backend, context):
+    return main.MainJob.askQwen("make everything bold", cache=cache, backend=backend, context=context)
+
+
+def test_generic_instruction_hits_after_edit(tmp_path):
+    cache = main.ResponseCache(str(tmp_path / "cache.json"))
+    backend = CountingBackend({"all_pages": {"line_all": {"bold": True}}})
+    ask(cache, backend, OUTLINE)
+    assert ask(cache, backend, RESTRUCTURED) == {"all_pages": {"line_all": {"bold": True}}}
+    assert backend.calls == 1
+
+
+def test_page_plan_is_keyed_on_outline_structure(tmp_path):
+    cache = main.ResponseCache(str(tmp_path / "cache.json"))
+    backend = CountingBackend({"page_1": {"line_2": {"bold": True}}})
+    ask(cache, backend, OUTLINE)
+    ask(cache, backend, EDITED)
+    assert backend.calls == 1
+    ask(cache, backend, RESTRUCTURED)
+    assert backend.calls == 2
+
+
+class Clock:
+    def __init__(self, monkeypatch, now=1000.0):
+        self.now = now
+        monkeypatch.setattr(main.time, "time", lambda: self.now)
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    path = str(tmp_path / "cache.json")
+    cache = main.ResponseCache(path, max_entries=2)
+    cache.put("a", {"selection": {"bold": True}})
+    clock.now += 1
+    cache.put("b", {"selection": {"italic": True}})
+    clock.now += 1
+    assert cache.get("a") is not None
+    clock.now += 1
+    cache.put("c", {"selection": {"font_size": 12}})
+    reloaded = main.ResponseCache(path, max_entries=2)
+    assert sorted(reloaded._load_disk()) == ["a", "c"]
+
+
+def test_expired_entry_is_a_miss_and_removed(tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    path = str(tmp_path / "cache.json")
+    cache = main.ResponseCache(path, ttl=10)
+    cache.put("a", {"selection": {"bold": True}})
+    clock.now += 11
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+    assert "a" not in main.ResponseCache(path)._load_disk()
+
+
+def test_entries_persist_and_reload_as_copies(tmp_path):
+    path = str(tmp_path / "cache.json")
+    main.ResponseCache(path).put("a", {"selection": {"bold": True}}, latency=1.5)
+    cache = main.ResponseCache(path)
+    plan = cache.get("a")
+    assert plan == {"selection": {"bold": True}}
+    plan["selection"]["bold"] = False
+    assert cache.get("a") == {"selection": {"bold": True}}
+    assert cache.stats()["hits"] == 2 and cache.stats()["saved_seconds"] == 3.0
+
+
+def test_corrupt_cache_file_is_ignored_and_rewritten(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_text("{not json", encoding="utf-8")
+    cache = main.ResponseCache(str(path))
+    assert cache.get("a") is None
+    cache.put("a", {"selection": {"bold": True}})
+    assert json.loads(path.read_text(encoding="utf-8"))["a"]["value"] == {"selection": {"bold": True}}
+    assert not (tmp_path / "cache.json.tmp").exists()
@@ -0,0 +1,166 @@
+import main
+
+
+class FakeIndex:
+    class pages:
+        @staticmethod
+        def prefetch(pages):
+            pass
+
+
+class FakeFormat:
+    style_mode = False
+    skip_unchanged = False
+    index = FakeIndex()
+
+    def __init__(self, traverse_all_text=True):
+        self.traverse_all_text = traverse_all_text
+
+
+def run(plan, monkeypatch, traverse_all_text=True):
+    calls = []
+    monkeypatch.setattr(main, "apply_operation",
+                        lambda fmt, op, trace=None: calls.append(("op", repr(op))))
+    monkeypatch.setattr(main, "apply_document_operations",
+                        lambda fmt, ops, trace=None: calls.append(("document", [repr(op) for op in ops])))
+    main._run_format_plan(plan if isinstance(plan, main.FormatPlan) else main.compile_plan(plan),
+                          FakeFormat(traverse_all_text))
+    return calls
+
+
+def test_document_ops_run_before_later_search(monkeypatch):
+    calls = run({
+        "all_pages": {"font_color": "000000"},
+        "find": {"text": "Total", "format": {"font_color": "FF0000"}},
+    }, monkeypatch)
+    assert [kind for kind, _ in calls] == ["document", "op"]
+    assert calls[1][1].startswith("find")
+
+
+def test_consecutive_document_ops_are_applied_together(monkeypatch):
+    calls = run(main.FormatPlan([
+        main.FormatOp("document", {"bold": True}),
+        main.FormatOp("document", {"italic": True}),
+        main.FormatOp("selection", {"font_size": 12}),
+        main.FormatOp("document", {"font_color": "FF0000"}),
+    ]), monkeypatch)
+    assert [(kind, len(value) if kind == "document" else 1) for kind, value in calls] == [
+        ("document", 2), ("op", 1), ("document", 1)]
+
+
+# ---- 每个文本只遍历一次 ----
+
+class FakeCursor:
+    def __init__(self, owner):
+        self.owner = owner
+        self.writes = []
+
+    def gotoStart(self, expand):
+        pass
+
+    def gotoEnd(self, expand):
+        pass
+
+    def gotoRange(self, text_range, expand):
+        pass
+
+    def getStart(self):
+        return None
+
+    def getEnd(self):
+        return None
+
+    def setPropertyValues(self, names, values):
+        self.writes.append(dict(zip(names, values)))
+
+
+class FakeText:
+    def __init__(self, name, cursors):
+        self.name = name
+        self.cursors = cursors
+
+    def createTextCursor(self):
+        cursor = FakeCursor(self.name)
+        self.cursors.append(cursor)
+        return cursor
+
+
+class FakeCollection:
+    def __init__(self, items):
+        self.items = items
+
+    def getCount(self):
+        return len(self.items)
+
+    def getByIndex(self, i):
+        return self.items[i]
+
+
+class FakeTable:
+    def __init__(self, cells):
+        self.cells = cells
+
+    def getCellNames(self):
+        return list(self.cells)
+
+    def getCellByName(self, name):
+        return self.cells[name]
+
+
+class FakeFrame:
+    def __init__(self, text):
+        self.text = text
+
+    def getText(self):
+        return self.text
+
+
+class FakeStyles:
+    def getByName(self, name):
+        return self
+
+    def getElementNames(self):
+        return []
+
+
+class FakeDoc:
+    def __init__(self, cursors):
+        self.cells = {"A1": FakeText("A1", cursors), "B1": FakeText("B1", cursors)}
+        self.frame = FakeText("frame", cursors)
+
+    def getTextTables(self):
+        return FakeCollection([FakeTable(self.cells)])
+
+    def getTextFrames(self):
+        return FakeCollection([FakeFrame(self.frame)])
+
+    def getStyleFamilies(self):
+        return FakeStyles()
+
+
+class WalkFormat(main.Format):
+    def __init__(self):
+        self.cursors = []
+        self.doc = FakeDoc(self.cursors)
+        self.style_mode = False
+        self.skip_unchanged = False
+        self.traverse_all_text = True
+
+    def get_document_cursor(self):
+        cursor = FakeCursor("body")
+        self.cursors.append(cursor)
+        return cursor
+
+
+def test_each_text_is_walked_once_for_all_document_ops():
+    fmt = WalkFormat()
+    main.apply_document_operations(fmt, [
+        main.FormatOp("document", {"bold": True}),
+        main.FormatOp("document", {"italic": True}),
+        main.FormatOp("document", {"font_color": "FF0000"}),
+    ])
+    assert sorted(cursor.owner for cursor in fmt.cursors) == ["A1", "B1", "body", "frame"]
+    for cursor in fmt.cursors:
+        # 三个操作的属性在一次提交中写入
+        assert len(cursor.writes) == 1
+        assert {"CharWeight", "CharPosture", "CharColor"} <= set(cursor.writes[0])
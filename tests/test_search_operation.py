@@ -0,0 +1,75 @@
+import re
+
+import pytest
+
+import main
+
+
+class FakeDescriptor:
+    def __init__(self):
+        self.attributes = None
+
+    def setReplaceAttributes(self, properties):
+        self.attributes = {prop.Name: prop.Value for prop in properties}
+
+
+class FakeDoc:
+    def __init__(self):
+        self.replaced = []
+
+    def createReplaceDescriptor(self):
+        return FakeDescriptor()
+
+    def replaceAll(self, descriptor):
+        self.replaced.append(descriptor)
+        return 1
+
+
+class SearchFormat(main.Format):
+    def __init__(self):
+        self.doc = FakeDoc()
+
+
+def run(entry, page_key="find"):
+    fmt = SearchFormat()
+    main.apply_search_operation(fmt, main.FormatOp.from_entry(page_key, None, entry))
+    return fmt.doc.replaced
+
+
+@pytest.mark.parametrize("literal, near_miss", [
+    ("a.b", "axb"),
+    ("(1)", "1"),
+    ("[x]*", "x"),
+    ("c:\\path", "c:path"),
+    ("$5^", "5"),
+    ("a|b", "a"),
+    ("x{2}+?", "xx"),
+])
+def test_literal_text_is_escaped(literal, near_miss):
+    [descriptor] = run({"text": literal, "format": {"bold": True}})
+    assert descriptor.SearchRegularExpression is True
+    # 这些转义在 ICU 和 Python 正则中含义相同
+    assert re.fullmatch(descriptor.SearchString, literal)
+    assert not re.search(descriptor.SearchString, near_miss)
+
+
+def test_regex_text_is_passed_through():
+    [descriptor] = run({"text": "([0-9]+)", "regex": True, "format": {"italic": True}})
+    assert descriptor.SearchString == "([0-9]+)"
+    assert descriptor.ReplaceString == "&"
+
+
+def test_format_is_mapped_to_replace_attributes():
+    [descriptor] = run({"text": "AI", "match_case": True, "whole_words": True,
+                        "format": {"bold": True, "font_color": "FF0000", "font_size": 14}})
+    assert descriptor.SearchCaseSensitive is True and descriptor.SearchWords is True
+    assert descriptor.attributes["CharWeight"] == "com.sun.star.awt.FontWeight.BOLD"
+    assert descriptor.attributes["CharColor"] == 0xFF0000
+    assert descriptor.attributes["CharHeight"] == 14
+
+
+def test_replace_all_keeps_text_literal():
+    [descriptor] = run({"text": "a.b", "replace_with": "$1"}, page_key="replace_all")
+    assert (descriptor.SearchString, descriptor.SearchRegularExpression) == ("a.b", False)
+    assert descriptor.ReplaceString == "$1"
+    assert descriptor.attributes is None
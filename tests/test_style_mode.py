@@ -0,0 +1,143 @@
+import main
+
+BOLD = "com.sun.star.awt.FontWeight.BOLD"
+
+
+class FakeEnumeration:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def hasMoreElements(self):
+        return bool(self.items)
+
+    def nextElement(self):
+        return self.items.pop(0)
+
+
+class FakeParagraph:
+    def __init__(self, style):
+        self.ParaStyleName = style
+
+    def supportsService(self, name):
+        return name == "com.sun.star.text.Paragraph"
+
+
+class FakeCell:
+    def __init__(self, style):
+        self.style = style
+
+    def createEnumeration(self):
+        return FakeEnumeration([FakeParagraph(self.style)])
+
+
+class FakeCollection:
+    def __init__(self, items):
+        self.items = items
+
+    def getCount(self):
+        return len(self.items)
+
+    def getByIndex(self, i):
+        return self.items[i]
+
+
+class FakeTable:
+    def __init__(self, style):
+        self.cell = FakeCell(style)
+
+    def getCellNames(self):
+        return ["A1"]
+
+    def getCellByName(self, name):
+        return self.cell
+
+
+class FakeStyle:
+    def __init__(self):
+        self.writes = []
+
+    def setPropertyValues(self, names, values):
+        self.writes.append(dict(zip(names, values)))
+
+
+class FakeFamilies:
+    def __init__(self, styles):
+        self.styles = styles
+
+    def getByName(self, name):
+        # 样式族和样式共用一个替身
+        return self.styles.get(name, self)
+
+    def getElementNames(self):
+        # 没有页面样式 (不遍历页眉页脚)
+        return []
+
+
+class FakeCursor:
+    """正文中有一段直接格式为常规粗细的文字。"""
+
+    def __init__(self):
+        self.writes = []
+
+    def getPropertyStates(self, names):
+        return tuple("com.sun.star.beans.PropertyState.DIRECT_VALUE" for _ in names)
+
+    def getPropertyValues(self, names):
+        return tuple(100.0 for _ in names)
+
+    def setPropertyValues(self, names, values):
+        self.writes.append(dict(zip(names, values)))
+
+    def setPropertiesToDefault(self, names):
+        raise AssertionError("direct formatting must not be reset")
+
+
+class FakeDoc:
+    def __init__(self, table_style):
+        self.styles = {"Standard": FakeStyle(), "Heading 1": FakeStyle()}
+        self.table_style = table_style
+
+    def getStyleFamilies(self):
+        return FakeFamilies(self.styles)
+
+    def getTextTables(self):
+        return FakeCollection([FakeTable(self.table_style)])
+
+    def getTextFrames(self):
+        return FakeCollection([])
+
+
+class FakeIndex:
+    def style_names(self):
+        return ["Standard", "Heading 1"]
+
+
+class StyleFormat(main.Format):
+    def __init__(self, table_style="Table Contents", traverse_all_text=False):
+        self.doc = FakeDoc(table_style)
+        self.index = FakeIndex()
+        self.traverse_all_text = traverse_all_text
+        self.cursor = FakeCursor()
+
+    def get_document_cursor(self):
+        return self.cursor
+
+
+def test_writes_only_requested_properties_to_styles_and_body():
+    fmt = StyleFormat()
+    assert main.apply_to_paragraph_styles(fmt, {"bold": True, "insert_text": "x"}) == {"insert_text": "x"}
+    for style in fmt.doc.styles.values():
+        assert style.writes == [{"CharWeight": BOLD}]
+    assert fmt.cursor.writes == [{"CharWeight": BOLD}]
+
+
+def test_style_shared_with_a_table_falls_back_to_direct_formatting():
+    fmt = StyleFormat(table_style="Standard")
+    assert main.apply_to_paragraph_styles(fmt, {"bold": True}) == {"bold": True}
+    assert all(style.writes == [] for style in fmt.doc.styles.values())
+
+
+def test_shared_style_is_in_scope_when_all_text_is_formatted():
+    fmt = StyleFormat(table_style="Standard", traverse_all_text=True)
+    assert main.apply_to_paragraph_styles(fmt, {"bold": True}) == {}
+    assert fmt.doc.styles["Standard"].writes == [{"CharWeight": BOLD}]
@@ -0,0 +1,394 @@
+"""
+writer.ai 命令行批量格式化：用多个 headless soffice 进程并行处理大量 .odt / .docx 文件。
+
+必须使用 LibreOffice 自带的 Python 运行 (需要 uno / pyuno)，例如:
+
+    /opt/libreoffice26.2/program/python writerai_batch.py archive/ --plan plan.json --workers 8
+    /opt/libreoffice26.2/program/python writerai_batch.py a.docx b.odt --preset "House style"
+    /opt/libreoffice26.2/program/python writerai_batch.py archive/ --instruction "bold all headings"
+
+计划只解析一次，所有文件执行同一份计划 (与扩展中的批量格式化相同)：--plan 为 JSON 或 JSON 文件，
+--preset / --instruction 使用 --config-dir 中的 writerai_presets.json / writerai.json (模型、API key、缓存)。
+
+每个 worker 是一个独立的子进程，启动自己的 soffice (独立的用户目录和 pipe)，逐个加载、格式化并保存
+收到的文件；主进程通过工作队列分发文件。worker 崩溃、或单个文件超过 --timeout 时，结束该 worker
+及其 soffice，记录该文件失败并重启 worker；每处理 --recycle 个文件也会重启一次，避免内存增长。
+
+每个文件的结果 (ok / error / 耗时 / 各阶段耗时 / worker) 追加到 --report 指定的 JSONL 文件。
+默认保存回原文件 (保持原格式)；--output-dir 时按相对于输入目录的路径另存到该目录 (保留子目录)。
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import selectors
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import uno
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main as writerai  # noqa: E402
+
+DOCUMENT_EXTENSIONS = (".odt", ".docx", ".doc", ".rtf", ".ott", ".dotx")
+DEFAULT_CONFIG_DIR = os.path.expanduser("~/.config/libreoffice/4/user/config")
+
+
+# ------------------------------------------------
+# Worker process: 一个 soffice，逐行读取任务，逐行输出结果
+# ------------------------------------------------
+
+def start_office(soffice, profile_dir, pipe_name):
+    command = [
+        soffice, "--headless", "--invisible", "--norestore", "--nologo", "--nodefault",
+        f"-env:UserInstallation={uno.systemPathToFileUrl(profile_dir)}",
+        f"--accept=pipe,name={pipe_name};urp;StarOffice.ComponentContext",
+    ]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def connect(pipe_name, timeout=60):
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return resolver.resolve(f"uno:pipe,name={pipe_name};urp;StarOffice.ComponentContext")
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def format_file(ctx, desktop, format_request, path, output_dir, suspend_layout, format_options, relative=None):
+    """加载、格式化并保存一个文件；返回结果字典。另存时保存到 output_dir 下的 relative 路径。"""
+    trace = writerai.RunTrace(None, mode="batch_cli", file=path)
+    doc = None
+    try:
+        with trace.phase("load"):
+            doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(path), "_blank", 0,
+                                               (writerai.make_property("Hidden", True),))
+        if doc is None or not doc.supportsService("com.sun.star.text.TextDocument"):
+            raise RuntimeError("not a Writer document")
+        writerai.execute_format_request(format_request, writerai.Format(ctx, doc, **format_options),
+                                        suspend_layout=suspend_layout, trace=trace)
+        with trace.phase("store"):
+            if output_dir:
+                # 另存时沿用加载时的过滤器，.docx 仍保存为 .docx
+                filters = [arg.Value for arg in doc.getArgs() if arg.Name == "FilterName"]
+                target = os.path.join(output_dir, relative or os.path.basename(path))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                doc.storeToURL(uno.systemPathToFileUrl(target),
+                               tuple(writerai.make_property("FilterName", value) for value in filters))
+            else:
+                doc.store()
+        record = trace.finish(ok=True)
+        return {"ok": True, "skipped_writes": record.get("skipped_writes", 0), "phases": record["phases"]}
+    except Exception as e:
+        record = trace.finish(ok=False, error=str(e))
+        return {"ok": False, "error": str(e), "skipped_writes": record.get("skipped_writes", 0),
+                "phases": record["phases"]}
+    finally:
+        if doc is not None:
+            try:
+                doc.close(True)
+            except Exception as e:
+                writerai.log_to_console(f"Error closing {path}: {e}", level=logging.WARNING)
+
+
+def run_worker(args):
+    with open(args.plan_file, encoding="utf-8") as file:
+        format_request = writerai.compile_plan(json.load(file))
+    format_options = {"style_mode": args.style_mode, "skip_unchanged": args.skip_unchanged,
+                      "traverse_all_text": not args.body_only}
+    pipe_name = f"writerai_batch_{os.getpid()}"
+    office = start_office(args.soffice, args.profile, pipe_name)
+    desktop = None
+    try:
+        ctx = connect(pipe_name)
+        desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+        print(json.dumps({"ready": True}), flush=True)
+        for line in sys.stdin:
+            task = json.loads(line)
+            result = format_file(ctx, desktop, format_request, task["path"], args.output_dir,
+                                 args.suspend_layout, format_options, task.get("relative"))
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+    finally:
+        try:
+            if desktop is not None:
+                desktop.terminate()
+        except Exception:
+            pass
+        try:
+            office.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            office.kill()
+
+
+# ------------------------------------------------
+# Driver: 工作队列、worker 重启和报告
+# ------------------------------------------------
+
+class WorkerProcess:
+    """主进程中的一个 worker 子进程句柄 (子进程和它的 soffice 在同一个进程组中)。"""
+
+    def __init__(self, number, args, plan_file, work_dir):
+        self.number = number
+        self.args = args
+        self.plan_file = plan_file
+        self.work_dir = work_dir
+        self.process = None
+        self.processed = 0
+        self.restarts = -1
+
+    def start(self):
+        profile = os.path.join(self.work_dir, f"profile_{self.number}")
+        # 重启时丢弃上一个 soffice 可能损坏的用户目录
+        shutil.rmtree(profile, ignore_errors=True)
+        command = [
+            sys.executable, os.path.abspath(__file__), "--worker",
+            "--plan-file", self.plan_file, "--profile", profile, "--soffice", self.args.soffice,
+            "--log-level", self.args.log_level,
+        ]
+        if self.args.output_dir:
+            command += ["--output-dir", self.args.output_dir]
+        if not self.args.suspend_layout:
+            command.append("--no-suspend-layout")
+        if self.args.style_mode:
+            command.append("--style-mode")
+        if self.args.skip_unchanged:
+            command.append("--skip-unchanged")
+        if self.args.body_only:
+            command.append("--body-only")
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                        encoding="utf-8", start_new_session=True)
+        self.processed = 0
+        self.restarts += 1
+        try:
+            ready = self.read(self.args.startup_timeout)
+        except TimeoutError:
+            ready = None
+        if ready is None:
+            self.stop(kill=True)
+            raise RuntimeError(f"worker {self.number} failed to start")
+
+    def read(self, timeout):
+        """读取一行结果；子进程退出时返回 None，超时抛出 TimeoutError。"""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            if not selector.select(timeout):
+                raise TimeoutError
+        line = self.process.stdout.readline()
+        return json.loads(line) if line else None
+
+    def run(self, path, relative=None):
+        if self.process is None or self.processed >= self.args.recycle:
+            self.stop()
+            self.start()
+        self.processed += 1
+        try:
+            self.process.stdin.write(json.dumps({"path": path, "relative": relative}) + "\n")
+            self.process.stdin.flush()
+            result = self.read(self.args.timeout)
+        except TimeoutError:
+            self.stop(kill=True)
+            return {"ok": False, "error": f"timed out after {self.args.timeout}s"}
+        except (OSError, ValueError):
+            result = None
+        if result is None:
+            self.stop(kill=True)
+            return {"ok": False, "error": "worker crashed"}
+        return result
+
+    def stop(self, kill=False):
+        if self.process is None:
+            return
+        if not kill and self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        # 结束整个进程组，包括挂起的 soffice
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+def collect_files(paths):
+    """
+    返回 [(绝对路径, 相对路径)]：目录中的文件相对于该目录 (保留子目录结构)，单独给出的文件为文件名。
+    --output-dir 下按相对路径保存。
+    """
+    files, seen = [], set()
+
+    def add(path, relative):
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            files.append((path, relative))
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(DOCUMENT_EXTENSIONS) and not name.startswith(".~lock"):
+                        add(os.path.join(root, name), os.path.relpath(os.path.join(root, name), path))
+        else:
+            add(path, os.path.basename(path))
+    return files
+
+
+def resolve_plan(args):
+    """按 --plan / --preset / --instruction 返回 JSON 计划；无效时抛出 ValueError。"""
+    if args.plan:
+        text = args.plan
+        if os.path.exists(text):
+            with open(text, encoding="utf-8") as file:
+                text = file.read()
+        format_request = json.loads(text)
+    elif args.preset:
+        store = writerai.PresetStore.for_path(os.path.join(args.config_dir, writerai.PresetStore.FILE_NAME))
+        if args.preset not in store.names():
+            raise ValueError(f"unknown preset {args.preset!r}")
+        format_request = store.raw_plan(args.preset)
+    else:
+        # 固定句式由本地解析器处理，不请求模型
+        format_request = writerai.parse_instruction(args.instruction)
+        writerai.record_planner("model" if format_request is None else "local")
+    if format_request is None and args.instruction:
+        config = writerai.ConfigStore.for_path(os.path.join(args.config_dir, writerai.ConfigStore.FILE_NAME))
+        backend = writerai.create_backend({
+            key: config.get(key, None) for key in ("model", "endpoint", "api_key", "request_timeout", "mock_response")
+        })
+        cache = writerai.ResponseCache.for_path(os.path.join(args.config_dir, writerai.ResponseCache.FILE_NAME))
+        format_request = writerai.MainJob.askQwen(args.instruction, cache=cache, backend=backend)
+        if not format_request:
+            raise ValueError("the model returned no plan")
+    problems = writerai.validate_plan(format_request)
+    if problems:
+        raise ValueError("invalid plan: " + "; ".join(problems))
+    return format_request
+
+
+def run_batch(args, files, format_request):
+    work_dir = tempfile.mkdtemp(prefix="writerai-batch-")
+    plan_file = os.path.join(work_dir, "plan.json")
+    with open(plan_file, "w", encoding="utf-8") as file:
+        json.dump(format_request, file, ensure_ascii=False)
+
+    tasks = queue.Queue()
+    for path, relative in files:
+        tasks.put((path, relative))
+    report_lock = threading.Lock()
+    totals = {"ok": 0, "failed": 0, "skipped_writes": 0}
+
+    def drive(worker):
+        try:
+            while True:
+                try:
+                    path, relative = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                started = time.perf_counter()
+                try:
+                    result = worker.run(path, relative)
+                except RuntimeError as e:
+                    result = {"ok": False, "error": str(e)}
+                result = {"file": path, **result, "seconds": round(time.perf_counter() - started, 3),
+                          "worker": worker.number, "restarts": worker.restarts}
+                with report_lock:
+                    totals["ok" if result["ok"] else "failed"] += 1
+                    totals["skipped_writes"] += result.get("skipped_writes", 0)
+                    with open(args.report, "a", encoding="utf-8") as file:
+                        file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    level = logging.INFO if result["ok"] else logging.WARNING
+                    writerai.log_to_console(f"[{totals['ok'] + totals['failed']}/{len(files)}] {path}: "
+                                            f"{'ok' if result['ok'] else result['error']} "
+                                            f"({result['seconds']:.1f}s)", level=level)
+        finally:
+            worker.stop()
+
+    started = time.perf_counter()
+    workers = [WorkerProcess(number, args, plan_file, work_dir) for number in range(min(args.workers, len(files)))]
+    threads = [threading.Thread(target=drive, args=(worker,), name=f"writerai-batch-{worker.number}")
+               for worker in workers]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    wall = time.perf_counter() - started
+    writerai.log_to_console(f"Batch finished: {totals['ok']} ok, {totals['failed']} failed in {wall:.1f}s "
+                            f"({len(files) / wall if wall else 0:.2f} files/s, {len(workers)} workers, "
+                            f"{totals['skipped_writes']} unchanged writes skipped)")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="文件或目录 (目录递归查找文档)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--plan", help="JSON 计划，或包含计划的文件")
+    source.add_argument("--preset", help="writerai_presets.json 中的预设名")
+    source.add_argument("--instruction", help="自然语言指令 (请求一次模型)")
+    parser.add_argument("--config-dir", default=DEFAULT_CONFIG_DIR, help="writerai.json 所在的 UserConfig 目录")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--soffice", default="soffice", help="soffice 可执行文件")
+    parser.add_argument("--output-dir", help="另存到该目录，而不是保存回原文件")
+    parser.add_argument("--report", default="writerai_batch_report.jsonl", help="JSONL 结果报告 (追加写入)")
+    parser.add_argument("--timeout", type=float, default=300, help="单个文件的最长处理时间 (秒)")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="worker 启动的最长时间 (秒)")
+    parser.add_argument("--recycle", type=int, default=200, help="每个 worker 处理多少个文件后重启")
+    parser.add_argument("--no-suspend-layout", dest="suspend_layout", action="store_false")
+    parser.add_argument("--style-mode", action="store_true", help="按段落样式修改格式 (同设置中的 style_mode)")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="只写入与当前值不同的属性 (同设置中的 skip_unchanged)")
+    parser.add_argument("--body-only", action="store_true",
+                        help="全文格式只作用于正文，不包括表格、文本框和页眉页脚 (同设置中的 traverse_all_text)")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--plan-file", help=argparse.SUPPRESS)
+    parser.add_argument("--profile", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    writerai.set_log_level(args.log_level)
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    if not (args.plan or args.preset or args.instruction):
+        parser.error("one of --plan, --preset or --instruction is required")
+    files = collect_files(args.paths)
+    if not files:
+        parser.error("no documents found")
+    if args.output_dir:
+        # 不同目录中的同名文件另存时不能落到同一个路径
+        targets = {}
+        for path, relative in files:
+            other = targets.setdefault(os.path.normcase(relative), path)
+            if other != path:
+                parser.error(f"{other} and {path} would both be saved as {relative} in --output-dir")
+        os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        format_request = resolve_plan(args)
+    except (ValueError, writerai.BackendError) as e:
+        parser.error(str(e))
+    totals = run_batch(args, files, format_request)
+    return 1 if totals["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+writer.ai 本地格式化守护进程：保持一个到 soffice 的常驻 UNO 连接，通过本地 HTTP 接收格式化任务。
+
+每个任务只需排队和执行，不再重复启动进程、建立 UNO 桥和创建 Desktop；
+模型请求复用 main.py 的 HTTP 连接池。必须使用 LibreOffice 自带的 Python 运行:
+
+    soffice --headless --accept="socket,host=localhost,port=2002;urp;" &
+    /opt/libreoffice26.2/program/python writerai_daemon.py --port 8765
+
+任务是 POST /format 的 JSON，path 加上 instruction / plan / preset 之一。请求必须带上
+writerai.json 中的 daemon_token (首次启动时自动生成)，本机其他用户的进程不能借守护进程读写文件:
+
+    TOKEN=...  # writerai.json 中 daemon_token 的值
+    curl -s localhost:8765/format -H "Authorization: Bearer $TOKEN" -d '{"path": "/tmp/a.odt", "instruction": "bold all headings"}'
+    curl -s localhost:8765/format -H "Authorization: Bearer $TOKEN" -d '{"path": "/tmp/a.odt", "plan": {"headings": {"bold": true}}}'
+    curl -s localhost:8765/format -H "Authorization: Bearer $TOKEN" -d '{"path": "/tmp/a.odt", "preset": "House style", "output": "/tmp/b.odt"}'
+
+可选字段: "save" (默认 true，保存回原文件)、"output" (另存为该路径)。
+GET /health 返回连接和队列状态。配置 (模型、API key、缓存等) 与扩展共用 writerai.json。
+
+任务由唯一的工作线程按顺序执行 (UNO 调用不跨线程并发)；HTTP 请求在各自线程中等待结果，
+响应中的 dispatch_ms 为任务在队列中等待的时间。超过 --timeout 时返回 504：仍在排队的任务被取消，
+已经开始的任务继续执行完 (响应中 state 为 running)。
+"""
+import argparse
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import uno
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main as writerai  # noqa: E402
+
+
+class OfficeConnection:
+    """到 soffice 的常驻 UNO 连接和 MainJob；连接断开后在下一个任务前重连。"""
+
+    def __init__(self, connect_string, log_level=None):
+        self.connect_string = connect_string
+        self.log_level = log_level
+        self.job = None
+
+    def get(self):
+        if self.job is None:
+            local = uno.getComponentContext()
+            resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+            ctx = resolver.resolve(f"uno:{self.connect_string};StarOffice.ComponentContext")
+            self.job = writerai.MainJob(ctx)
+            # MainJob 按 writerai.json 的 log_level 设置级别，命令行参数优先
+            if self.log_level:
+                writerai.set_log_level(self.log_level)
+            writerai.log_to_console(f"Connected to office at {self.connect_string}")
+        return self.job
+
+    def reset(self):
+        self.job = None
+
+
+class FormatTask:
+    """一个排队的任务；state 为 queued / running / cancelled / done，由 lock 保护。"""
+
+    def __init__(self, request):
+        self.request = request
+        self.received = time.perf_counter()
+        self.result = None
+        self.state = "queued"
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+
+class Worker(threading.Thread):
+    """唯一的 UNO 工作线程：按到达顺序处理任务。"""
+
+    def __init__(self, office):
+        super().__init__(name="writerai-daemon-worker", daemon=True)
+        self.office = office
+        self.queue = queue.Queue()
+        self.processed = 0
+
+    def submit(self, request, timeout):
+        """
+        排队并等待结果。超过 timeout 时返回带 "timeout" 和任务 state 的错误：
+        仍在排队的任务被取消 (不会再执行)；已经开始的任务不能中途停止，留给工作线程执行完，
+        调用方不再等待 (一个卡住的 UNO 调用不会占住所有 HTTP 线程)。
+        """
+        task = FormatTask(request)
+        self.queue.put(task)
+        if not task.done.wait(timeout):
+            with task.lock:
+                if task.state == "queued":
+                    task.state = "cancelled"
+                    return {"ok": False, "timeout": True, "state": "cancelled",
+                            "error": f"timed out after {timeout}s in queue, not run"}
+                if task.state == "running":
+                    return {"ok": False, "timeout": True, "state": "running",
+                            "error": f"timed out after {timeout}s, task is still running"}
+        return task.result
+
+    def run(self):
+        from com.sun.star.lang import DisposedException
+
+        while True:
+            task = self.queue.get()
+            with task.lock:
+                if task.state == "cancelled":
+                    writerai.log_to_console(f"Skipping cancelled task for {task.request.get('path')}")
+                    continue
+                task.state = "running"
+            started = time.perf_counter()
+            try:
+                try:
+                    task.result = self.process(task.request)
+                except DisposedException:
+                    # soffice 重启过：重连后重试一次
+                    writerai.log_to_console("Office connection lost, reconnecting", level=logging.WARNING)
+                    self.office.reset()
+                    task.result = self.process(task.request)
+            except Exception as e:
+                writerai.log_to_console(f"Error processing {task.request.get('path')}: {e}", level=logging.WARNING)
+                task.result = {"ok": False, "error": str(e)}
+            task.result["dispatch_ms"] = round((started - task.received) * 1000, 3)
+            self.processed += 1
+            task.state = "done"
+            task.done.set()
+
+    def process(self, request):
+        job = self.office.get()
+        path = os.path.abspath(request["path"])
+        trace = job.new_trace(mode="daemon", file=path)
+        doc, opened = self.open_document(job, uno.systemPathToFileUrl(path), trace)
+        try:
+            fmt = writerai.Format(job.ctx, doc, **job.format_options())
+            format_request = self.resolve_plan(job, request, fmt, trace)
+            writerai.execute_format_request(
+                format_request, fmt,
+                suspend_layout=job.suspend_layout(), trace=trace)
+            if request.get("save", True):
+                with trace.phase("store"):
+                    if request.get("output"):
+                        doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(request["output"])), ())
+                    else:
+                        doc.store()
+            record = trace.finish(ok=True)
+        except Exception as e:
+            trace.finish(ok=False, error=str(e))
+            raise
+        finally:
+            if opened:
+                doc.close(True)
+        return {
+            "ok": True,
+            "plan": format_request if isinstance(format_request, dict) else None,
+            "total": record["total"],
+            "skipped_writes": record.get("skipped_writes", 0),
+            "phases": record["phases"],
+        }
+
+    @staticmethod
+    def open_document(job, url, trace):
+        """已在 soffice 中打开的文档直接使用 (不关闭)，否则隐藏加载；返回 (doc, 是否由本任务打开)。"""
+        components = job.desktop.getComponents().createEnumeration()
+        while components.hasMoreElements():
+            component = components.nextElement()
+            if hasattr(component, "getURL") and component.getURL() == url:
+                return component, False
+        with trace.phase("load"):
+            doc = job.desktop.loadComponentFromURL(url, "_blank", 0, (writerai.make_property("Hidden", True),))
+        if doc is None or not doc.supportsService("com.sun.star.text.TextDocument"):
+            if doc is not None:
+                doc.close(True)
+            raise ValueError("not a Writer document")
+        return doc, True
+
+    @staticmethod
+    def resolve_plan(job, request, fmt, trace):
+        if "plan" in request:
+            problems = writerai.validate_plan(request["plan"])
+            if problems:
+                raise ValueError("invalid plan: " + "; ".join(problems))
+            return request["plan"]
+        if "preset" in request:
+            format_request = job.preset_store().plan(request["preset"])
+            if format_request is None:
+                raise ValueError(f"unknown preset {request['preset']!r}")
+            return format_request
+        instruction = request.get("instruction")
+        if not instruction:
+            raise ValueError("request needs one of plan, preset or instruction")
+        ask, _ = job.plan_request(instruction, fmt, job.response_cache(), job.get_backend(), trace)
+        format_request = ask()
+        if not format_request:
+            raise ValueError("the model returned no plan")
+        job.preset_store().remember(instruction, format_request)
+        return format_request
+
+
+class Handler(BaseHTTPRequestHandler):
+    worker = None
+    timeout_seconds = 300
+    token = None
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.reply(404, {"ok": False, "error": "not found"})
+            return
+        self.reply(200, {
+            "ok": True,
+            "connected": self.worker.office.job is not None,
+            "queued": self.worker.queue.qsize(),
+            "processed": self.worker.processed,
+        })
+
+    def do_POST(self):
+        if self.path != "/format":
+            self.reply(404, {"ok": False, "error": "not found"})
+            return
+        if not self.authorized():
+            self.reply(401, {"ok": False, "error": "missing or wrong daemon token"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(request, dict) or not request.get("path"):
+                raise ValueError("request must be a JSON object with a path")
+        except ValueError as e:
+            self.reply(400, {"ok": False, "error": str(e)})
+            return
+        result = self.worker.submit(request, self.timeout_seconds)
+        if result.get("timeout"):
+            self.reply(504, result)
+        else:
+            self.reply(200 if result.get("ok") else 500, result)
+
+    def authorized(self):
+        header = self.headers.get("Authorization", "")
+        return bool(self.token) and hmac.compare_digest(header.encode("utf-8"), f"Bearer {self.token}".encode("utf-8"))
+
+    def reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # 每个请求一条，按 logging 的 % 参数延迟格式化
+        writerai.logger.debug(format, *args)
+
+
+def daemon_token(job):
+    """读取 writerai.json 中的 daemon_token，没有时生成一个并保存。"""
+    token = job.get_config("daemon_token", "")
+    if not token:
+        token = secrets.token_urlsafe(24)
+        job.set_config("daemon_token", token)
+        writerai.log_to_console("Generated daemon_token in "
+                                f"{os.path.join(job.user_config_dir(), writerai.ConfigStore.FILE_NAME)}")
+    return token
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uno", default="socket,host=localhost,port=2002;urp",
+                        help="soffice --accept 使用的连接串")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=300, help="每个任务的最长等待时间 (秒)")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+
+    writerai.set_log_level(args.log_level)
+    office = OfficeConnection(args.uno, args.log_level)
+    # 启动时建立连接，之后的任务直接复用
+    job = office.get()
+    worker = Worker(office)
+    worker.start()
+
+    Handler.worker = worker
+    Handler.timeout_seconds = args.timeout
+    Handler.token = daemon_token(job)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    writerai.log_to_console(f"writer.ai daemon listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()